@@ -0,0 +1,4 @@
+import time
+
+# Start of the app's import, for the startup_seconds metric
+IMPORT_STARTED = time.perf_counter()
@@ -0,0 +1,121 @@
+"""Admission control: shed requests before they reach the handlers.
+
+Every request belongs to a route group (`ROUTE_GROUPS`) limited by its
+`ADMISSION_LIMITS`:
+
+- it only starts while this worker serves fewer requests than the group's
+  `in_flight_share` of `ADMISSION_MAX_IN_FLIGHT`, so under overload orders
+  are answered 503 first while catalog reads keep being served;
+- token buckets in Redis, per user and for all users together, shared by
+  every worker, answer 429 once a group is used faster than its rates.
+
+Both answers carry `Retry-After`. Monitoring routes are never shed.
+"""
+import logging
+import math
+from typing import Dict, List, NamedTuple, Tuple
+
+import aioredis
+from starlette.responses import JSONResponse
+
+from .keys import KEYS
+from .metrics import ADMISSION_REJECTED, route_template
+from .settings import ADMISSION_LIMITS, ADMISSION_MAX_IN_FLIGHT, ADMISSION_RETRY_AFTER
+from .utils import CacheUtils, RedisUtils
+
+logger = logging.getLogger("icecreamapi.admission")
+
+
+class GroupLimits(NamedTuple):
+    in_flight_share: float = 1.0
+    user_rate: float = 0  # requests per second, 0 for no limit
+    user_burst: int = 1
+    global_rate: float = 0
+    global_burst: int = 1
+
+
+# (method, route path) -> group, other routes are in "default"
+ROUTE_GROUPS = {
+    ("GET", "/"): "catalog",
+    ("GET", "/api/icecream/"): "catalog",
+    ("GET", "/api/icecream/{item_id}"): "catalog",
+    ("POST", "/api/order/new"): "orders",
+    ("POST", "/api/user/new"): "auth",
+    ("POST", "/api/user/login"): "auth",
+}
+UNLIMITED_ROUTES = {"/metrics", "/api/service/cache", "/health/live", "/health/ready"}
+
+GROUP_LIMITS: Dict[str, GroupLimits] = {
+    group: GroupLimits(**limits) for group, limits in ADMISSION_LIMITS.items()
+}
+
+
+async def client_identity(scope) -> str:
+    """The login of a valid bearer token, else the client address."""
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer" and token:
+                login = await CacheUtils.get_session_login(token)
+                if login is not None:
+                    return f"user:{login}"
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+async def rate_limit_wait(scope, group: str, limits: GroupLimits) -> int:
+    """Milliseconds until the request fits the group's rates, 0 to admit it now."""
+    buckets: List[Tuple[str, float, int]] = []
+    if limits.user_rate > 0:
+        identity = await client_identity(scope)
+        buckets.append((KEYS.rate_limit(group, identity), limits.user_rate, limits.user_burst))
+    if limits.global_rate > 0:
+        buckets.append((KEYS.rate_limit(group), limits.global_rate, limits.global_burst))
+    if not buckets:
+        return 0
+    try:
+        return await RedisUtils.take_tokens(buckets)
+    except aioredis.RedisError as e:
+        # Without Redis the handler fails anyway; let it say so.
+        logger.warning("rate limits not checked", extra={"group": group, "error": repr(e)})
+        return 0
+
+
+def rejection(status_code: int, detail: str, retry_after: int) -> JSONResponse:
+    return JSONResponse(
+        {"detail": detail}, status_code=status_code, headers={"Retry-After": str(retry_after)}
+    )
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, max_in_flight: int = ADMISSION_MAX_IN_FLIGHT) -> None:
+        self.app = app
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = route_template(scope)
+        if route in UNLIMITED_ROUTES:
+            await self.app(scope, receive, send)
+            return
+        group = ROUTE_GROUPS.get((scope["method"], route), "default")
+        limits = GROUP_LIMITS.get(group, GroupLimits())
+        if self.in_flight >= self.max_in_flight * limits.in_flight_share:
+            ADMISSION_REJECTED.inc(group, "overloaded")
+            response = rejection(503, "service is overloaded", ADMISSION_RETRY_AFTER)
+            await response(scope, receive, send)
+            return
+        self.in_flight += 1
+        try:
+            wait_ms = await rate_limit_wait(scope, group, limits)
+            if wait_ms:
+                ADMISSION_REJECTED.inc(group, "rate_limited")
+                response = rejection(429, "too many requests", math.ceil(wait_ms / 1000))
+                await response(scope, receive, send)
+                return
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
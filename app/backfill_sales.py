@@ -0,0 +1,25 @@
+"""Rebuild the sales counters of /api/analytics/sales from the stored orders.
+
+    python -m app.backfill_sales --batch-size 1000
+"""
+import argparse
+import asyncio
+
+from .logs import setup_logging
+from .utils import RedisUtils
+
+
+async def main(args: argparse.Namespace) -> None:
+    await RedisUtils.connect()
+    try:
+        await RedisUtils.backfill_sales(args.batch_size)
+    finally:
+        await RedisUtils.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    log_listener = setup_logging(log_format="text")
+    asyncio.run(main(parser.parse_args()))
+    log_listener.stop()
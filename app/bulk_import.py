@@ -0,0 +1,119 @@
+"""Bulk catalog import.
+
+    python -m app.bulk_import ice.json
+    python -m app.bulk_import catalog.jsonl --batch-size 1000 --image-workers 16
+
+`.json` files have the shape of `ice.json` and are loaded whole. `.jsonl`
+files hold one user (`{"login": ..., "password": ...}`) or icecream per line
+and are streamed, use them for big catalogs. Icecreams are matched to earlier
+imports by their `key` field, falling back to `name`, so re-running an import
+does not duplicate anything; icecreams with neither are skipped.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from typing import Iterator, List, Optional, Tuple
+
+from .logs import setup_logging
+from .models import IceCream, UserIn
+from .settings import IMAGE_WORKERS, WINDOWS_PLATFORM
+from .utils import ImageIngestionQueue, RedisUtils
+
+Record = Tuple[str, dict]
+logger = logging.getLogger("icecreamapi.import")
+
+
+def iter_records(path: str) -> Iterator[Record]:
+    if path.endswith(".jsonl"):
+        with open(path, "r") as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    yield ("user" if "login" in record else "icecream"), record
+        return
+    with open(path, "r") as file:
+        data = json.load(file)
+    for user in data.get("users", []):
+        yield "user", user
+    for icecream in data.get("icecreams", []):
+        yield "icecream", icecream
+
+
+def import_key(record: dict) -> Optional[str]:
+    """Pop the record's import key, its `name` when it has none."""
+    key = record.pop("key", None)
+    if key is None:
+        key = record.get("name")
+    return None if key is None else str(key)
+
+
+async def import_batch(batch: List[Record], images: ImageIngestionQueue) -> int:
+    """Write a batch and queue its new images, returns the number of new icecreams."""
+    await RedisUtils.import_users([UserIn(**record) for kind, record in batch if kind == "user"])
+    icecreams = []
+    for kind, record in batch:
+        if kind != "icecream":
+            continue
+        key = import_key(record)
+        if key is None:
+            logger.error("icecream without key or name skipped", extra={"record": record})
+            continue
+        icecreams.append((key, IceCream(**record)))
+    created = await RedisUtils.import_icecreams(icecreams)
+    for icecream in created:
+        if icecream.img_url:
+            await images.put(icecream.id, icecream.img_url)
+    return len(created)
+
+
+async def import_file(
+    path: str, batch_size: int = 500, image_workers: int = IMAGE_WORKERS
+) -> None:
+    images = ImageIngestionQueue(workers=image_workers)
+    images.start()
+    started_at = time.perf_counter()
+    records = created = 0
+    batch: List[Record] = []
+    for record in iter_records(path):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            created += await import_batch(batch, images)
+            records += len(batch)
+            batch = []
+    if batch:
+        created += await import_batch(batch, images)
+        records += len(batch)
+    written_in = time.perf_counter() - started_at
+    logger.info(
+        f"wrote {records} records ({created} new icecreams) in {written_in:.2f}s",
+        extra={"records_per_second": round(records / max(written_in, 1e-9))},
+    )
+    await images.join()
+    await images.stop()
+    images_in = time.perf_counter() - started_at
+    logger.info(
+        f"fetched {images.ready} images ({images.failed} failed), import took {images_in:.2f}s"
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    await RedisUtils.connect()
+    try:
+        await import_file(args.path, args.batch_size, args.image_workers)
+    finally:
+        await RedisUtils.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help=".json or .jsonl file")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--image-workers", type=int, default=IMAGE_WORKERS)
+    args = parser.parse_args()
+    if WINDOWS_PLATFORM:
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    log_listener = setup_logging(log_format="text")
+    asyncio.run(main(args))
+    log_listener.stop()
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .responses import ENCODINGS, compress, dumps
+from .settings import (
+    CATALOG_CACHE_SIZE,
+    CATALOG_CACHE_TTL,
+    SESSION_CACHE_SIZE,
+    SESSION_CACHE_TTL,
+)
+
+
+class TTLCache:
+    """Per-process LRU cache whose entries also expire after `ttl` seconds.
+
+    `generation` grows with every invalidation, so a value fetched before
+    one is not stored after it, see `set`.
+    """
+
+    def __init__(
+        self, maxsize: int, ttl: float, timer: Callable[[], float] = time.monotonic
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, value = item
+        if expires_at <= self.timer():
+            del self._data[key]
+            self.evictions += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None) -> None:
+        """Store `value`, unless it was fetched at a `generation` since invalidated."""
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (self.timer() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def keys(self) -> List[Hashable]:
+        return list(self._data)
+
+    def invalidate(self, key: Hashable) -> None:
+        self.generation += 1
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class SingleFlight:
+    """Share one in-flight fetch between concurrent callers asking for the same key.
+
+    Keys are tuples whose first item names the kind of read, counters are kept
+    per kind. The fetch runs as its own task, so a caller being cancelled (a
+    client gone away) does not fail the others waiting on it.
+    """
+
+    def __init__(self) -> None:
+        self.calls: Dict[Hashable, int] = {}
+        self.coalesced: Dict[Hashable, int] = {}
+        self._in_flight: Dict[Tuple, asyncio.Future] = {}
+
+    async def do(self, key: Tuple, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        kind = key[0]
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fetch())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.coalesced[kind] = self.coalesced.get(kind, 0) + 1
+        return await asyncio.shield(future)
+
+    def _done(self, key: Tuple, future: asyncio.Future) -> None:
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+        if not future.cancelled():
+            future.exception()  # retrieved here in case every caller went away
+
+    def forget(self, *prefix: Hashable) -> None:
+        """Make later callers start a new fetch for keys starting with `prefix`.
+
+        For reads racing a write: callers already waiting keep the old result.
+        """
+        for key in [key for key in self._in_flight if key[: len(prefix)] == prefix]:
+            del self._in_flight[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._in_flight),
+            "calls": sum(self.calls.values()),
+            "coalesced": sum(self.coalesced.values()),
+            "by_kind": {
+                kind: {"calls": calls, "coalesced": self.coalesced.get(kind, 0)}
+                for kind, calls in self.calls.items()
+            },
+        }
+
+
+class CatalogSnapshot(NamedTuple):
+    """Serialized catalog response body and the ETag identifying its version.
+
+    Compressed bodies are made on first use and kept with it, the ETag of
+    each gets the encoding appended.
+    """
+
+    body: bytes
+    etag: str
+    compressed: Dict[str, bytes]
+
+    @classmethod
+    def build(cls, items: List[BaseModel]) -> "CatalogSnapshot":
+        body = dumps(items)
+        return cls(body=body, etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"', compressed={})
+
+    def encoded(self, coding: str) -> Tuple[bytes, str]:
+        """Body compressed with `coding` and its ETag."""
+        body = self.compressed.get(coding)
+        if body is None:
+            body = self.compressed[coding] = compress(self.body, coding, smallest=True)
+        return body, f'{self.etag[:-1]}-{coding}"'
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        if not if_none_match:
+            return False
+        for tag in (tag.strip() for tag in if_none_match.split(",")):
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            for coding in ENCODINGS:
+                if tag.endswith(f'-{coding}"'):
+                    tag = f'{tag[:-len(coding) - 2]}"'
+            if tag == "*" or tag == self.etag:
+                return True
+        return False
+
+
+ALL_ICECREAMS_KEY = "all"
+CATALOG_SNAPSHOT_KEY = "snapshot"
+CATALOG_CACHE = TTLCache(CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL)
+SESSION_CACHE = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+SINGLE_FLIGHT = SingleFlight()
@@ -1,24 +1,78 @@
-from datetime import datetime
-from typing import List
+from datetime import datetime, timedelta
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.security import (
+    HTTPAuthorizationCredentials,
+    HTTPBasic,
+    HTTPBasicCredentials,
+    HTTPBearer,
+)
 from starlette.responses import FileResponse, HTMLResponse, Response
 
+from .cache import CATALOG_CACHE, SINGLE_FLIGHT
+from .metrics import render_metrics
 from .models import (
     IceCream,
+    IceCreamSearch,
+    IceCreamSort,
     Order,
     OrderPosition,
     ResponceDetail,
+    SalesReport,
     SuccessToken,
     UserIn,
     UserOut,
 )
-from .settings import FAVICON_PATH, MAIN_PAGE_RESPONSE
-from .utils import HashUtils, RedisUtils
+from .responses import ModelJSONResponse, choose_encoding
+from .settings import (
+    COMPRESSION_MIN_SIZE,
+    FAVICON_PATH,
+    ICECREAM_BATCH_MAX_SIZE,
+    MAIN_PAGE_RESPONSE,
+    ORDERS_PAGE_LIMIT,
+    ORDERS_PAGE_MAX_LIMIT,
+    SALES_REPORT_MAX_HOURS,
+    SEARCH_PAGE_MAX_LIMIT,
+)
+from .utils import CacheUtils, RedisUtils, SearchTooBroadError
 
-router = APIRouter()
+# Endpoints returning ModelJSONResponse themselves skip response_model validation.
+router = APIRouter(default_response_class=ModelJSONResponse)
 security = HTTPBasic()
+bearer = HTTPBearer()
+
+
+async def current_user_login(
+    credentials: HTTPAuthorizationCredentials = Depends(bearer),
+) -> str:
+    login = await CacheUtils.get_session_login(credentials.credentials)
+    if login is None:
+        raise HTTPException(status_code=401, detail="invalid token")
+    return login
+
+
+@router.get(
+    path="/health/live",
+    tags=["service"],
+    summary="The worker is up, restart it when this fails",
+)
+async def liveness() -> dict:
+    return {"status": "alive"}
+
+
+@router.get(
+    path="/health/ready",
+    tags=["service"],
+    summary="The worker is warmed up and can take traffic",
+    responses={
+        503: {"content": {"application/json": {"example": {"status": "not ready"}}}}
+    },
+)
+async def readiness(request: Request):
+    if not request.app.state.ready:
+        return ModelJSONResponse({"status": "not ready"}, status_code=503)
+    return {"status": "ready"}
 
 
 @router.get(
@@ -37,6 +91,45 @@ async def service_unavailable():
     raise HTTPException(503, detail="service is unavailable")
 
 
+@router.get(
+    path="/api/service/cache",
+    tags=["service"],
+    summary="Catalog cache and request coalescing counters of this worker",
+    responses={
+        200: {
+            "content": {
+                "application/json": {
+                    "example": {
+                        "size": 12,
+                        "maxsize": 1024,
+                        "hits": 5120,
+                        "misses": 31,
+                        "evictions": 2,
+                        "single_flight": {
+                            "in_flight": 0,
+                            "calls": 40,
+                            "coalesced": 25,
+                            "by_kind": {
+                                "all": {"calls": 12, "coalesced": 10},
+                                "icecream": {"calls": 20, "coalesced": 15},
+                                "orders": {"calls": 8, "coalesced": 0},
+                            },
+                        },
+                    }
+                }
+            }
+        }
+    },
+)
+async def cache_stats() -> dict:
+    return {**CATALOG_CACHE.stats(), "single_flight": SINGLE_FLIGHT.stats()}
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @router.get("/", response_class=HTMLResponse)
 async def root():
     return MAIN_PAGE_RESPONSE.format(counter=await RedisUtils.get_icecream_count())
@@ -50,7 +143,12 @@ async def favicon():
 @router.get(
     "/api/icecream/",
     tags=["icecream"],
-    summary="Get all icecreams",
+    summary="Get all icecreams, or search them",
+    description=(
+        "Without query parameters the whole catalog is returned with an `ETag`. "
+        "With any of them only the matching page is returned, "
+        "`limit` defaults to 20."
+    ),
     responses={
         200: {
             "content": {
@@ -62,6 +160,7 @@ async def favicon():
                             "price": 15.89,
                             "weight": 70.0,
                             "img_url": "https://media-cdn.tripadvisor.com/media/photo-s/18/7c/da/68/bonmot-ice-cream.jpg",
+                            "img_status": "ready",
                         },
                         {
                             "id": 2,
@@ -69,15 +168,115 @@ async def favicon():
                             "price": 13.56,
                             "weight": 50.0,
                             "img_url": "https://media-cdn.tripadvisor.com/media/photo-s/18/7c/da/68/bonmot-ice-cream.jpg",
+                            "img_status": "ready",
                         },
                     ]
                 }
             },
-        }
+        },
+        304: {"description": "Catalog did not change since the `ETag` in `If-None-Match`"},
+    },
+)
+async def get_icecreams(
+    if_none_match: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+    min_price: Optional[float] = Query(None),
+    max_price: Optional[float] = Query(None),
+    min_weight: Optional[float] = Query(None),
+    max_weight: Optional[float] = Query(None),
+    name: Optional[str] = Query(None, description="Case-insensitive name prefix"),
+    sort: Optional[IceCreamSort] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=SEARCH_PAGE_MAX_LIMIT),
+    offset: Optional[int] = Query(None, ge=0),
+    ids: Optional[str] = Query(
+        None,
+        regex=r"^\d+(,\d+)*$",
+        description="Comma separated ids to get in this order, other parameters are ignored",
+    ),
+):
+    if ids is not None:
+        id_list = [int(id_) for id_ in ids.split(",")]
+        if len(id_list) > ICECREAM_BATCH_MAX_SIZE:
+            raise HTTPException(
+                status_code=422, detail=f"at most {ICECREAM_BATCH_MAX_SIZE} ids"
+            )
+        return ModelJSONResponse(await CacheUtils.get_icecreams_by_ids(id_list))
+    params = dict(
+        min_price=min_price,
+        max_price=max_price,
+        min_weight=min_weight,
+        max_weight=max_weight,
+        name=name,
+        sort=sort,
+        limit=limit,
+        offset=offset,
+    )
+    search = {param: value for param, value in params.items() if value is not None}
+    if search:
+        try:
+            return ModelJSONResponse(await RedisUtils.search_icecreams(IceCreamSearch(**search)))
+        except SearchTooBroadError as e:
+            raise HTTPException(
+                status_code=422,
+                detail=f"search scans more than {e} icecreams, narrow it down",
+            )
+    snapshot = await CacheUtils.get_catalog_snapshot()
+    body, etag, headers = snapshot.body, snapshot.etag, {"Vary": "Accept-Encoding"}
+    coding = choose_encoding(accept_encoding)
+    if coding is not None and len(body) >= COMPRESSION_MIN_SIZE:
+        body, etag = snapshot.encoded(coding)
+        headers["Content-Encoding"] = coding
+    headers["ETag"] = etag
+    if snapshot.matches(if_none_match):
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@router.post(
+    "/api/icecream/batch",
+    tags=["icecream"],
+    summary="Add many icecreams at once",
+    status_code=201,
+    response_model=List[IceCream],
+)
+async def create_items(ice_creams: List[IceCream]):
+    check_batch_size(ice_creams)
+    return ModelJSONResponse(await RedisUtils.create_ice_creams(ice_creams), status_code=201)
+
+
+@router.put(
+    "/api/icecream/batch",
+    tags=["icecream"],
+    summary="Update many icecreams at once",
+    description="Each item needs its own `id`, only the fields it sets are changed.",
+    response_model=List[IceCream],
+    responses={
+        404: {
+            "content": {
+                "application/json": {"example": {"detail": "icecreams not found: [7, 9]"}}
+            },
+        },
     },
 )
-async def get_icecreams() -> List[IceCream]:
-    return await RedisUtils.get_all_ice_creams()
+async def update_items(ice_creams: List[IceCream]):
+    check_batch_size(ice_creams)
+    if any(ice_cream.id is None for ice_cream in ice_creams):
+        raise HTTPException(status_code=422, detail="every icecream needs an id")
+    ids = [ice_cream.id for ice_cream in ice_creams]
+    if len(set(ids)) < len(ids):
+        raise HTTPException(status_code=422, detail="icecream ids must be unique")
+    updated, missing = await RedisUtils.merge_icecream_updates(ice_creams)
+    if missing:
+        raise HTTPException(status_code=404, detail=f"icecreams not found: {missing}")
+    return ModelJSONResponse(await RedisUtils.update_icecreams(updated))
+
+
+def check_batch_size(batch: list) -> None:
+    if not 0 < len(batch) <= ICECREAM_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=422, detail=f"send 1 to {ICECREAM_BATCH_MAX_SIZE} icecreams"
+        )
 
 
 @router.get(
@@ -95,6 +294,7 @@ async def get_icecreams() -> List[IceCream]:
                             "price": 15.89,
                             "weight": 70.0,
                             "img_url": "https://media-cdn.tripadvisor.com/media/photo-s/18/7c/da/68/bonmot-ice-cream.jpg",
+                            "img_status": "ready",
                         }
                     ]
                 }
@@ -106,10 +306,10 @@ async def get_icecreams() -> List[IceCream]:
     },
 )
 async def get_icecream_by_id(item_id: int) -> IceCream:
-    ice_cream = await RedisUtils.get_icecream_by_id(item_id)
+    ice_cream = await CacheUtils.get_icecream_by_id(item_id)
     if not ice_cream:
         raise HTTPException(status_code=404, detail="not found")
-    return ice_cream
+    return ModelJSONResponse(ice_cream)
 
 
 @router.post(
@@ -163,7 +363,11 @@ async def new_user(user_in: UserIn) -> UserOut:
         200: {
             "model": SuccessToken,
             "description": "Successfull login",
-            "content": {"application/json": {"example": {"token": 1977390630}}},
+            "content": {
+                "application/json": {
+                    "example": {"token": "tTQe0DnP4xmQ7D6QlbfH_uFSk2t7aVQ3z1jzWfVtGZI"}
+                }
+            },
         },
         401: {
             "model": ResponceDetail,
@@ -185,7 +389,7 @@ async def login(credentials: HTTPBasicCredentials = Depends(security)) -> Succes
         raise HTTPException(status_code=404, detail="user not found")
     if not await RedisUtils.user_has_valid_password(user):
         raise HTTPException(status_code=401, detail="invalid credentials")
-    return {"token": HashUtils.gen_user_token()}
+    return {"token": await RedisUtils.create_session(user.login)}
 
 
 @router.post(
@@ -213,52 +417,61 @@ async def login(credentials: HTTPBasicCredentials = Depends(security)) -> Succes
         },
         401: {
             "model": ResponceDetail,
-            "description": "Invalid credentials",
+            "description": "Invalid token",
+            "content": {"application/json": {"example": {"detail": "invalid token"}}},
+        },
+        404: {
+            "model": ResponceDetail,
+            "description": "Ordered icecream does not exist",
             "content": {
-                "application/json": {"example": {"detail": "invalid credentials"}}
+                "application/json": {"example": {"detail": "icecream not found"}}
             },
         },
     },
 )
 async def make_order(
     positions: List[OrderPosition],
-    credentials: HTTPBasicCredentials = Depends(security),
+    login: str = Depends(current_user_login),
 ) -> Order:
-    user = UserIn(login=credentials.username, password=credentials.password)
-    if not await RedisUtils.is_user_exist(
-        user.login
-    ) or not await RedisUtils.user_has_valid_password(user):
-        raise HTTPException(status_code=401, detail="invalid credentials")
-    return await RedisUtils.create_order(user.login, positions)
+    order = await RedisUtils.create_order(login, positions)
+    if not order:
+        raise HTTPException(status_code=404, detail="icecream not found")
+    return ModelJSONResponse(order, status_code=201)
 
 
 @router.get(
     path="/api/order/my",
-    summary="Get all user orders",
+    summary="Get user orders page by page, newest first",
     tags=["orders"],
     responses={
         200: {
             "model": List[Order],
             "description": "User orders",
+            "headers": {
+                "X-Next-Cursor": {
+                    "description": "`cursor` of the next page, absent on the last page",
+                    "schema": {"type": "integer"},
+                }
+            },
             "content": {
                 "application/json": {
                     "example": [
                         {
-                            "id": 1,
+                            "id": 2,
                             "user_login": "bestboss",
-                            "created_at": datetime(2021, 11, 11, 11, 11, 11),
+                            "created_at": datetime(2021, 12, 12, 12, 12, 12),
                             "positions": [
-                                OrderPosition(icecream_id=1, quantity=2),
-                                OrderPosition(icecream_id=2, quantity=3),
+                                OrderPosition(icecream_id=4, quantity=1),
+                                OrderPosition(icecream_id=5, quantity=1),
                             ],
                         },
                         {
-                            "id": 2,
+                            "id": 1,
                             "user_login": "bestboss",
-                            "created_at": datetime(2021, 12, 12, 12, 12, 12),
+                            "created_at": datetime(2021, 11, 11, 11, 11, 11),
                             "positions": [
-                                OrderPosition(icecream_id=4, quantity=1),
-                                OrderPosition(icecream_id=5, quantity=1),
+                                OrderPosition(icecream_id=1, quantity=2),
+                                OrderPosition(icecream_id=2, quantity=3),
                             ],
                         },
                     ]
@@ -267,22 +480,54 @@ async def make_order(
         },
         401: {
             "model": ResponceDetail,
-            "description": "Invalid credentials",
-            "content": {
-                "application/json": {"example": {"detail": "invalid credentials"}}
-            },
+            "description": "Invalid token",
+            "content": {"application/json": {"example": {"detail": "invalid token"}}},
         },
     },
 )
 async def get_user_orders(
-    credentials: HTTPBasicCredentials = Depends(security),
+    cursor: Optional[int] = Query(None, ge=0),
+    limit: int = Query(ORDERS_PAGE_LIMIT, ge=1, le=ORDERS_PAGE_MAX_LIMIT),
+    login: str = Depends(current_user_login),
 ) -> List[Order]:
-    user = UserIn(login=credentials.username, password=credentials.password)
-    if not await RedisUtils.is_user_exist(
-        user.login
-    ) or not await RedisUtils.user_has_valid_password(user):
-        raise HTTPException(status_code=401, detail="invalid credentials")
-    return await RedisUtils.get_user_orders(user.login)
+    page = await CacheUtils.get_user_orders(login, cursor, limit)
+    headers = {} if page.next_cursor is None else {"X-Next-Cursor": str(page.next_cursor)}
+    return ModelJSONResponse(page.orders, headers=headers)
+
+
+@router.get(
+    path="/api/analytics/sales",
+    response_model=SalesReport,
+    summary="Top sellers and hourly sales totals",
+    description=(
+        "`top` best sellers by `by`, all time, and the totals of every hour "
+        "from `since` to `until` (the last 24 hours by default). Hours are in "
+        "server local time, times with an offset are converted to it."
+    ),
+    tags=["analytics"],
+)
+async def sales_report(
+    top: int = Query(10, ge=1, le=100),
+    by: str = Query("quantity", regex="^(quantity|revenue)$"),
+    since: Optional[datetime] = Query(None),
+    until: Optional[datetime] = Query(None),
+) -> SalesReport:
+    # The hourly counters are keyed by naive local time, see RedisUtils.buffer_sales
+    since, until = (
+        moment.astimezone().replace(tzinfo=None) if moment and moment.tzinfo else moment
+        for moment in (since, until)
+    )
+    until = until or datetime.now()
+    since = since or until - timedelta(hours=23)
+    if until - since > timedelta(hours=SALES_REPORT_MAX_HOURS):
+        raise HTTPException(
+            status_code=422, detail=f"at most {SALES_REPORT_MAX_HOURS} hours"
+        )
+    report = SalesReport(
+        top=await RedisUtils.get_top_sellers(top, by),
+        hourly=await RedisUtils.get_hourly_sales(since, until),
+    )
+    return ModelJSONResponse(report)
 
 
 @router.put(
@@ -293,14 +538,10 @@ async def get_user_orders(
     summary="Update icecream",
 )
 async def update_icecream(item_id: int, icecream: IceCream):
-    saved_icecream = await RedisUtils.get_icecream_by_id(item_id)
+    saved_icecream = await RedisUtils.get_icecream_by_id(item_id, primary=True)
     if not saved_icecream:
         raise HTTPException(404, f"Icecream with id {item_id} not found")
-    update_data = icecream.dict(exclude_unset=True)
-    saved_icecream_dict = saved_icecream.dict()
-    saved_icecream_dict.update(update_data)
-    updated_icecream = IceCream.parse_obj(saved_icecream_dict)
-    return await RedisUtils.update_icecream(updated_icecream)
+    return await RedisUtils.update_icecream(RedisUtils.merge_icecream_update(saved_icecream, icecream))
 
 
 
@@ -311,7 +552,7 @@ async def update_icecream(item_id: int, icecream: IceCream):
     summary="Delete icecream"
 )
 async def delete_icecream(item_id: int):
-    icecream = await RedisUtils.get_icecream_by_id(item_id)
+    icecream = await RedisUtils.get_icecream_by_id(item_id, primary=True)
     if not icecream:
         raise HTTPException(404, f"Icecream with id {item_id} not found")
     await RedisUtils.delete_icecream(item_id)
@@ -1,28 +1,22 @@
 import asyncio
-import json
 
-from .models import IceCream, UserIn
+from .bulk_import import import_file
+from .logs import setup_logging
 from .settings import WINDOWS_PLATFORM
 from .utils import RedisUtils
 
 
-def get_file_dict() -> dict:
-    with open("ice.json", "r") as file:
-        return json.loads(file.read())
-
-
 async def load_data_from_file():
-    data = get_file_dict()
-    for user in data["users"]:
-        await RedisUtils.create_user(UserIn(**user))
-
-    for icecream in data["icecreams"]:
-        await RedisUtils.create_ice_cream(IceCream(**icecream))
-
-    await asyncio.sleep(1)
+    await RedisUtils.connect()
+    try:
+        await import_file("ice.json")
+    finally:
+        await RedisUtils.disconnect()
 
 
 if __name__ == "__main__":
     if WINDOWS_PLATFORM:
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    log_listener = setup_logging(log_format="text")
     asyncio.run(load_data_from_file())
+    log_listener.stop()
@@ -0,0 +1,162 @@
+"""Names of the Redis keys, for a single Redis or a Redis Cluster.
+
+A cluster only runs a multi-key command, MULTI or Lua script when all its
+keys hash to one slot. With `REDIS_CLUSTER` every key carries a hash tag,
+the part in braces that alone decides the slot:
+
+- `{catalog}`: icecreams, the icecream id set, search indexes, import keys;
+- `{sales}`: sales counters, the order id list and stream;
+- `{<login>}`: a user, their order list and their orders;
+- `{<group>}`: the rate limit buckets of a route group.
+
+Otherwise the keys keep the names they always had. app.migrate_keys
+renames existing keys from the first layout to the second.
+"""
+from typing import Dict, Optional, Tuple, Union
+
+from .settings import (
+    ICECREAM_NAME_INDEX,
+    ICECREAM_NAME_MEMBERS,
+    ICECREAM_SCORE_INDEXES,
+    IMPORT_KEYS_HASH,
+    RATE_LIMIT_PREFIX,
+    REDIS_CLUSTER,
+    SALES_HOUR_PREFIX,
+    SALES_HOURS_KEY,
+    SALES_QUANTITY_KEY,
+    SALES_REVENUE_KEY,
+)
+
+CLUSTER_SLOTS = 16384
+CATALOG_TAG = "{catalog}"
+SALES_TAG = "{sales}"
+
+
+def crc16(data: bytes) -> int:
+    """CRC16-CCITT (XModem), the checksum Redis Cluster hashes keys with."""
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+    return crc
+
+
+def key_slot(key: Union[str, bytes]) -> int:
+    """Cluster slot of `key`: only its first non-empty `{...}` is hashed, if any."""
+    if isinstance(key, str):
+        key = key.encode()
+    start = key.find(b"{")
+    if start != -1:
+        end = key.find(b"}", start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return crc16(key) % CLUSTER_SLOTS
+
+
+class KeyLayout:
+    def __init__(self, cluster: bool = False) -> None:
+        self.cluster = cluster
+
+    def tagged(self, name: str, tag: str) -> str:
+        return f"{name}:{tag}" if self.cluster else name
+
+    # Catalog
+    def icecream(self, id_: int) -> str:
+        return f"icecream:{CATALOG_TAG}:{id_}" if self.cluster else f"icecream:{id_}"
+
+    def deleted_icecream(self, id_: int) -> str:
+        return f"deleted:{self.icecream(id_)}"
+
+    @property
+    def icecream_ids(self) -> str:
+        return self.tagged("icecream_ids", CATALOG_TAG)
+
+    @property
+    def score_indexes(self) -> Dict[str, str]:
+        return {
+            field: self.tagged(index, CATALOG_TAG)
+            for field, index in ICECREAM_SCORE_INDEXES.items()
+        }
+
+    @property
+    def name_index(self) -> str:
+        return self.tagged(ICECREAM_NAME_INDEX, CATALOG_TAG)
+
+    @property
+    def name_members(self) -> str:
+        return self.tagged(ICECREAM_NAME_MEMBERS, CATALOG_TAG)
+
+    @property
+    def import_keys(self) -> str:
+        return self.tagged(IMPORT_KEYS_HASH, CATALOG_TAG)
+
+    def highest_id(self, object_name: str) -> str:
+        """Counter of allocated `object_name` ids, "icecream" or "order"."""
+        tag = SALES_TAG if object_name == "order" else CATALOG_TAG
+        return self.tagged(f"{object_name}_highest_id", tag)
+
+    # Users and their orders
+    def user(self, login: str) -> str:
+        return f"user:{{{login}}}" if self.cluster else f"user:{login}"
+
+    def user_orders(self, login: str) -> str:
+        return f"{self.user(login)}:orders"
+
+    def order_prefix(self, login: str) -> str:
+        return f"order:{{{login}}}:" if self.cluster else "order:"
+
+    def order(self, login: str, id_: int) -> str:
+        return f"{self.order_prefix(login)}{id_}"
+
+    def order_ref(self, login: str, id_: int) -> str:
+        """Member of `order_ids` for an order: its id, or its key in a cluster,
+        where the id alone does not say which slot the order is in."""
+        return self.order(login, id_) if self.cluster else str(id_)
+
+    def order_from_ref(self, ref: Union[str, bytes]) -> Tuple[str, int]:
+        """The key and id of an `order_ids` member."""
+        if isinstance(ref, bytes):
+            ref = ref.decode()
+        if self.cluster:
+            return ref, int(ref.rsplit(":", 1)[1])
+        return f"order:{ref}", int(ref)
+
+    def token(self, token: str) -> str:
+        return f"token:{token}"
+
+    # Sales
+    @property
+    def order_ids(self) -> str:
+        return self.tagged("order_ids", SALES_TAG)
+
+    def stream(self, name: str) -> str:
+        """The order stream named `name`, "" (no stream) stays ""."""
+        return self.tagged(name, SALES_TAG) if name else name
+
+    @property
+    def sales_quantity(self) -> str:
+        return self.tagged(SALES_QUANTITY_KEY, SALES_TAG)
+
+    @property
+    def sales_revenue(self) -> str:
+        return self.tagged(SALES_REVENUE_KEY, SALES_TAG)
+
+    @property
+    def sales_hours(self) -> str:
+        return self.tagged(SALES_HOURS_KEY, SALES_TAG)
+
+    @property
+    def sales_hour_prefix(self) -> str:
+        return f"{SALES_HOUR_PREFIX}{SALES_TAG}:" if self.cluster else SALES_HOUR_PREFIX
+
+    def sales_hour(self, hour: str) -> str:
+        return f"{self.sales_hour_prefix}{hour}"
+
+    def rate_limit(self, group: str, identity: Optional[str] = None) -> str:
+        """Token bucket of a route group, per `identity` or shared by everyone."""
+        name = f"{{{group}}}" if self.cluster else group
+        return f"{RATE_LIMIT_PREFIX}{name}:{identity}" if identity else f"{RATE_LIMIT_PREFIX}{name}"
+
+
+KEYS = KeyLayout(REDIS_CLUSTER)
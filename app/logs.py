@@ -0,0 +1,129 @@
+"""Structured logging that keeps formatting and I/O off the event loop.
+
+Records are put on an in-memory queue as-is and formatted and written by a
+`QueueListener` thread. Pass cheap values as `extra` fields instead of
+pre-formatting messages, disabled levels then cost a single level check.
+High-volume events go through a `SampledLogger`, which drops most of them
+before a record is even built.
+"""
+import json
+import logging
+import queue
+import random
+import sys
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+from .settings import LOG_FORMAT, LOG_LEVEL, LOG_SAMPLE_RATES
+
+REQUEST_ID: ContextVar[str] = ContextVar("request_id", default="-")
+
+# Attributes every LogRecord has, everything else came in through `extra`.
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self) -> None:
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(
+            f"{k}={v}" for k, v in vars(record).items() if k not in _RECORD_ATTRIBUTES
+        )
+        line = super().format(record)
+        return f"{line} {fields}" if fields else line
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Enqueue records unformatted, only capturing the current request id."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = REQUEST_ID.get()
+        return record
+
+
+# Logger name -> share of its records below WARNING that get logged
+SAMPLE_RATES: Dict[str, float] = {}
+
+
+class SampledLogger(logging.LoggerAdapter):
+    """Logger that keeps only a `SAMPLE_RATES` share of its records below WARNING."""
+
+    def __init__(self, name: str) -> None:
+        super().__init__(logging.getLogger(name), {})
+
+    def isEnabledFor(self, level: int) -> bool:
+        if not self.logger.isEnabledFor(level):
+            return False
+        return level >= logging.WARNING or random.random() < SAMPLE_RATES.get(self.logger.name, 1)
+
+    def process(self, msg, kwargs):
+        return msg, kwargs
+
+
+def setup_logging(
+    level: str = LOG_LEVEL,
+    log_format: str = LOG_FORMAT,
+    sample_rates: Dict[str, float] = LOG_SAMPLE_RATES,
+) -> QueueListener:
+    """Route `icecreamapi` loggers through a queue, returns the started listener."""
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    logger = logging.getLogger("icecreamapi")
+    logger.setLevel(level)
+    logger.handlers = [DeferredQueueHandler(log_queue)]
+    logger.propagate = False
+    SAMPLE_RATES.clear()
+    SAMPLE_RATES.update(sample_rates)
+    # Not used by our formatters, skip collecting them for every record.
+    logging.logThreads = logging.logProcesses = logging.logMultiprocessing = False
+    listener.start()
+    return listener
+
+
+class RequestIdMiddleware:
+    """Tag everything logged while serving a request with its X-Request-ID."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id: Optional[str] = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+        request_id = request_id or uuid.uuid4().hex
+
+        async def send_with_request_id(message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode())]
+            await send(message)
+
+        token = REQUEST_ID.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            REQUEST_ID.reset(token)
@@ -1,27 +1,51 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+import aioredis
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 
+from .admission import AdmissionMiddleware
 from .endpoints import router
-from .settings import REDIS_CLIENT
-
-app = FastAPI(
-    title="IceCreamAPI",
-    description=(
-        "This service is MVP (ultra-minimal 😊) of API for mobile app."
-        "Настюха, оно вроде работает! Запускай приложуху!!! (только сначала сделай xD)"
-    ),
-    version="0.0.9",
-    contact={
-        "name": "Sizikov Vitaly",
-        "url": "https://vk.com/vitaliksiz",
-        "email": "sizikov.vitaly@gmail.com",
-    },
-)
-app.include_router(router)
-
-
-@app.on_event("startup")
-async def startup_event():
+from .logs import RequestIdMiddleware, setup_logging
+from .metrics import STARTUP_SECONDS, MetricsMiddleware, since_import
+from .responses import CompressionMiddleware
+from .settings import IMAGE_QUEUE_DRAIN_TIMEOUT, REDIS_SOCKET_TIMEOUT
+from .utils import IMAGE_QUEUE, CacheUtils, RedisUtils
+
+logger = logging.getLogger("icecreamapi")
+
+
+def create_app(
+    redis_client: Optional[aioredis.Redis] = None,
+    replica_client: Optional[aioredis.Redis] = None,
+) -> FastAPI:
+    """The API, connecting to Redis (`redis_client`, or a new pool) on startup,
+    and to its read replica (`replica_client`, or `REDIS_REPLICA_URL` if set).
+
+    Creating it has no side effects; `app.state.ready` is set once startup
+    has warmed it up, see /health/ready.
+    """
+    app = FastAPI(
+        title="IceCreamAPI",
+        description=(
+            "This service is MVP (ultra-minimal 😊) of API for mobile app."
+            "Настюха, оно вроде работает! Запускай приложуху!!! (только сначала сделай xD)"
+        ),
+        version="0.0.9",
+        contact={
+            "name": "Sizikov Vitaly",
+            "url": "https://vk.com/vitaliksiz",
+            "email": "sizikov.vitaly@gmail.com",
+        },
+    )
+    app.include_router(router)
+    app.add_middleware(AdmissionMiddleware)
+    app.add_middleware(CompressionMiddleware)
+    app.add_middleware(MetricsMiddleware)
+    app.add_middleware(RequestIdMiddleware)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
@@ -29,11 +53,51 @@ async def startup_event():
         allow_methods=["*"],
         allow_headers=["*"],
     )
-    await REDIS_CLIENT.incr("health")
-    print("SUCCESS:\tRedis initialized.")
+    app.state.ready = False
+
+    @app.on_event("startup")
+    async def startup_event():
+        started_at = time.perf_counter()
+        app.state.log_listener = setup_logging()
+        await RedisUtils.connect(redis_client)
+        replica = await RedisUtils.connect_replica(replica_client)
+        await RedisUtils.migrate_icecream_ids()
+        await RedisUtils.ensure_icecream_indexes()
+        await RedisUtils.load_scripts()
+        subscribed = asyncio.Event()
+        app.state.cache_listener = asyncio.create_task(
+            CacheUtils.listen_for_invalidations(subscribed)
+        )
+        # The listener clears the cache when it subscribes, warm it afterwards.
+        await asyncio.wait_for(subscribed.wait(), REDIS_SOCKET_TIMEOUT)
+        await CacheUtils.get_catalog_snapshot()
+        app.state.replica_monitor = (
+            asyncio.create_task(RedisUtils.monitor_replica()) if replica is not None else None
+        )
+        IMAGE_QUEUE.start()
+        app.state.ready = True
+        STARTUP_SECONDS.set(since_import(), "ready")
+        logger.info(
+            "ready",
+            extra={
+                "warm_up_seconds": round(time.perf_counter() - started_at, 3),
+                "since_import_seconds": round(since_import(), 3),
+            },
+        )
+
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        # The server has stopped accepting and drained in-flight requests by now.
+        app.state.ready = False
+        app.state.cache_listener.cancel()
+        if app.state.replica_monitor is not None:
+            app.state.replica_monitor.cancel()
+        await IMAGE_QUEUE.stop(drain_timeout=IMAGE_QUEUE_DRAIN_TIMEOUT)
+        await RedisUtils.disconnect()
+        app.state.log_listener.stop()
+
+    STARTUP_SECONDS.set(since_import(), "created")
+    return app
 
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    await REDIS_CLIENT.close()
-    print("SUCCESS:\tRedis connection was closed")
+app = create_app()
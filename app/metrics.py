@@ -0,0 +1,203 @@
+"""Prometheus-style metrics of this worker, rendered in the text exposition format."""
+import time
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+import aioredis
+from aioredis.client import Pipeline
+from starlette.routing import Match
+
+from . import IMPORT_STARTED
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    def _labels_text(self, values: LabelValues, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(header + self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._labels_text(labels)} {value}" for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values: str, amount: float = 1) -> None:
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value: float, *label_values: str) -> None:
+        self.values[label_values] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = ()):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[LabelValues, list] = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, *label_values: str) -> None:
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                bucket_labels = self._labels_text(labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels_text(labels)} {counts[-1]}")
+            lines.append(f"{self.name}_count{self._labels_text(labels)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "HTTP requests by route and status.", ["method", "route", "status"]
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route.",
+    ["method", "route"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being served.")
+REDIS_COMMAND_DURATION = Histogram(
+    "redis_command_duration_seconds",
+    "Redis round trip latency by command, pipelines are timed as PIPELINE.",
+    ["command"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+)
+REDIS_COMMAND_ERRORS = Counter("redis_command_errors_total", "Failed Redis commands.", ["command"])
+STARTUP_SECONDS = Gauge(
+    "startup_seconds",
+    "Seconds from the start of the app's import to the app being created, "
+    "ready (warmed up) and answering its first request.",
+    ["phase"],
+)
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total", "Requests shed by admission control.", ["group", "reason"]
+)
+REPLICA_LAG = Gauge(
+    "redis_replica_lag_seconds",
+    "Replication lag of the read replica at its last check, +Inf when it failed.",
+)
+REPLICA_READS = Counter(
+    "redis_replica_reads_total",
+    "Reads that may use the replica by route: replica, or to the primary as the "
+    "replica is lagging, the user made a recent_write or the replica_failed.",
+    ["route"],
+)
+
+
+def since_import() -> float:
+    return time.perf_counter() - IMPORT_STARTED
+
+
+def route_template(scope) -> str:
+    """The path template of the matching route, to keep label cardinality low."""
+    for route in scope["app"].routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app) -> None:
+        self.app = app
+        self.answered = False
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = "500"
+
+        async def send_with_status(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - start
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            route = route_template(scope)
+            HTTP_REQUESTS.inc(scope["method"], route, status)
+            HTTP_REQUEST_DURATION.observe(duration, scope["method"], route)
+            if not self.answered:
+                self.answered = True
+                STARTUP_SECONDS.set(since_import(), "first_request")
+
+
+async def _timed(command: str, coroutine):
+    start = time.perf_counter()
+    try:
+        return await coroutine
+    except Exception:
+        REDIS_COMMAND_ERRORS.inc(command)
+        raise
+    finally:
+        REDIS_COMMAND_DURATION.observe(time.perf_counter() - start, command)
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        return await _timed("PIPELINE", super().execute(raise_on_error))
+
+
+class InstrumentedRedis(aioredis.Redis):
+    """Redis client recording the latency of every command it sends."""
+
+    async def execute_command(self, *args, **options):
+        return await _timed(str(args[0]).upper(), super().execute_command(*args, **options))
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
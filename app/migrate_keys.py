@@ -0,0 +1,214 @@
+"""Rename the keys of a single Redis to the hash-tagged layout of REDIS_CLUSTER=1.
+
+Stop the API and the order workers, run this against the Redis being moved,
+copy that Redis into the cluster and start everything with REDIS_CLUSTER=1:
+
+    python -m app.migrate_keys --batch-size 1000
+    redis-cli --cluster import <cluster node> --cluster-from <this redis> --cluster-copy
+
+Keys are renamed a SCAN batch at a time with pipelined RENAMENX, and keys
+already in the cluster layout are left alone, so an interrupted run can be
+started again. Sessions and rate limit buckets keep their names.
+"""
+import argparse
+import asyncio
+import logging
+import re
+from typing import Dict, List, Optional, Sequence, Union
+
+import aioredis
+
+from .keys import KeyLayout
+from .logs import setup_logging
+from .serialization import ORDER_SERIALIZER
+from .settings import ORDER_STREAM, RATE_LIMIT_PREFIX, SALES_HOUR_PREFIX
+from .utils import RedisUtils
+
+logger = logging.getLogger("icecreamapi.migrate_keys")
+
+STANDALONE = KeyLayout(cluster=False)
+CLUSTER = KeyLayout(cluster=True)
+KEPT_PREFIXES = ("token:", RATE_LIMIT_PREFIX)
+ORDER_KEY = re.compile(r"order:(\d+)")
+# (pattern, key type, cluster name of a match) of the keys named after an id or login
+PATTERNS = [
+    (re.compile(r"icecream:(\d+)"), "hash", lambda match: CLUSTER.icecream(match[1])),
+    (re.compile(r"deleted:icecream:(\d+)"), "hash", lambda match: CLUSTER.deleted_icecream(match[1])),
+    (re.compile(r"user:(.+):orders"), "list", lambda match: CLUSTER.user_orders(match[1])),
+    (re.compile(r"user:(.+)"), "hash", lambda match: CLUSTER.user(match[1])),
+    (
+        re.compile(re.escape(SALES_HOUR_PREFIX) + r"(\d+)"),
+        "hash",
+        lambda match: CLUSTER.sales_hour(match[1]),
+    ),
+]
+
+
+def singleton_names(order_stream: str = ORDER_STREAM) -> Dict[str, str]:
+    """Single Redis name -> cluster name of the keys that exist once."""
+    names = {
+        getattr(STANDALONE, name): getattr(CLUSTER, name)
+        for name in (
+            "icecream_ids",
+            "name_index",
+            "name_members",
+            "import_keys",
+            "sales_quantity",
+            "sales_revenue",
+            "sales_hours",
+        )
+    }
+    names.update(zip(STANDALONE.score_indexes.values(), CLUSTER.score_indexes.values()))
+    for object_name in ("icecream", "order"):
+        names[STANDALONE.highest_id(object_name)] = CLUSTER.highest_id(object_name)
+    if order_stream:
+        names[order_stream] = CLUSTER.stream(order_stream)
+        names[f"{order_stream}:dead"] = f"{CLUSTER.stream(order_stream)}:dead"
+    return names
+
+
+def cluster_name(key: str, key_type: str, singletons: Dict[str, str]) -> Optional[str]:
+    """The cluster name of `key`, None when it keeps its name (orders aside)."""
+    if "{" in key or key.startswith(KEPT_PREFIXES):
+        return None
+    if key in singletons:
+        return singletons[key]
+    for pattern, pattern_type, rename in PATTERNS:
+        match = pattern.fullmatch(key)
+        if match and key_type == pattern_type:
+            return rename(match)
+    return None
+
+
+async def order_logins(
+    client: aioredis.Redis, ids: Sequence[Union[bytes, str]]
+) -> List[Optional[str]]:
+    """The user of each single Redis order, None for orders that are gone."""
+    keys_and_ids = [STANDALONE.order_from_ref(id_) for id_ in ids]
+    async with client.pipeline(transaction=False) as pipe:
+        for key, _ in keys_and_ids:
+            pipe.hget(key, "order")
+        raws = await pipe.execute()
+    return [
+        ORDER_SERIALIZER.loads(raw, id=id_).user_login if raw else None
+        for (_, id_), raw in zip(keys_and_ids, raws)
+    ]
+
+
+async def migrate_order_ids(client: aioredis.Redis, batch_size: int) -> int:
+    """Rewrite `order_ids` into the cluster one, which lists order keys since
+    those carry their user's tag. Run it before the orders are renamed.
+
+    Returns how many orders were listed.
+    """
+    if not await client.exists(STANDALONE.order_ids):
+        return 0
+    draft = f"{CLUSTER.order_ids}:draft"
+    await client.delete(draft)
+    listed = 0
+    total = await client.llen(STANDALONE.order_ids)
+    for start in range(0, total, batch_size):
+        ids = await client.lrange(STANDALONE.order_ids, start, start + batch_size - 1)
+        refs = [
+            CLUSTER.order_ref(login, int(id_))
+            for id_, login in zip(ids, await order_logins(client, ids))
+            if login is not None
+        ]
+        if refs:
+            listed = await client.rpush(draft, *refs)
+    async with client.pipeline(transaction=True) as pipe:
+        pipe.delete(STANDALONE.order_ids)
+        if listed:
+            pipe.rename(draft, CLUSTER.order_ids)
+        await pipe.execute()
+    logger.info("order ids migrated", extra={"orders": listed, "gone": total - listed})
+    return listed
+
+
+async def key_types(client: aioredis.Redis, keys: Sequence[str]) -> List[str]:
+    async with client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.type(key)
+        return [key_type.decode() for key_type in await pipe.execute()]
+
+
+async def order_names(
+    client: aioredis.Redis, keys: Sequence[str], types: Sequence[str]
+) -> Dict[str, str]:
+    """Single Redis name -> cluster name of the orders among `keys`."""
+    order_keys = {
+        key: match[1]
+        for key, key_type in zip(keys, types)
+        if key_type == "hash" and (match := ORDER_KEY.fullmatch(key))
+    }
+    logins = await order_logins(client, list(order_keys.values()))
+    return {
+        key: CLUSTER.order(login, int(id_))
+        for (key, id_), login in zip(order_keys.items(), logins)
+        if login is not None
+    }
+
+
+async def rename(client: aioredis.Redis, new_names: Dict[str, str]) -> int:
+    """RENAMENX every key to its new name, returns how many were."""
+    async with client.pipeline(transaction=False) as pipe:
+        for key, new_name in new_names.items():
+            pipe.renamenx(key, new_name)
+        results = await pipe.execute(raise_on_error=False)
+    renamed = 0
+    for (key, new_name), result in zip(new_names.items(), results):
+        if result is True:
+            renamed += 1
+        else:
+            logger.warning(
+                "key not renamed", extra={"key": key, "to": new_name, "result": repr(result)}
+            )
+    return renamed
+
+
+async def rename_keys(client: aioredis.Redis, batch_size: int) -> int:
+    """Rename every key of the single Redis layout, returns how many were."""
+    singletons = singleton_names()
+    renamed = 0
+    cursor = None
+    while cursor != 0:
+        cursor, keys = await client.scan(cursor or 0, count=batch_size)
+        keys = [key.decode() for key in keys]
+        types = await key_types(client, keys)
+        new_names = await order_names(client, keys, types)
+        for key, key_type in zip(keys, types):
+            new_name = cluster_name(key, key_type, singletons)
+            if new_name is not None:
+                new_names[key] = new_name
+        if new_names:
+            renamed += await rename(client, new_names)
+            logger.info("keys renamed", extra={"renamed": renamed})
+    return renamed
+
+
+async def migrate_keys(client: aioredis.Redis, batch_size: int = 1000) -> int:
+    """Move every key to the cluster layout, returns how many were renamed."""
+    await migrate_order_ids(client, batch_size)
+    renamed = 0
+    # Renames during a SCAN may make it miss keys, so scan until none are left.
+    while count := await rename_keys(client, batch_size):
+        renamed += count
+    return renamed
+
+
+async def main(args: argparse.Namespace) -> None:
+    client = await RedisUtils.connect()
+    try:
+        await migrate_keys(client, args.batch_size)
+    finally:
+        await RedisUtils.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    log_listener = setup_logging(log_format="text")
+    asyncio.run(main(parser.parse_args()))
+    log_listener.stop()
@@ -1,12 +1,19 @@
 from datetime import datetime
+from enum import Enum
 from typing import List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+IMAGE_PENDING = "pending"
+IMAGE_READY = "ready"
+IMAGE_FAILED = "failed"
+# Fields of IceCream only the image queue writes
+IMAGE_STATE_FIELDS = {"img_status", "thumbnail_url", "medium_url"}
 
 
 class OrderPosition(BaseModel):
     icecream_id: int
-    quantity: int
+    quantity: int = Field(..., gt=0)
 
     class Config:
         schema_extra = {
@@ -24,6 +31,11 @@ class Order(BaseModel):
     positions: List[OrderPosition]
 
 
+class OrdersPage(BaseModel):
+    orders: List[Order]
+    next_cursor: Optional[int] = None
+
+
 class User(BaseModel):
     login: str
     hash_: bytes
@@ -56,6 +68,9 @@ class IceCream(BaseModel):
     price: Optional[float] = 0
     weight: Optional[float] = 0
     img_url: Optional[str] = None
+    img_status: Optional[str] = None
+    thumbnail_url: Optional[str] = None
+    medium_url: Optional[str] = None
 
     class Config:
         schema_extra = {
@@ -68,9 +83,57 @@ class IceCream(BaseModel):
         }
 
 
+class IceCreamSort(str, Enum):
+    ID = "id"
+    ID_DESC = "-id"
+    NAME = "name"
+    NAME_DESC = "-name"
+    PRICE = "price"
+    PRICE_DESC = "-price"
+    WEIGHT = "weight"
+    WEIGHT_DESC = "-weight"
+
+    @property
+    def field(self) -> str:
+        return self.value.lstrip("-")
+
+    @property
+    def descending(self) -> bool:
+        return self.value.startswith("-")
+
+
+class IceCreamSearch(BaseModel):
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    min_weight: Optional[float] = None
+    max_weight: Optional[float] = None
+    name: Optional[str] = None  # case-insensitive prefix
+    sort: IceCreamSort = IceCreamSort.ID
+    limit: Optional[int] = None  # SEARCH_PAGE_LIMIT
+    offset: int = 0
+
+
+class IceCreamSales(BaseModel):
+    icecream_id: int
+    quantity: int
+    revenue: float
+
+
+class HourlySales(BaseModel):
+    hour: datetime
+    orders: int = 0
+    quantity: int = 0
+    revenue: float = 0
+
+
+class SalesReport(BaseModel):
+    top: List[IceCreamSales]
+    hourly: List[HourlySales]
+
+
 class ResponceDetail(BaseModel):
     detail: str
 
 
 class SuccessToken(BaseModel):
-    token: int
+    token: str
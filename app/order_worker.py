@@ -0,0 +1,237 @@
+"""Persist orders from `ORDER_STREAM` into SQLite, outside the API processes.
+
+Runs as a consumer of the `ORDER_WORKER_GROUP` consumer group, so several
+workers share the stream. Entries are acknowledged once their batch is
+committed; entries left unacknowledged (a crash, a failed write) are
+claimed again after `ORDER_WORKER_RETRY_IDLE_MS` and moved to the
+`<stream>:dead` stream after `ORDER_WORKER_MAX_DELIVERIES` attempts.
+
+    python -m app.order_worker --db orders.sqlite3
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+import aioredis
+
+from .keys import KEYS
+from .logs import setup_logging
+from .metrics import InstrumentedRedis
+from .models import Order
+from .serialization import ORDER_SERIALIZER
+from .settings import (
+    ORDER_STORE_PATH,
+    ORDER_STREAM,
+    ORDER_WORKER_BATCH_SIZE,
+    ORDER_WORKER_BLOCK_MS,
+    ORDER_WORKER_GROUP,
+    ORDER_WORKER_MAX_DELIVERIES,
+    ORDER_WORKER_RETRY_IDLE_MS,
+    REDIS_CONNECTION_STRING,
+    REDIS_HEALTH_CHECK_INTERVAL,
+    REDIS_SOCKET_TIMEOUT,
+)
+
+logger = logging.getLogger("icecreamapi.order_worker")
+
+StreamEntry = Tuple[bytes, Optional[Dict[bytes, bytes]]]
+
+
+class OrderStore:
+    """SQLite copy of the orders, upserted by id so a redelivered entry is harmless."""
+
+    def __init__(self, path: str) -> None:
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS orders ("
+                "id INTEGER PRIMARY KEY, user_login TEXT NOT NULL, "
+                "created_at TEXT NOT NULL, positions TEXT NOT NULL)"
+            )
+
+    def save(self, orders: List[Order]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO orders VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        order.id,
+                        order.user_login,
+                        order.created_at.isoformat(),
+                        json.dumps([position.dict() for position in order.positions]),
+                    )
+                    for order in orders
+                ],
+            )
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def decode_entry(fields: Dict[bytes, bytes]) -> Order:
+    return ORDER_SERIALIZER.loads(fields[b"order"], id=int(fields[b"id"]))
+
+
+class OrderStreamWorker:
+    def __init__(
+        self,
+        client: aioredis.Redis,
+        store: OrderStore,
+        consumer: str,
+        stream: str = KEYS.stream(ORDER_STREAM),
+        group: str = ORDER_WORKER_GROUP,
+        batch_size: int = ORDER_WORKER_BATCH_SIZE,
+        block_ms: int = ORDER_WORKER_BLOCK_MS,
+        retry_idle_ms: int = ORDER_WORKER_RETRY_IDLE_MS,
+        max_deliveries: int = ORDER_WORKER_MAX_DELIVERIES,
+    ) -> None:
+        self.client = client
+        self.store = store
+        self.consumer = consumer
+        self.stream = stream
+        self.group = group
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.retry_idle_ms = retry_idle_ms
+        self.max_deliveries = max_deliveries
+        self.persisted = 0
+        self.dead = 0
+
+    async def ensure_group(self) -> None:
+        """Create the consumer group reading from the start of the stream."""
+        try:
+            await self.client.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except aioredis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def run(self, stop: asyncio.Event) -> None:
+        await self.ensure_group()
+        logger.info("order worker started", extra={"consumer": self.consumer})
+        while not stop.is_set():
+            await self.run_once()
+        logger.info(
+            "order worker stopped",
+            extra={"persisted": self.persisted, "dead": self.dead},
+        )
+
+    async def run_once(self) -> int:
+        """Retry stale entries, then read and persist one batch of new ones."""
+        handled = await self.process(await self.claim_stale())
+        response = await self.client.xreadgroup(
+            self.group,
+            self.consumer,
+            {self.stream: ">"},
+            count=self.batch_size,
+            block=self.block_ms,
+        )
+        for _, entries in response or []:
+            handled += await self.process(entries)
+        return handled
+
+    async def claim_stale(self) -> List[StreamEntry]:
+        pending = await self.client.xpending_range(
+            self.stream, self.group, "-", "+", self.batch_size
+        )
+        stale = [entry for entry in pending if entry["time_since_delivered"] >= self.retry_idle_ms]
+        exhausted = [
+            entry["message_id"]
+            for entry in stale
+            if entry["times_delivered"] >= self.max_deliveries
+        ]
+        if exhausted:
+            entries = await self.client.xclaim(
+                self.stream, self.group, self.consumer, self.retry_idle_ms, exhausted
+            )
+            await self.dead_letter(entries, "too many deliveries")
+        retry = [
+            entry["message_id"]
+            for entry in stale
+            if entry["times_delivered"] < self.max_deliveries
+        ]
+        if not retry:
+            return []
+        return await self.client.xclaim(
+            self.stream, self.group, self.consumer, self.retry_idle_ms, retry
+        )
+
+    async def process(self, entries: List[StreamEntry]) -> int:
+        """Persist a batch in one transaction and ack it, or leave it pending for a retry."""
+        if not entries:
+            return 0
+        orders, ids, undecodable = [], [], []
+        for entry_id, fields in entries:
+            if not fields:  # trimmed from the stream before it was read
+                ids.append(entry_id)
+                continue
+            try:
+                orders.append(decode_entry(fields))
+                ids.append(entry_id)
+            except Exception:
+                logger.exception("undecodable order entry", extra={"entry_id": entry_id.decode()})
+                undecodable.append((entry_id, fields))
+        try:
+            self.store.save(orders)
+        except Exception:
+            logger.exception("order batch not persisted", extra={"size": len(orders)})
+            return 0
+        if ids:
+            await self.client.xack(self.stream, self.group, *ids)
+        await self.dead_letter(undecodable, "undecodable")
+        self.persisted += len(orders)
+        return len(entries)
+
+    async def dead_letter(self, entries: List[StreamEntry], reason: str) -> None:
+        if not entries:
+            return
+        async with self.client.pipeline(transaction=True) as pipe:
+            for entry_id, fields in entries:
+                pipe.xadd(
+                    f"{self.stream}:dead",
+                    {**(fields or {}), b"entry_id": entry_id, b"reason": reason},
+                )
+            pipe.xack(self.stream, self.group, *(entry_id for entry_id, _ in entries))
+            await pipe.execute()
+        self.dead += len(entries)
+        logger.warning("order entries dead-lettered", extra={"count": len(entries), "reason": reason})
+
+
+async def main(args: argparse.Namespace) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    store = OrderStore(args.db)
+    # Its own connection, XREADGROUP blocks longer than the API's socket timeout
+    client = InstrumentedRedis.from_url(
+        REDIS_CONNECTION_STRING,
+        socket_timeout=ORDER_WORKER_BLOCK_MS / 1000 + REDIS_SOCKET_TIMEOUT,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+    )
+    worker = OrderStreamWorker(client, store, args.consumer, batch_size=args.batch_size)
+    try:
+        await worker.run(stop)
+    finally:
+        store.close()
+        await client.connection_pool.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db", default=ORDER_STORE_PATH)
+    parser.add_argument("--consumer", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--batch-size", type=int, default=ORDER_WORKER_BATCH_SIZE)
+    listener = setup_logging()
+    try:
+        asyncio.run(main(parser.parse_args()))
+    finally:
+        listener.stop()
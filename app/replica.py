@@ -0,0 +1,56 @@
+"""Replication lag of the read replica, see RedisUtils.read."""
+import logging
+import math
+
+import aioredis
+
+from .metrics import REPLICA_LAG
+from .settings import REPLICA_CHECK_INTERVAL, REPLICA_HEARTBEAT_KEY, REPLICA_MAX_LAG
+
+logger = logging.getLogger("icecreamapi.redis")
+
+
+class ReplicaMonitor:
+    """Lag of a replica, measured with a heartbeat written to its primary.
+
+    Each check reads the heartbeat the replica has, then writes the primary's
+    current TIME as the next one. `lag` is the age of the heartbeat the
+    replica had, so it exceeds the real lag by up to `interval` (less with
+    several workers writing heartbeats). It is infinite until the replica
+    has a heartbeat and while it cannot be read.
+    """
+
+    def __init__(
+        self,
+        max_lag: float = REPLICA_MAX_LAG,
+        interval: float = REPLICA_CHECK_INTERVAL,
+        key: str = REPLICA_HEARTBEAT_KEY,
+    ) -> None:
+        self.max_lag = max_lag
+        self.interval = interval
+        self.key = key
+        self.lag = math.inf
+
+    @property
+    def healthy(self) -> bool:
+        return self.lag <= self.max_lag
+
+    def mark_down(self, error: Exception) -> None:
+        """Keep reads off the replica until a check reaches it again."""
+        if self.lag != math.inf:
+            logger.warning("replica unavailable", extra={"error": repr(error)})
+        self.lag = math.inf
+        REPLICA_LAG.set(self.lag)
+
+    async def check(self, primary: aioredis.Redis, replica: aioredis.Redis) -> float:
+        seconds, microseconds = await primary.time()
+        now = seconds + microseconds / 1e6
+        try:
+            seen = await replica.get(self.key)
+        except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+            self.mark_down(e)
+        else:
+            self.lag = max(now - float(seen), 0) if seen is not None else math.inf
+            REPLICA_LAG.set(self.lag)
+        await primary.set(self.key, repr(now))
+        return self.lag
@@ -0,0 +1,130 @@
+"""JSON encoding of responses with orjson, and their negotiated compression."""
+import gzip
+from typing import Any, Optional
+
+import brotli
+import orjson
+from pydantic import BaseModel
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+
+from .settings import (
+    COMPRESSION_BROTLI_QUALITY,
+    COMPRESSION_GZIP_LEVEL,
+    COMPRESSION_MIN_SIZE,
+)
+
+# Preferred first when the client accepts both equally
+ENCODINGS = ("br", "gzip")
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """JSON of `content`, models included, as FastAPI would have written it."""
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class ModelJSONResponse(JSONResponse):
+    """JSON response encoding pydantic models as they are.
+
+    Endpoints returning one skip FastAPI's validation against their
+    `response_model` and its `jsonable_encoder`, so only return models
+    this app built itself.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """The one of `ENCODINGS` the client prefers by q-value, None for identity."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, *params = item.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for coding in ENCODINGS:
+        quality = accepted.get(coding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress(body: bytes, coding: str, smallest: bool = False) -> bytes:
+    """`smallest` spends more CPU, for bodies compressed once and served many times."""
+    if coding == "br":
+        return brotli.compress(body, quality=11 if smallest else COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=9 if smallest else COMPRESSION_GZIP_LEVEL)
+
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    return content_type is not None and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def vary_on(headers: MutableHeaders, name: str) -> None:
+    """Add `name` to `Vary` unless it is listed already."""
+    if name.lower() not in (token.strip().lower() for token in headers.get("vary", "").split(",")):
+        headers.add_vary_header(name)
+
+
+class CompressionMiddleware:
+    """Compresses response bodies of at least `minimum_size` bytes with the
+    encoding negotiated from `Accept-Encoding`.
+
+    Responses already carrying a `Content-Encoding` (the catalog snapshot is
+    compressed once per version) and streamed ones are sent as they are.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        coding = choose_encoding(Headers(scope=scope).get("accept-encoding"))
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+        start = None
+
+        async def send_compressed(message) -> None:
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if start is None:  # the rest of a streamed body
+                await send(message)
+                return
+            headers = MutableHeaders(scope=start)
+            body = message.get("body", b"")
+            if is_compressible(headers.get("content-type")) and "content-encoding" not in headers:
+                vary_on(headers, "Accept-Encoding")
+                if not message.get("more_body") and len(body) >= self.minimum_size:
+                    body = compress(body, coding)
+                    headers["Content-Encoding"] = coding
+                    headers["Content-Length"] = str(len(body))
+                    message = {**message, "body": body}
+                start["headers"] = headers.raw
+            await send(start)
+            start = None
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
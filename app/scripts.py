@@ -0,0 +1,163 @@
+"""Lua scripts that run a multi-step change in one atomic round trip."""
+import hashlib
+from typing import Any, List, Sequence
+
+from aioredis.exceptions import NoScriptError
+
+
+class LuaScript:
+    """Script called by EVALSHA, falling back to EVAL when the server lacks it."""
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.sha = hashlib.sha1(source.encode("utf-8")).hexdigest()
+        SCRIPTS.append(self)
+
+    async def __call__(
+        self, client, keys: Sequence[Any] = (), args: Sequence[Any] = ()
+    ) -> Any:
+        try:
+            return await client.evalsha(self.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            return await client.eval(self.source, len(keys), *keys, *args)
+
+
+SCRIPTS: List[LuaScript] = []
+
+# KEYS: icecream ids
+# Converts the pre-sorted-set list of icecream ids into a sorted set scored by id.
+# Returns how many ids were moved, 0 when there was no list.
+MIGRATE_ICECREAM_IDS = LuaScript(
+    """
+if redis.call("TYPE", KEYS[1]).ok ~= "list" then
+    return 0
+end
+local ids = redis.call("LRANGE", KEYS[1], 0, -1)
+redis.call("DEL", KEYS[1])
+for _, id in ipairs(ids) do
+    redis.call("ZADD", KEYS[1], id, id)
+end
+return #ids
+"""
+)
+
+# KEYS: order id counter, user order ids list, global order ids list,
+#       sales quantity and revenue sorted sets, icecream price index,
+#       sales hour hash, sales hours set, optionally the order stream
+# ARGV: order encoded without its id (see app.serialization), stream MAXLEN (0 for none),
+#       sales hour, unix time it expires at (see RedisUtils.sales_hour_expiry),
+#       then icecream id and quantity per position
+# Returns {1, order id}, or {0, icecream id} when that icecream does not exist.
+# Single Redis only, it builds icecream and order keys of its own (see app.keys);
+# a cluster runs RedisUtils.store_order_in_slots instead.
+CREATE_ORDER = LuaScript(
+    """
+for i = 5, #ARGV, 2 do
+    if redis.call("EXISTS", "icecream:" .. ARGV[i]) == 0 then
+        return {0, tonumber(ARGV[i])}
+    end
+end
+local order_id = redis.call("INCR", KEYS[1])
+redis.call("HSET", "order:" .. order_id, "order", ARGV[1])
+redis.call("RPUSH", KEYS[2], order_id)
+redis.call("RPUSH", KEYS[3], order_id)
+local quantity, revenue = 0, 0
+for i = 5, #ARGV, 2 do
+    local price = tonumber(redis.call("ZSCORE", KEYS[6], ARGV[i])) or 0
+    local cents = math.floor(price * 100 + 0.5) * tonumber(ARGV[i + 1])
+    redis.call("ZINCRBY", KEYS[4], ARGV[i + 1], ARGV[i])
+    redis.call("ZINCRBY", KEYS[5], cents, ARGV[i])
+    quantity = quantity + tonumber(ARGV[i + 1])
+    revenue = revenue + cents
+end
+redis.call("HINCRBY", KEYS[7], "orders", 1)
+redis.call("HINCRBY", KEYS[7], "quantity", quantity)
+redis.call("HINCRBY", KEYS[7], "revenue_cents", revenue)
+redis.call("EXPIREAT", KEYS[7], ARGV[4])
+redis.call("SADD", KEYS[8], ARGV[3])
+if KEYS[9] then
+    if ARGV[2] == "0" then
+        redis.call("XADD", KEYS[9], "*", "id", order_id, "order", ARGV[1])
+    else
+        redis.call("XADD", KEYS[9], "MAXLEN", "~", ARGV[2], "*", "id", order_id, "order", ARGV[1])
+    end
+end
+return {1, order_id}
+"""
+)
+
+# KEYS: global order ids list, sales quantity and revenue sorted sets, sales hours set,
+#       then the sales hour hash of each hour in ARGV
+# ARGV: the members of the sales hours set
+# Drops every sales counter and returns how many orders exist, all at one instant,
+# so a backfill replays exactly the orders created before the counters were reset.
+# Returns -1, dropping nothing, when the sales hours set is no longer ARGV.
+RESET_SALES = LuaScript(
+    """
+if redis.call("SCARD", KEYS[4]) ~= #ARGV then
+    return -1
+end
+for _, hour in ipairs(ARGV) do
+    if redis.call("SISMEMBER", KEYS[4], hour) == 0 then
+        return -1
+    end
+end
+for i = 2, #KEYS do
+    redis.call("DEL", KEYS[i])
+end
+return redis.call("LLEN", KEYS[1])
+"""
+)
+
+# KEYS: user order ids list
+# ARGV: cursor (list index to read below) or "" for the newest orders, page size,
+#       order key prefix of the user (see KeyLayout.order_prefix)
+# Returns {next cursor, order id, order, ...} with orders newest first.
+# Single Redis only, a cluster runs RedisUtils.get_orders_page_in_slot instead.
+GET_ORDERS_PAGE = LuaScript(
+    """
+local stop = tonumber(ARGV[1]) or redis.call("LLEN", KEYS[1])
+local start = math.max(stop - tonumber(ARGV[2]), 0)
+local page = {start}
+if stop > start then
+    local ids = redis.call("LRANGE", KEYS[1], start, stop - 1)
+    for i = #ids, 1, -1 do
+        page[#page + 1] = ids[i]
+        page[#page + 1] = redis.call("HGET", ARGV[3] .. ids[i], "order")
+    end
+end
+return page
+"""
+)
+
+# KEYS: token bucket hashes
+# ARGV: refill rate (tokens per second) and capacity of each bucket, in KEYS order
+# Takes a token from every bucket, or from none when one of them is empty.
+# Returns 0, or the milliseconds until all of them have a token again.
+TAKE_TOKENS = LuaScript(
+    """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1]) / 1000
+    local burst = tonumber(ARGV[2 * i])
+    local state = redis.call("HMGET", key, "tokens", "ms")
+    local last = tonumber(state[2]) or now
+    tokens[i] = math.min(burst, (tonumber(state[1]) or burst) + math.max(0, now - last) * rate)
+    if tokens[i] < 1 then
+        wait = math.max(wait, math.ceil((1 - tokens[i]) / rate))
+    end
+end
+if wait > 0 then
+    return wait
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1]) / 1000
+    redis.call("HSET", key, "tokens", tostring(tokens[i] - 1), "ms", now)
+    redis.call("PEXPIRE", key, math.ceil(tonumber(ARGV[2 * i]) / rate))
+end
+return 0
+"""
+)
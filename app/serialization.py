@@ -0,0 +1,135 @@
+"""Storage encoding of the models kept in Redis.
+
+A stored value starts with one byte naming the schema version of the rest,
+a msgpack array of the model fields. Values starting with "{" are JSON,
+written before this module existed or with `STORAGE_FORMAT=json`, and are
+read the same way.
+"""
+import json
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Generic, List, Set, Type, TypeVar
+
+import msgpack
+from pydantic import BaseModel
+
+from .models import IceCream, Order, OrderPosition
+from .settings import STORAGE_FORMAT
+
+Model = TypeVar("Model", bound=BaseModel)
+
+JSON_PREFIX = ord("{")
+EPOCH = datetime(1970, 1, 1)
+
+
+class UnknownSchemaError(ValueError):
+    pass
+
+
+class Schema(Generic[Model]):
+    """One layout of a model, tagged by `version` (1-122, "{" is JSON)."""
+
+    def __init__(
+        self,
+        version: int,
+        to_row: Callable[[Model], List[Any]],
+        from_row: Callable[..., Model],
+    ) -> None:
+        self.version = version
+        self.to_row = to_row
+        self.from_row = from_row
+
+
+class Serializer(Generic[Model]):
+    """Writes `model` with the last of `schemas` and reads any of them.
+
+    Adding a field means appending a new schema, older ones stay readable.
+    `external` fields are not stored, the caller knows them from the key.
+    """
+
+    def __init__(
+        self,
+        model: Type[Model],
+        schemas: List[Schema[Model]],
+        storage_format: str,
+        external: Set[str] = frozenset(),
+    ) -> None:
+        self.model = model
+        self.external = external
+        self.schemas: Dict[int, Schema[Model]] = {
+            schema.version: schema for schema in schemas
+        }
+        self.current = schemas[-1]
+        self.storage_format = storage_format
+
+    def dumps(self, obj: Model) -> bytes:
+        if self.storage_format == "json":
+            return obj.json(exclude=self.external).encode("utf-8")
+        return bytes((self.current.version,)) + msgpack.packb(
+            self.current.to_row(obj), use_bin_type=True
+        )
+
+    def loads(self, raw: bytes, **known: Any) -> Model:
+        """Decode `raw`, taking the fields kept outside of it from `known`."""
+        if raw[0] == JSON_PREFIX:
+            return self.model.parse_obj({**json.loads(raw), **known})
+        schema = self.schemas.get(raw[0])
+        if schema is None:
+            raise UnknownSchemaError(f"{self.model.__name__} schema {raw[0]} is unknown")
+        return schema.from_row(msgpack.unpackb(raw[1:], raw=False), **known)
+
+
+def datetime_to_micros(value: datetime) -> int:
+    # Orders hold naive local times, keep them as they are.
+    return (value.replace(tzinfo=None) - EPOCH) // timedelta(microseconds=1)
+
+
+def micros_to_datetime(value: int) -> datetime:
+    return EPOCH + timedelta(microseconds=value)
+
+
+ORDER_SERIALIZER = Serializer(
+    Order,
+    [
+        Schema(
+            version=1,
+            to_row=lambda order: [
+                order.user_login,
+                datetime_to_micros(order.created_at),
+                [[position.icecream_id, position.quantity] for position in order.positions],
+            ],
+            from_row=lambda row, **known: Order(
+                **known,
+                user_login=row[0],
+                created_at=micros_to_datetime(row[1]),
+                positions=[
+                    OrderPosition(icecream_id=icecream_id, quantity=quantity)
+                    for icecream_id, quantity in row[2]
+                ],
+            ),
+        )
+    ],
+    STORAGE_FORMAT,
+    external={"id"},
+)
+
+ICECREAM_FIELDS = (
+    "id",
+    "name",
+    "price",
+    "weight",
+    "img_url",
+    "img_status",
+    "thumbnail_url",
+    "medium_url",
+)
+ICECREAM_SERIALIZER = Serializer(
+    IceCream,
+    [
+        Schema(
+            version=1,
+            to_row=lambda icecream: [getattr(icecream, field) for field in ICECREAM_FIELDS],
+            from_row=lambda row, **known: IceCream(**{**dict(zip(ICECREAM_FIELDS, row)), **known}),
+        )
+    ],
+    STORAGE_FORMAT,
+)
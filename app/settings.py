@@ -1,7 +1,10 @@
+import json
 import os
 
 import aioredis
 
+from .metrics import InstrumentedRedis
+
 FAVICON_PATH = "app/static/favicon.ico"
 MAIN_PAGE_RESPONSE = """
     ✨ Main page! ✨ <br>
@@ -13,5 +16,138 @@ WINDOWS_PLATFORM = False
 HOST = os.getenv("ICECREAMAPI_HOST", "localhost")
 SERVER_STATIC_PREFIX = f"http://{HOST}/static/"
 STATIC_FOLDER_PATH = "/root/icecreamapi-app/icecreamapi/static/"
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 4))
+IMAGE_QUEUE_SIZE = int(os.getenv("IMAGE_QUEUE_SIZE", 1000))
+IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", 10))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 5 * 1024 * 1024))
+# Content-addressed images, served by Caddy as immutable.
+IMAGES_FOLDER = "images/"
+# Variant name -> longest side in pixels, stored as `<variant>_url` of IceCream.
+IMAGE_VARIANTS = {"thumbnail": 160, "medium": 640}
+IMAGE_VARIANT_FORMAT = "WEBP"
 REDIS_CONNECTION_STRING = os.getenv("REDIS_URL", "redis://localhost")
-REDIS_CLIENT = aioredis.from_url(REDIS_CONNECTION_STRING)
+# Per process: a gunicorn server opens up to WEB_CONCURRENCY * REDIS_MAX_CONNECTIONS.
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 32))
+# Seconds a request waits for a free pooled connection before failing
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", 2))
+# Connections idle longer than this are PINGed before being reused
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
+# Connections opened by startup, so the first requests do not pay for them
+REDIS_WARM_CONNECTIONS = min(int(os.getenv("REDIS_WARM_CONNECTIONS", 4)), REDIS_MAX_CONNECTIONS)
+# Read replica of a single REDIS_URL serving catalog and order history reads, "" for none.
+# Not used with REDIS_CLUSTER.
+REDIS_REPLICA_URL = os.getenv("REDIS_REPLICA_URL", "")
+# Reads stay on the primary while the replica lags more than this many seconds. The lag
+# is measured by writing REPLICA_HEARTBEAT_KEY every REPLICA_CHECK_INTERVAL seconds.
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 2))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", 0.5))
+REPLICA_HEARTBEAT_KEY = "replica_heartbeat"
+# A user's reads stay on the primary this long after they created an order on a worker
+REPLICA_READ_YOUR_WRITES_SECONDS = float(os.getenv("REPLICA_READ_YOUR_WRITES_SECONDS", 5))
+REPLICA_RECENT_WRITERS_SIZE = int(os.getenv("REPLICA_RECENT_WRITERS_SIZE", 10000))
+# "1" for the hash-tagged key layout of a Redis Cluster reached through a proxy at
+# REDIS_URL, see app.keys and the README for what the proxy must support
+REDIS_CLUSTER = os.getenv("REDIS_CLUSTER", "") == "1"
+# Order ids a process reserves at once in cluster mode, see IdBlockAllocator (ORDER_IDS)
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", 100))
+
+
+def create_redis_client(url: str = REDIS_CONNECTION_STRING) -> InstrumentedRedis:
+    """A client whose pool connects on first use, see RedisUtils.connect."""
+    return InstrumentedRedis(
+        connection_pool=aioredis.BlockingConnectionPool.from_url(
+            url,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            timeout=REDIS_POOL_TIMEOUT,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_SOCKET_CONNECT_TIMEOUT,
+            socket_keepalive=True,
+            health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+            retry_on_timeout=True,
+        )
+    )
+
+
+# Seconds the image queue gets on shutdown to finish queued downloads
+IMAGE_QUEUE_DRAIN_TIMEOUT = float(os.getenv("IMAGE_QUEUE_DRAIN_TIMEOUT", 10))
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", 1024))
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", 30))
+CATALOG_INVALIDATION_CHANNEL = "icecream_changes"
+SESSION_TTL = int(os.getenv("SESSION_TTL", 7 * 24 * 60 * 60))
+# A token stays usable on a worker for up to this long after it expires in Redis.
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", 30))
+ORDERS_PAGE_LIMIT = int(os.getenv("ORDERS_PAGE_LIMIT", 20))
+ORDERS_PAGE_MAX_LIMIT = 100
+# Import key (see app.bulk_import) -> icecream id
+IMPORT_KEYS_HASH = "icecream_import_keys"
+# Every created order is also appended here for app.order_worker, "" turns it off
+ORDER_STREAM = os.getenv("ORDER_STREAM", "order_events")
+# Approximate cap on the stream length, 0 keeps everything
+ORDER_STREAM_MAXLEN = int(os.getenv("ORDER_STREAM_MAXLEN", 1_000_000))
+ORDER_WORKER_GROUP = "order_persistence"
+ORDER_WORKER_BATCH_SIZE = int(os.getenv("ORDER_WORKER_BATCH_SIZE", 100))
+ORDER_WORKER_BLOCK_MS = int(os.getenv("ORDER_WORKER_BLOCK_MS", 5000))
+# Entries unacknowledged this long are retried, and dead-lettered after MAX_DELIVERIES
+ORDER_WORKER_RETRY_IDLE_MS = int(os.getenv("ORDER_WORKER_RETRY_IDLE_MS", 60000))
+ORDER_WORKER_MAX_DELIVERIES = int(os.getenv("ORDER_WORKER_MAX_DELIVERIES", 5))
+ORDER_STORE_PATH = os.getenv("ORDER_STORE_PATH", "orders.sqlite3")
+# Sales counters kept by every created order, see RedisUtils.get_top_sellers and
+# RedisUtils.get_hourly_sales
+SALES_QUANTITY_KEY = "sales:quantity"
+SALES_REVENUE_KEY = "sales:revenue"
+# Hours (SALES_HOUR_FORMAT) that have a SALES_HOUR_PREFIX hash
+SALES_HOURS_KEY = "sales:hours"
+SALES_HOUR_PREFIX = "sales:hour:"
+SALES_HOUR_FORMAT = "%Y%m%d%H"
+SALES_HOUR_TTL = int(os.getenv("SALES_HOUR_TTL", 90 * 24 * 60 * 60))
+SALES_REPORT_MAX_HOURS = 31 * 24
+# "msgpack" or "json", how orders and icecreams are written, both are read
+STORAGE_FORMAT = os.getenv("STORAGE_FORMAT", "msgpack")
+# Search indexes kept up to date by RedisUtils, see RedisUtils.search_icecreams
+ICECREAM_SCORE_INDEXES = {"price": "icecream_idx:price", "weight": "icecream_idx:weight"}
+ICECREAM_NAME_INDEX = "icecream_idx:name"
+# Icecream id -> its current member of ICECREAM_NAME_INDEX
+ICECREAM_NAME_MEMBERS = "icecream_idx:name_members"
+# Largest batch accepted by the bulk icecream endpoints and by `?ids=`
+ICECREAM_BATCH_MAX_SIZE = int(os.getenv("ICECREAM_BATCH_MAX_SIZE", 1000))
+# Icecreams written per MULTI pipeline by bulk create/update
+BULK_WRITE_BATCH_SIZE = int(os.getenv("BULK_WRITE_BATCH_SIZE", 200))
+SEARCH_PAGE_LIMIT = int(os.getenv("SEARCH_PAGE_LIMIT", 20))
+SEARCH_PAGE_MAX_LIMIT = 100
+# Index entries loaded per round trip, and at most per request, by searches the
+# indexes cannot page alone, see RedisUtils.search_icecreams
+SEARCH_SCAN_BATCH_SIZE = int(os.getenv("SEARCH_SCAN_BATCH_SIZE", 200))
+SEARCH_SCAN_MAX_SIZE = int(os.getenv("SEARCH_SCAN_MAX_SIZE", 10000))
+# Smallest response body compressed, and the compression effort (see app.responses)
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", 4))
+# Admission control, see app.admission. Requests a worker serves at once:
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", 200))
+# Seconds a client shed for overload is told to wait
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 1))
+RATE_LIMIT_PREFIX = "ratelimit:"
+# Route group -> limits: the share of ADMISSION_MAX_IN_FLIGHT it may fill, lower
+# is shed first, and requests/s with bursts per user and for everyone (0 for none).
+# ADMISSION_LIMITS='{"orders": {"user_rate": 2}}' overrides single values.
+ADMISSION_LIMITS = {
+    "catalog": {"in_flight_share": 1.0},
+    "orders": {
+        "in_flight_share": 0.5,
+        "user_rate": 1,
+        "user_burst": 5,
+        "global_rate": 500,
+        "global_burst": 1000,
+    },
+    "auth": {"in_flight_share": 0.5, "user_rate": 0.2, "user_burst": 10},
+    "default": {"in_flight_share": 0.8},
+}
+for group, limits in json.loads(os.getenv("ADMISSION_LIMITS", "{}")).items():
+    ADMISSION_LIMITS.setdefault(group, {}).update(limits)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Logger name -> share of its INFO/DEBUG records that get written
+LOG_SAMPLE_RATES = {"icecreamapi.orders": float(os.getenv("ORDER_LOG_SAMPLE_RATE", 0.1))}
@@ -1,12 +1,28 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import MagicMock, patch
 
 import pytest
 
-from .data import ICECREAM_IDS, global_fake_redis
+from .data import ICECREAM_IDS, IMAGE_BYTES, global_fake_redis
+from ..cache import CATALOG_CACHE, SESSION_CACHE
 from ..models import IceCream
 from ..utils import RedisUtils
 
 
+@pytest.fixture(autouse=True)
+def clear_caches() -> None:
+    CATALOG_CACHE.clear()
+    SESSION_CACHE.clear()
+
+
+@pytest.fixture(autouse=True)
+def no_order_stream() -> None:
+    # fakeredis has no streams, see test_order_worker_persists_stream for a real Redis
+    with patch("app.utils.ORDER_STREAM", ""):
+        yield
+
+
 @pytest.fixture()
 async def one_icecream_fixture() -> IceCream:
     # @pytest.fixture must be most inner decorator to fixture to yield value, but not async_generator object.
@@ -33,7 +49,33 @@ async def one_icecream_fixture() -> IceCream:
 @pytest.mark.asyncio
 async def icecream_ids_fixture() -> None:
     print("SETUP:icecream_ids_fixture")
-    await global_fake_redis.rpush("icecream_ids", *ICECREAM_IDS)
+    await global_fake_redis.zadd("icecream_ids", {id_: id_ for id_ in ICECREAM_IDS})
     yield
     print("TEARDOWN:icecream_ids_fixture")
     await global_fake_redis.delete("icecream_ids")
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/ice.jpg":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(IMAGE_BYTES)))
+        self.end_headers()
+        self.wfile.write(IMAGE_BYTES)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def image_server() -> str:
+    """Local stand-in for remote image hosts, yields its base url."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
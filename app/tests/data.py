@@ -1,10 +1,17 @@
+from io import BytesIO
+
 import fakeredis.aioredis
 from fastapi.testclient import TestClient
+from PIL import Image
 
 from ..main import app
 
 ICECREAM_IDS = [1, 5, 6]
 
+IMAGE_BYTES = BytesIO()
+Image.new("RGB", (1280, 960), "pink").save(IMAGE_BYTES, "JPEG")
+IMAGE_BYTES = IMAGE_BYTES.getvalue()
+
 client = TestClient(app)
 
 global_fake_redis = fakeredis.aioredis.FakeRedis()
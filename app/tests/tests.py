@@ -1,11 +1,39 @@
-from unittest.mock import MagicMock, patch
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import aioredis
+import brotli
 import fakeredis.aioredis
+from fastapi.encoders import jsonable_encoder
+from fastapi.testclient import TestClient
 import pytest
+from PIL import Image
 
-from .data import ICECREAM_IDS, client, global_fake_redis
-from ..models import IceCream, Order, OrderPosition, UserIn
-from ..utils import RedisUtils
+from .data import ICECREAM_IDS, IMAGE_BYTES, client, global_fake_redis
+from ..admission import GROUP_LIMITS, AdmissionMiddleware, GroupLimits
+from ..bulk_import import import_file
+from .. import utils
+from ..cache import ALL_ICECREAMS_KEY, CATALOG_CACHE, CATALOG_SNAPSHOT_KEY, SESSION_CACHE, SingleFlight, TTLCache
+from ..keys import KeyLayout, crc16, key_slot
+from ..logs import REQUEST_ID, SampledLogger, setup_logging
+from ..main import create_app
+from ..metrics import REDIS_COMMAND_DURATION, Histogram, InstrumentedRedis
+from ..migrate_keys import migrate_keys
+from ..models import IMAGE_FAILED, IMAGE_PENDING, IMAGE_READY, IceCream, IceCreamSearch, Order, OrderPosition, UserIn
+from ..order_worker import OrderStore, OrderStreamWorker, decode_entry
+from ..replica import ReplicaMonitor
+from ..responses import ModelJSONResponse, choose_encoding
+from ..scripts import RESET_SALES, SCRIPTS
+from ..serialization import ICECREAM_SERIALIZER, ORDER_SERIALIZER, UnknownSchemaError
+from ..settings import REPLICA_HEARTBEAT_KEY, SALES_HOUR_FORMAT, SERVER_STATIC_PREFIX
+from ..utils import CacheUtils, IdBlockAllocator, ImageIngestionQueue, ImageUtils, RedisUtils
 
 
 @patch("app.utils.REDIS_CLIENT", global_fake_redis)
@@ -19,12 +47,98 @@ async def test_get_icecreams(one_icecream_fixture: IceCream):
     ).strip("[").strip("]")
 
 
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+@pytest.mark.asyncio
+async def test_get_icecreams_not_modified(one_icecream_fixture: IceCream):
+    etag = client.get("/api/icecream").headers["ETag"]
+    response = client.get("/api/icecream", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    await RedisUtils.update_icecream(one_icecream_fixture.copy(update={"price": 1}))
+    response = client.get("/api/icecream", headers={"If-None-Match": f"W/{etag}"})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_model_json_response_matches_fastapi_encoding():
+    order = Order(
+        id=1,
+        user_login="юзер",
+        created_at=datetime(2021, 11, 11, 11, 11, 11, 123456),
+        positions=[OrderPosition(icecream_id=1, quantity=2)],
+    )
+    icecream = IceCream(id=2, name="ice", price=15.89, weight=70)
+    content = {"orders": [order], "icecream": icecream}
+    assert json.loads(ModelJSONResponse(content).body) == jsonable_encoder(content)
+
+
+def test_choose_encoding_by_quality():
+    assert choose_encoding(None) is None
+    assert choose_encoding("gzip, deflate, br") == "br"
+    assert choose_encoding("gzip;q=1.0, br;q=0.5") == "gzip"
+    assert choose_encoding("br;q=0, *") == "gzip"
+    assert choose_encoding("identity, deflate") is None
+
+
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+@pytest.mark.asyncio
+async def test_responses_compressed_by_negotiation():
+    await RedisUtils.create_ice_creams(
+        [IceCream(name=f"ice cream {i}", price=i, weight=50, img_url=f"http://img/{i}.jpg") for i in range(1, 30)]
+    )
+    plain = client.get("/api/icecream/", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in plain.headers
+    # requests decodes the body itself, read the raw one
+    response = client.get("/api/icecream/", headers={"Accept-Encoding": "br"}, stream=True)
+    assert response.headers["Content-Encoding"] == "br"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"] == plain.headers["ETag"][:-1] + '-br"'
+    assert brotli.decompress(response.raw.read(decode_content=False)) == plain.content
+    response = client.get(
+        "/api/icecream/", headers={"Accept-Encoding": "br", "If-None-Match": response.headers["ETag"]}
+    )
+    assert response.status_code == 304
+    response = client.get("/api/icecream/", params={"limit": 25}, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(response.json()) == 25
+    response = client.get("/api/icecream/1", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers  # below COMPRESSION_MIN_SIZE
+    assert response.headers["Vary"] == "Accept-Encoding"
+    await global_fake_redis.flushall()
+    await RedisUtils.create_ice_cream(IceCream(name="small", price=1, weight=1))
+    response = client.get("/api/icecream/", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"  # the snapshot sets it too
+    await global_fake_redis.flushall()
+
+
 @patch("app.utils.REDIS_CLIENT", global_fake_redis)
 @pytest.mark.asyncio
 async def test_get_all_icecream_ids(icecream_ids_fixture: None):
     assert await RedisUtils.get_all_icecream_ids() == ICECREAM_IDS
 
 
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+async def test_migrate_icecream_ids_from_list():
+    await global_fake_redis.rpush("icecream_ids", 6, 1, 5, 1)
+    await RedisUtils.migrate_icecream_ids()
+    await RedisUtils.migrate_icecream_ids()
+    assert await global_fake_redis.type("icecream_ids") == b"zset"
+    assert await RedisUtils.get_all_icecream_ids() == [1, 5, 6]
+    assert await RedisUtils.get_icecream_count() == 3
+    await global_fake_redis.flushall()
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+async def test_get_all_ice_creams_skips_deleted(icecream_ids_fixture: None):
+    icecream = IceCream(id=5, name="only one left", price=1.5, weight=40, img_url="img.png")
+    await global_fake_redis.hset("icecream:5", mapping=RedisUtils.icecream_to_hash(icecream))
+    assert await RedisUtils.get_all_ice_creams() == [icecream]
+    await global_fake_redis.flushall()
+
+
 @pytest.mark.asyncio
 @patch("app.utils.REDIS_CLIENT", fakeredis.aioredis.FakeRedis())
 @patch(
@@ -83,11 +197,798 @@ async def test_user_has_valid_password():
 @patch("app.utils.REDIS_CLIENT", fakeredis.aioredis.FakeRedis())
 async def test_create_order():
     user_login = "user1"
+    await RedisUtils.create_ice_cream(IceCream(name="ice_cream_1", price=10, weight=10))
     position = OrderPosition(icecream_id=1, quantity=2)
     positions = [position]
     await RedisUtils.create_order(user_login, positions)
     assert await RedisUtils.get_user_orders_ids(user_login) == [1]
-    order: Order = (await RedisUtils.get_user_orders(user_login))[0]
+    order: Order = (await RedisUtils.get_user_orders(user_login)).orders[0]
     assert order.user_login == user_login
     assert order.id == 1
     assert order.positions[0] == position
+
+
+@pytest.mark.asyncio
+async def test_fetch_overtaken_by_invalidation_is_not_cached():
+    release = asyncio.Event()
+
+    async def old_catalog(primary=False):
+        await release.wait()
+        return [IceCream(id=1, name="old")]
+
+    async def old_icecream(id_, primary=False):
+        await release.wait()
+        return IceCream(id=id_, name="old")
+
+    with patch("app.utils.RedisUtils.get_all_ice_creams", old_catalog), patch(
+        "app.utils.RedisUtils.get_icecream_by_id", old_icecream
+    ):
+        reads = asyncio.gather(CacheUtils.get_catalog_snapshot(), CacheUtils.get_icecream_by_id(1))
+        await asyncio.sleep(0)
+        CacheUtils.invalidate_icecream(1)
+        release.set()
+        await reads
+        for key in (ALL_ICECREAMS_KEY, CATALOG_SNAPSHOT_KEY, 1):
+            assert CATALOG_CACHE.get(key) is None
+        await CacheUtils.get_catalog_snapshot()
+        await CacheUtils.get_icecream_by_id(1)
+        for key in (ALL_ICECREAMS_KEY, CATALOG_SNAPSHOT_KEY, 1):
+            assert CATALOG_CACHE.get(key) is not None
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", fakeredis.aioredis.FakeRedis())
+async def test_create_order_rejects_unknown_icecream():
+    icecream = await RedisUtils.create_ice_cream(IceCream(name="ice_cream_1", price=10, weight=10))
+    positions = [OrderPosition(icecream_id=icecream.id, quantity=1), OrderPosition(icecream_id=42, quantity=1)]
+    assert await RedisUtils.create_order("user1", positions) is None
+    assert await RedisUtils.get_user_orders_ids("user1") == []
+    assert await RedisUtils.create_order("user1", positions[:1]) is not None
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", fakeredis.aioredis.FakeRedis())
+async def test_order_positions_need_a_positive_quantity():
+    await RedisUtils.create_ice_cream(IceCream(name="ice_cream_1", price=10, weight=10))
+    headers = {"Authorization": f"Bearer {await RedisUtils.create_session('user1')}"}
+    for quantity in (0, -1):
+        with pytest.raises(ValueError):
+            OrderPosition(icecream_id=1, quantity=quantity)
+        body = [{"icecream_id": 1, "quantity": quantity}]
+        assert client.post("/api/order/new", json=body, headers=headers).status_code == 422
+    assert await RedisUtils.get_user_orders_ids("user1") == []
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+async def test_create_order_concurrently():
+    icecream = await RedisUtils.create_ice_cream(IceCream(name="ice_cream_1", price=10, weight=10))
+    logins = [f"user{i % 10}" for i in range(300)]
+    orders = await asyncio.gather(
+        *(RedisUtils.create_order(login, [OrderPosition(icecream_id=icecream.id, quantity=1)]) for login in logins)
+    )
+    assert sorted(order.id for order in orders) == list(range(1, 301))
+    assert sorted(int(id_) for id_ in await global_fake_redis.lrange("order_ids", 0, -1)) == list(range(1, 301))
+    for i in range(10):
+        user_ids = [int(id_) for id_ in await global_fake_redis.lrange(f"user:user{i}:orders", 0, -1)]
+        assert user_ids == sorted(order.id for order in orders if order.user_login == f"user{i}")
+    stored = ORDER_SERIALIZER.loads(
+        await global_fake_redis.hget(f"order:{orders[-1].id}", "order"), id=orders[-1].id
+    )
+    assert stored == orders[-1]
+    await global_fake_redis.flushall()
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+async def test_legacy_json_records_are_still_read():
+    legacy_order = Order(id=1, user_login="user1", created_at=datetime(2021, 11, 11), positions=[])
+    await global_fake_redis.hset("order:1", "order", legacy_order.json())
+    await global_fake_redis.rpush("user:user1:orders", 1)
+    await global_fake_redis.set("order_highest_id", 1)
+    legacy_icecream = IceCream(id=7, name="old", price=1.5, weight=40, img_url="img.png")
+    await global_fake_redis.hset("icecream:7", mapping=legacy_icecream.dict(exclude_none=True))
+    order = await RedisUtils.create_order("user1", [])
+    assert (await RedisUtils.get_user_orders("user1")).orders == [order, legacy_order]
+    assert await RedisUtils.get_icecream_by_id(7) == legacy_icecream
+    await global_fake_redis.flushall()
+
+
+def test_serializers_round_trip_and_reject_unknown_schemas():
+    order = Order(
+        id=3,
+        user_login="user1",
+        created_at=datetime(2021, 11, 11, 11, 11, 11, 5),
+        positions=[OrderPosition(icecream_id=1, quantity=2)],
+    )
+    raw = ORDER_SERIALIZER.dumps(order)
+    assert raw[0] == 1 and len(raw) < len(order.json()) / 2
+    assert ORDER_SERIALIZER.loads(raw, id=3) == order
+    icecream = IceCream(id=1, name="ice", price=2.5, weight=50, img_status=IMAGE_PENDING)
+    assert ICECREAM_SERIALIZER.loads(ICECREAM_SERIALIZER.dumps(icecream)) == icecream
+    with pytest.raises(UnknownSchemaError):
+        ICECREAM_SERIALIZER.loads(b"\x7f" + raw[1:])
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+async def test_get_user_orders_pages_newest_first():
+    icecream = await RedisUtils.create_ice_cream(IceCream(name="ice_cream_1", price=10, weight=10))
+    for _ in range(5):
+        await RedisUtils.create_order("user1", [OrderPosition(icecream_id=icecream.id, quantity=1)])
+    token = await RedisUtils.create_session("user1")
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 2} if cursor is None else {"limit": 2, "cursor": cursor}
+        response = client.get("/api/order/my", params=params, headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        pages.append([order["id"] for order in response.json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert pages == [[5, 4], [3, 2], [1]]
+    assert await RedisUtils.get_user_orders_ids("user1") == [1, 2, 3, 4, 5]
+    await global_fake_redis.flushall()
+
+
+def test_ttl_cache_evicts_least_recent_and_expired():
+    now = [0.0]
+    cache = TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+    cache.set(1, "one")
+    cache.set(2, "two")
+    assert cache.get(1) == "one"
+    cache.set(3, "three")
+    assert cache.get(2) is None
+    now[0] = 11
+    assert cache.get(1) is None
+    assert cache.stats() == {"size": 1, "maxsize": 2, "hits": 1, "misses": 2, "evictions": 2}
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+async def test_cache_utils_invalidated_by_update(one_icecream_fixture: IceCream):
+    assert await CacheUtils.get_icecream_by_id(one_icecream_fixture.id) == one_icecream_fixture
+    hits = CATALOG_CACHE.hits
+    assert await CacheUtils.get_icecream_by_id(one_icecream_fixture.id) == one_icecream_fixture
+    assert CATALOG_CACHE.hits == hits + 1
+    updated = one_icecream_fixture.copy(update={"price": 99})
+    await RedisUtils.update_icecream(updated)
+    assert await CacheUtils.get_icecream_by_id(one_icecream_fixture.id) == updated
+    assert await CacheUtils.get_all_ice_creams() == [updated]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_one_fetch():
+    single_flight = SingleFlight()
+    fetches = []
+
+    async def fetch():
+        fetches.append(1)
+        await asyncio.sleep(0.01)
+        return len(fetches)
+
+    first, second, other = await asyncio.gather(
+        single_flight.do(("icecream", 1), fetch),
+        single_flight.do(("icecream", 1), fetch),
+        single_flight.do(("icecream", 2), fetch),
+    )
+    assert first == second and len(fetches) == 2 and other in (1, 2)
+    assert await single_flight.do(("icecream", 1), fetch) == 3  # nothing in flight any more
+    assert single_flight.stats() == {
+        "in_flight": 0,
+        "calls": 4,
+        "coalesced": 1,
+        "by_kind": {"icecream": {"calls": 4, "coalesced": 1}},
+    }
+
+
+@pytest.mark.asyncio
+async def test_single_flight_survives_cancelled_caller_and_forget():
+    single_flight = SingleFlight()
+    release = asyncio.Event()
+
+    async def fetch():
+        await release.wait()
+        return "old"
+
+    leader = asyncio.create_task(single_flight.do(("orders", "user1", None), fetch))
+    follower = asyncio.create_task(single_flight.do(("orders", "user1", None), fetch))
+    await asyncio.sleep(0)
+    leader.cancel()
+    single_flight.forget("orders", "user1")
+    fresh = asyncio.create_task(single_flight.do(("orders", "user1", None), fetch))
+    await asyncio.sleep(0)
+    release.set()
+    assert await follower == "old"
+    assert await fresh == "old"
+    assert single_flight.stats()["coalesced"] == 1
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+async def test_cache_utils_coalesces_concurrent_misses(one_icecream_fixture: IceCream):
+    with patch.object(RedisUtils, "get_icecream_by_id", wraps=RedisUtils.get_icecream_by_id) as fetch:
+        icecreams = await asyncio.gather(
+            *(CacheUtils.get_icecream_by_id(one_icecream_fixture.id) for _ in range(10))
+        )
+    assert icecreams == [one_icecream_fixture] * 10
+    assert fetch.call_count == 1
+    response = client.get("/api/service/cache")
+    assert response.json()["single_flight"]["by_kind"]["icecream"]["coalesced"] >= 9
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+async def test_cache_listener_applies_remote_changes():
+    listener = asyncio.create_task(CacheUtils.listen_for_invalidations())
+    await asyncio.sleep(0.05)
+    CATALOG_CACHE.set(7, "stale")
+    await global_fake_redis.publish("icecream_changes", 7)
+    await asyncio.sleep(0.05)
+    listener.cancel()
+    assert CATALOG_CACHE.get(7) is None
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", fakeredis.aioredis.FakeRedis())
+async def test_image_ingested_in_background(image_server: str, tmp_path):
+    queue = ImageIngestionQueue(workers=2)
+    with patch("app.utils.IMAGE_QUEUE", queue), patch("app.utils.STATIC_FOLDER_PATH", f"{tmp_path}/"):
+        queue.start()
+        icecream = await RedisUtils.create_ice_cream(IceCream(name="ice", img_url=f"{image_server}/ice.jpg"))
+        same_image = await RedisUtils.create_ice_cream(IceCream(name="ice 2", img_url=f"{image_server}/ice.jpg"))
+        assert icecream.img_status == IMAGE_PENDING
+        await queue.join()
+        await queue.stop()
+    saved = await RedisUtils.get_icecream_by_id(icecream.id)
+    content_hash = hashlib.sha256(IMAGE_BYTES).hexdigest()
+    assert saved.img_status == IMAGE_READY
+    assert saved.img_url == f"{SERVER_STATIC_PREFIX}images/{content_hash}.jpg"
+    assert saved.thumbnail_url == ImageUtils.static_url(f"{content_hash}-160.webp")
+    assert saved.medium_url == ImageUtils.static_url(f"{content_hash}-640.webp")
+    assert (tmp_path / "images" / f"{content_hash}.jpg").read_bytes() == IMAGE_BYTES
+    with Image.open(tmp_path / "images" / f"{content_hash}-640.webp") as medium:
+        assert medium.format == "WEBP"
+        assert medium.size == (640, 480)
+    assert (await RedisUtils.get_icecream_by_id(same_image.id)).dict(exclude={"id", "name"}) == saved.dict(
+        exclude={"id", "name"}
+    )
+    assert len(list((tmp_path / "images").iterdir())) == 3
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", fakeredis.aioredis.FakeRedis())
+async def test_new_image_url_is_ingested_again():
+    queue = MagicMock(put=AsyncMock())
+    with patch("app.utils.IMAGE_QUEUE", queue):
+        icecream = await RedisUtils.create_ice_cream(IceCream(name="ice", img_url="http://1.2.3.4/old.jpg"))
+        await RedisUtils.set_icecream_image(
+            icecream.id,
+            "http://static/old.jpg",
+            IMAGE_READY,
+            "http://1.2.3.4/old.jpg",
+            {"thumbnail": "http://static/t.webp"},
+        )
+        queue.put.reset_mock()
+        response = client.put(f"/api/icecream/{icecream.id}", json={"price": 3, "img_status": IMAGE_FAILED})
+        assert response.json()["img_status"] == IMAGE_READY
+        queue.put.assert_not_called()
+        response = client.put(f"/api/icecream/{icecream.id}", json={"img_url": "http://1.2.3.4/new.jpg"})
+        assert response.json()["img_status"] == IMAGE_PENDING
+        assert response.json()["thumbnail_url"] is None
+        queue.put.assert_awaited_once_with(icecream.id, "http://1.2.3.4/new.jpg")
+        # A download of the old url finishing late does not overwrite the new one
+        assert not await RedisUtils.set_icecream_image(
+            icecream.id, "http://static/old.jpg", IMAGE_READY, "http://1.2.3.4/old.jpg"
+        )
+        assert (await RedisUtils.get_icecream_by_id(icecream.id)).img_status == IMAGE_PENDING
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", fakeredis.aioredis.FakeRedis())
+async def test_image_queue_drains_on_stop(image_server: str, tmp_path):
+    queue = ImageIngestionQueue(workers=2)
+    with patch("app.utils.IMAGE_QUEUE", queue), patch("app.utils.STATIC_FOLDER_PATH", f"{tmp_path}/"):
+        queue.start()
+        icecreams = [
+            await RedisUtils.create_ice_cream(IceCream(name="ice", img_url=f"{image_server}/ice.jpg")) for _ in range(3)
+        ]
+        await queue.stop(drain_timeout=10)
+    assert queue.ready == 3
+    for icecream in icecreams:
+        assert (await RedisUtils.get_icecream_by_id(icecream.id)).img_status == IMAGE_READY
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", fakeredis.aioredis.FakeRedis())
+@patch("app.utils.IMAGE_MAX_BYTES", 100)
+async def test_image_ingestion_rejects_large_images(image_server: str, tmp_path):
+    queue = ImageIngestionQueue(workers=1)
+    with patch("app.utils.IMAGE_QUEUE", queue), patch("app.utils.STATIC_FOLDER_PATH", f"{tmp_path}/"):
+        queue.start()
+        icecream = await RedisUtils.create_ice_cream(IceCream(name="ice", img_url=f"{image_server}/ice.jpg"))
+        missing = await RedisUtils.create_ice_cream(IceCream(name="ice", img_url=f"{image_server}/missing.jpg"))
+        await queue.join()
+        await queue.stop()
+    assert (await RedisUtils.get_icecream_by_id(icecream.id)).img_status == IMAGE_FAILED
+    assert (await RedisUtils.get_icecream_by_id(missing.id)).img_status == IMAGE_FAILED
+    assert list((tmp_path / "images").iterdir()) == []
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+async def test_login_token_authorizes_orders():
+    await RedisUtils.create_user(UserIn(login="user1", password="pass1"))
+    assert client.post("/api/user/login", auth=("user1", "wrong")).status_code == 401
+    response = client.post("/api/user/login", auth=("user1", "pass1"))
+    assert response.status_code == 200
+    token = response.json()["token"]
+    assert 0 < await global_fake_redis.ttl(f"token:{token}") <= 7 * 24 * 60 * 60
+    response = client.get("/api/order/my", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    assert SESSION_CACHE.get(token) == "user1"
+    response = client.get("/api/order/my", headers={"Authorization": "Bearer not-a-token"})
+    assert response.status_code == 401
+    await global_fake_redis.flushall()
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+@patch.dict(GROUP_LIMITS, {"orders": GroupLimits(user_rate=0.01, user_burst=2, global_rate=100, global_burst=100)})
+async def test_orders_rate_limited_per_user():
+    icecream = await RedisUtils.create_ice_cream(IceCream(name="ice_cream_1", price=10, weight=10))
+    body = [{"icecream_id": icecream.id, "quantity": 1}]
+    headers = {"Authorization": f"Bearer {await RedisUtils.create_session('user1')}"}
+    statuses = [client.post("/api/order/new", json=body, headers=headers).status_code for _ in range(3)]
+    assert statuses == [201, 201, 429]
+    response = client.post("/api/order/new", json=body, headers=headers)
+    assert response.status_code == 429
+    assert 0 < int(response.headers["Retry-After"]) <= 100
+    assert await RedisUtils.get_user_orders_ids("user1") == [1, 2]
+    headers = {"Authorization": f"Bearer {await RedisUtils.create_session('user2')}"}
+    assert client.post("/api/order/new", json=body, headers=headers).status_code == 201
+    assert client.get(f"/api/icecream/{icecream.id}").status_code == 200
+    await global_fake_redis.flushall()
+
+
+@pytest.mark.asyncio
+async def test_admission_sheds_orders_before_catalog_reads():
+    served = []
+
+    async def handler(scope, receive, send):
+        served.append(scope["path"])
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def request(method: str, path: str) -> dict:
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "headers": [], "app": client.app}
+        await middleware(scope, None, send)
+        return {"status": messages[0]["status"], **dict(messages[0]["headers"])}
+
+    middleware = AdmissionMiddleware(handler, max_in_flight=4)
+    middleware.in_flight = 2  # half full, the "orders" in-flight share
+    response = await request("POST", "/api/order/new")
+    assert response["status"] == 503 and response[b"retry-after"] == b"1"
+    assert (await request("GET", "/api/icecream/"))["status"] == 200
+    assert (await request("GET", "/api/icecream/7"))["status"] == 200
+    middleware.in_flight = 4
+    assert (await request("GET", "/api/icecream/"))["status"] == 503
+    assert (await request("GET", "/metrics"))["status"] == 200
+    assert served == ["/api/icecream/", "/api/icecream/7", "/metrics"]
+    assert middleware.in_flight == 4
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", fakeredis.aioredis.FakeRedis())
+async def test_bulk_import_is_idempotent(image_server: str, tmp_path):
+    records = [{"login": "user1", "password": "pass1"}] + [
+        {"name": f"ice {i}", "price": i, "weight": 50, "img_url": f"{image_server}/ice.jpg"} for i in range(1, 6)
+    ]
+    # Without a key or name it could not be matched on the next import
+    records.append({"price": 1, "weight": 50})
+    path = tmp_path / "catalog.jsonl"
+    path.write_text("\n".join(json.dumps(record) for record in records))
+    with patch("app.utils.STATIC_FOLDER_PATH", f"{tmp_path}/"):
+        await import_file(str(path), batch_size=2, image_workers=2)
+        records[1]["price"] = 100
+        path.write_text("\n".join(json.dumps(record) for record in records))
+        await import_file(str(path), batch_size=4, image_workers=2)
+    icecreams = await RedisUtils.get_all_ice_creams()
+    assert [icecream.name for icecream in icecreams] == [f"ice {i}" for i in range(1, 6)]
+    assert [icecream.id for icecream in icecreams] == [1, 2, 3, 4, 5]
+    assert icecreams[0].price == 100
+    assert {icecream.img_status for icecream in icecreams} == {IMAGE_READY}
+    assert await RedisUtils.user_has_valid_password(UserIn(login="user1", password="pass1"))
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+async def test_search_icecreams_uses_maintained_indexes():
+    for name, price, weight in [("Plombir", 30, 80), ("pistachio", 45, 70), ("Mango", 20, 90), ("Mint", 50, 60)]:
+        await RedisUtils.create_ice_cream(IceCream(name=name, price=price, weight=weight))
+    mango = await RedisUtils.get_icecream_by_id(3)
+    await RedisUtils.update_icecream(mango.copy(update={"name": "Pear", "price": 25}))
+    await RedisUtils.delete_icecream(4)
+
+    def names(**params):
+        response = client.get("/api/icecream/", params=params)
+        assert response.status_code == 200
+        assert "ETag" not in response.headers
+        return [icecream["name"] for icecream in response.json()]
+
+    assert names(name="p") == ["Plombir", "pistachio", "Pear"]
+    assert names(name="p", sort="name") == ["Pear", "pistachio", "Plombir"]
+    assert names(name="P", sort="-price", limit=2) == ["pistachio", "Plombir"]
+    assert names(name="m") == []
+    assert names(min_price=25, max_price=45, sort="price") == ["Pear", "Plombir", "pistachio"]
+    assert names(min_price=25, max_weight=80, sort="name") == ["pistachio", "Plombir"]
+    assert names(sort="-weight", offset=1) == ["Plombir", "pistachio"]
+    assert names(sort="-id", limit=1) == ["Pear"]
+    assert client.get("/api/icecream/", params={"sort": "color"}).status_code == 422
+    assert await global_fake_redis.hlen("icecream_idx:name_members") == 3
+
+    await global_fake_redis.delete("icecream_idx:name", "icecream_idx:name_members", "icecream_idx:price")
+    await RedisUtils.ensure_icecream_indexes()
+    assert names(name="pe", min_price=25) == ["Pear"]
+    with patch("app.utils.SEARCH_SCAN_BATCH_SIZE", 1):
+        assert names(min_price=25, max_weight=80, sort="-name") == ["Plombir", "pistachio"]
+        assert names(min_price=25, max_weight=75, sort="price", limit=1) == ["pistachio"]
+        with patch("app.utils.SEARCH_SCAN_MAX_SIZE", 2):
+            assert names(min_price=25, max_weight=80, sort="price", limit=1) == ["Plombir"]
+            response = client.get("/api/icecream/", params={"min_price": 25, "max_weight": 75, "sort": "price"})
+            assert response.status_code == 422
+    await global_fake_redis.flushall()
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+async def test_batch_create_update_and_multi_get():
+    response = client.post("/api/icecream/batch", json=[{"name": f"ice {i}", "price": i} for i in range(3)])
+    assert response.status_code == 201
+    assert [icecream["id"] for icecream in response.json()] == [1, 2, 3]
+    assert await global_fake_redis.get("icecream_highest_id") == b"3"
+    response = client.get("/api/icecream/", params={"ids": "3,1,99,3"})
+    assert [icecream["name"] for icecream in response.json()] == ["ice 2", "ice 0", "ice 2"]
+    assert client.get("/api/icecream/", params={"ids": "1,x"}).status_code == 422
+
+    response = client.put("/api/icecream/batch", json=[{"id": 2, "name": "beta"}, {"id": 2, "name": "gamma"}])
+    assert response.status_code == 422
+    response = client.put("/api/icecream/batch", json=[{"id": 1, "price": 5}, {"id": 99, "price": 5}])
+    assert response.status_code == 404
+    assert response.json() == {"detail": "icecreams not found: [99]"}
+    response = client.put("/api/icecream/batch", json=[{"id": 1, "price": 5}, {"id": 2, "name": "renamed"}])
+    assert response.status_code == 200
+    assert [(icecream["name"], icecream["price"]) for icecream in response.json()] == [("ice 0", 5), ("renamed", 1)]
+    assert [icecream.name for icecream in await CacheUtils.get_icecreams_by_ids([2])] == ["renamed"]
+    assert [icecream["id"] for icecream in client.get("/api/icecream/", params={"name": "ren"}).json()] == [2]
+    assert await global_fake_redis.zcard("icecream_idx:name") == 3
+    assert client.post("/api/icecream/batch", json=[]).status_code == 422
+    await global_fake_redis.flushall()
+
+
+@pytest.mark.asyncio
+@patch("app.utils.REDIS_CLIENT", global_fake_redis)
+async def test_sales_counters_and_backfill():
+    cheap = await RedisUtils.create_ice_cream(IceCream(name="cheap", price=1.1, weight=10))
+    dear = await RedisUtils.create_ice_cream(IceCream(name="dear", price=15.89, weight=10))
+    await RedisUtils.create_order("user1", [OrderPosition(icecream_id=cheap.id, quantity=5)])
+    await RedisUtils.create_order(
+        "user1", [OrderPosition(icecream_id=dear.id, quantity=2), OrderPosition(icecream_id=cheap.id, quantity=1)]
+    )
+    await RedisUtils.create_order("user1", [OrderPosition(icecream_id=42, quantity=1)])
+
+    def report(**params):
+        response = client.get("/api/analytics/sales", params=params)
+        assert response.status_code == 200
+        return response.json()
+
+    live = report()
+    assert live["top"] == [
+        {"icecream_id": cheap.id, "quantity": 6, "revenue": 6.6},
+        {"icecream_id": dear.id, "quantity": 2, "revenue": 31.78},
+    ]
+    assert [entry["icecream_id"] for entry in report(by="revenue", top=1)["top"]] == [dear.id]
+    assert len(live["hourly"]) == 24
+    assert [sum(hour[total] for hour in live["hourly"]) for total in ("orders", "quantity", "revenue")] == [2, 8, 38.38]
+    assert client.get("/api/analytics/sales", params={"since": "2021-01-01T00:00:00"}).status_code == 422
+    utc_since = (datetime.now().astimezone(timezone.utc) - timedelta(hours=23)).isoformat()
+    assert report(since=utc_since)["hourly"] == live["hourly"]
+    assert report(since=utc_since, until=datetime.now().astimezone().isoformat())["hourly"] == live["hourly"]
+    (hour,) = await global_fake_redis.smembers("sales:hours")
+    expiry = RedisUtils.sales_hour_expiry(datetime.strptime(hour.decode(), SALES_HOUR_FORMAT))
+    assert abs(await global_fake_redis.ttl(b"sales:hour:" + hour) - (expiry - time.time())) <= 1
+
+    # Counters are only dropped with every sales hour key declared
+    reset_keys = ["order_ids", "sales:quantity", "sales:revenue", "sales:hours"]
+    assert await RESET_SALES(global_fake_redis, keys=reset_keys, args=[]) == -1
+    assert report() == live
+    await global_fake_redis.zincrby("sales:quantity", 100, dear.id)
+    assert await RedisUtils.backfill_sales(batch_size=1) == 2
+    assert report() == live
+    assert abs(await global_fake_redis.ttl(b"sales:hour:" + hour) - (expiry - time.time())) <= 1
+    await global_fake_redis.flushall()
+
+
+@pytest.mark.asyncio
+async def test_reads_use_replica_unless_lagging_failing_or_just_written():
+    primary, replica_server = fakeredis.aioredis.FakeRedis(), fakeredis.FakeServer()
+    replica = fakeredis.aioredis.FakeRedis(server=replica_server)
+    monitor, now = ReplicaMonitor(max_lag=1), [0.0]
+    recent_writers = TTLCache(10, 5, timer=lambda: now[0])
+    with patch("app.utils.REDIS_CLIENT", primary), patch("app.utils.REDIS_REPLICA", replica), patch(
+        "app.utils.REPLICA_MONITOR", monitor
+    ), patch("app.utils.RECENT_WRITERS", recent_writers):
+        # The stand-ins do not replicate: the replica gets an older catalog and an order of ann
+        with patch("app.utils.REDIS_CLIENT", replica):
+            await RedisUtils.create_ice_cream(IceCream(name="old", price=1, weight=1))
+            ann_order = await RedisUtils.create_order("ann", [OrderPosition(icecream_id=1, quantity=1)])
+        recent_writers.clear()
+        await RedisUtils.create_ice_cream(IceCream(name="new", price=1, weight=1))
+        await RedisUtils.create_ice_cream(IceCream(name="newer", price=1, weight=1))
+
+        assert (await RedisUtils.get_icecream_by_id(1)).name == "new"  # lag not measured yet
+        await monitor.check(primary, replica)
+        await replica.set(REPLICA_HEARTBEAT_KEY, await primary.get(REPLICA_HEARTBEAT_KEY))
+        assert await monitor.check(primary, replica) < 1
+        assert (await RedisUtils.get_icecream_by_id(1)).name == "old"
+        assert (await RedisUtils.get_icecream_by_id(1, primary=True)).name == "new"
+        assert [icecream.name for icecream in await RedisUtils.get_all_ice_creams()] == ["old"]
+        assert await RedisUtils.get_icecream_count() == 1
+        assert (await RedisUtils.get_user_orders("ann")).orders == [ann_order]
+
+        bob_order = await RedisUtils.create_order("bob", [OrderPosition(icecream_id=1, quantity=1)])
+        assert (await RedisUtils.get_user_orders("bob")).orders == [bob_order]
+        now[0] += 6
+        assert (await RedisUtils.get_user_orders("bob")).orders == []
+
+        await replica.set(REPLICA_HEARTBEAT_KEY, 0)
+        assert await monitor.check(primary, replica) > 1
+        assert await RedisUtils.get_icecream_count() == 2
+
+        await replica.set(REPLICA_HEARTBEAT_KEY, await primary.get(REPLICA_HEARTBEAT_KEY))
+        await monitor.check(primary, replica)
+        replica_server.connected = False
+        assert await RedisUtils.get_icecream_count() == 2
+        assert not monitor.healthy
+
+
+@pytest.mark.asyncio
+async def test_catalog_refills_from_primary_after_invalidation():
+    primary, replica = fakeredis.aioredis.FakeRedis(), fakeredis.aioredis.FakeRedis()
+    monitor, now = ReplicaMonitor(max_lag=1), [0.0]
+    stale_keys = TTLCache(10, 1, timer=lambda: now[0])
+    with patch("app.utils.REDIS_CLIENT", primary), patch("app.utils.REDIS_REPLICA", replica), patch(
+        "app.utils.REPLICA_MONITOR", monitor
+    ), patch("app.utils.STALE_CATALOG_KEYS", stale_keys):
+        for redis in (primary, replica):
+            with patch("app.utils.REDIS_CLIENT", redis):
+                await RedisUtils.create_ice_cream(IceCream(name="old", price=1, weight=1))
+        await monitor.check(primary, replica)
+        await replica.set(REPLICA_HEARTBEAT_KEY, await primary.get(REPLICA_HEARTBEAT_KEY))
+        assert await monitor.check(primary, replica) < 1
+        now[0] += 6
+        assert (await CacheUtils.get_icecream_by_id(1)).name == "old"
+
+        # The stand-ins do not replicate, so the replica stays behind every change below
+        await RedisUtils.update_icecream(IceCream(id=1, name="new", price=1, weight=1))
+        assert (await RedisUtils.get_icecream_by_id(1)).name == "old"  # only refills use the primary
+        assert (await CacheUtils.get_icecream_by_id(1)).name == "new"
+        assert [icecream.name for icecream in await CacheUtils.get_all_ice_creams()] == ["new"]
+        CATALOG_CACHE.clear()
+        assert (await CacheUtils.get_icecream_by_id(1)).name == "old"  # refilled once already
+
+        # Changed by another worker, announced by the invalidation listener
+        await RedisUtils.update_icecream(IceCream(id=1, name="newer", price=1, weight=1))
+        CATALOG_CACHE.clear()
+        CacheUtils.invalidate_icecream(1)
+        assert b"newer" in (await CacheUtils.get_catalog_snapshot()).body
+
+        CacheUtils.invalidate_icecream(1)
+        now[0] += 2  # past REPLICA_MAX_LAG, the replica has the change by now
+        assert (await CacheUtils.get_icecream_by_id(1)).name == "old"
+    for redis in (primary, replica):
+        await redis.connection_pool.disconnect()
+
+
+def test_cluster_keys_share_slots_by_hash_tag():
+    assert crc16(b"123456789") == 0x31C3
+    assert key_slot("foo") == 12182
+    assert key_slot("{user1000}.following") == key_slot("{user1000}.followers")
+    assert key_slot("foo{}{bar}") == crc16(b"foo{}{bar}") % 16384
+    cluster = KeyLayout(cluster=True)
+    user_keys = [cluster.user("bob"), cluster.user_orders("bob"), cluster.order("bob", 7)]
+    catalog_keys = [cluster.icecream(1), cluster.icecream_ids, cluster.name_index, *cluster.score_indexes.values()]
+    sales_keys = [
+        cluster.order_ids, cluster.sales_hour("2021111111"), cluster.highest_id("order"), cluster.stream("order_events")
+    ]
+    rate_limit_keys = [cluster.rate_limit("orders", "user:bob"), cluster.rate_limit("orders")]
+    for keys in (user_keys, catalog_keys, sales_keys, rate_limit_keys):
+        assert len({key_slot(key) for key in keys}) == 1
+    assert KeyLayout().user_orders("bob") == "user:bob:orders" and KeyLayout().order("bob", 7) == "order:7"
+
+
+@pytest.mark.asyncio
+async def test_keys_migrated_to_cluster_layout():
+    redis = fakeredis.aioredis.FakeRedis()
+    with patch("app.utils.REDIS_CLIENT", redis):
+        cheap = await RedisUtils.create_ice_cream(IceCream(name="cheap", price=1.1, weight=10))
+        dear = await RedisUtils.create_ice_cream(IceCream(name="dear", price=15.89, weight=10))
+        await RedisUtils.create_user(UserIn(login="bob", password="secret"))
+        for login, icecream in (("bob", cheap), ("bob", dear), ("ann", cheap)):
+            await RedisUtils.create_order(login, [OrderPosition(icecream_id=icecream.id, quantity=2)])
+        token = await RedisUtils.create_session("bob")
+        catalog = await RedisUtils.get_all_ice_creams()
+        bob_orders = await RedisUtils.get_user_orders("bob")
+        top = await RedisUtils.get_top_sellers(10)
+
+        assert await migrate_keys(redis, batch_size=2) > 0
+        assert await migrate_keys(redis, batch_size=2) == 0
+        for key in await redis.keys():
+            assert b"{" in key or key.startswith(b"token:")
+
+        with patch("app.utils.KEYS", KeyLayout(cluster=True)), patch("app.utils.ORDER_IDS", IdBlockAllocator("order", 2)):
+            assert await RedisUtils.get_all_ice_creams() == catalog
+            assert await RedisUtils.get_user_orders("bob") == bob_orders
+            assert await RedisUtils.get_session_login(token) == "bob"
+            assert await RedisUtils.user_has_valid_password(UserIn(login="bob", password="secret"))
+            assert [icecream.id for icecream in await RedisUtils.search_icecreams(IceCreamSearch(name="de"))] == [dear.id]
+            assert await RedisUtils.backfill_sales(batch_size=2) == 3
+            assert await RedisUtils.get_top_sellers(10) == top
+
+            assert await RedisUtils.create_order("bob", [OrderPosition(icecream_id=42, quantity=1)]) is None
+            orders = [
+                await RedisUtils.create_order("bob", [OrderPosition(icecream_id=dear.id, quantity=1)]) for _ in range(3)
+            ]
+            assert [order.id for order in orders] == [4, 5, 6]
+            assert await redis.get("order_highest_id:{sales}") == b"7"
+            newest = await RedisUtils.get_user_orders("bob", limit=3)
+            assert newest.orders == orders[::-1]
+            assert await RedisUtils.get_user_orders("bob", cursor=newest.next_cursor, limit=3) == bob_orders
+            assert await redis.lrange("order_ids:{sales}", -1, -1) == [b"order:{bob}:6"]
+            top = await RedisUtils.get_top_sellers(10)
+            assert {sales.icecream_id: sales.quantity for sales in top} == {cheap.id: 4, dear.id: 5}
+            assert await RedisUtils.backfill_sales() == 6
+            assert await RedisUtils.connect_replica(fakeredis.aioredis.FakeRedis()) is None
+
+
+@pytest.mark.asyncio
+async def test_cluster_order_appended_to_stream():
+    redis = fakeredis.aioredis.FakeRedis()
+    # fakeredis has no XADD: record what the sales slot MULTI appends instead of sending it
+    with patch("app.utils.REDIS_CLIENT", redis), patch("app.utils.KEYS", KeyLayout(cluster=True)), patch(
+        "app.utils.ORDER_IDS", IdBlockAllocator("order", 2)
+    ), patch("app.utils.ORDER_STREAM", "order_events"), patch("app.utils.ORDER_STREAM_MAXLEN", 10), patch.object(
+        aioredis.client.Pipeline, "xadd", autospec=True, side_effect=lambda pipe, *args, **kwargs: pipe
+    ) as xadd:
+        icecream = await RedisUtils.create_ice_cream(IceCream(name="ice", price=10, weight=10))
+        order = await RedisUtils.create_order("bob", [OrderPosition(icecream_id=icecream.id, quantity=1)])
+        assert await redis.lrange("order_ids:{sales}", 0, -1) == [b"order:{bob}:1"]
+    (_, stream, fields), options = xadd.call_args
+    assert stream == "order_events:{sales}"
+    assert fields["id"] == order.id
+    assert ORDER_SERIALIZER.loads(fields["order"], id=order.id) == order
+    assert options == {"maxlen": 10}
+
+
+def test_order_store_upserts_by_id(tmp_path):
+    store = OrderStore(str(tmp_path / "orders.sqlite3"))
+    order = Order(
+        id=1, user_login="user1", created_at=datetime(2021, 11, 11), positions=[OrderPosition(icecream_id=1, quantity=2)]
+    )
+    entry = {b"id": b"1", b"order": ORDER_SERIALIZER.dumps(order)}
+    store.save([decode_entry(entry), decode_entry(entry)])
+    store.save([order.copy(update={"user_login": "user2"})])
+    assert store.count() == 1
+    assert store.connection.execute("SELECT user_login, positions FROM orders").fetchone() == (
+        "user2",
+        '[{"icecream_id": 1, "quantity": 2}]',
+    )
+    store.close()
+
+
+@pytest.mark.skipif(not os.getenv("TEST_REDIS_URL"), reason="needs a real Redis in TEST_REDIS_URL, will be flushed")
+@pytest.mark.asyncio
+async def test_order_worker_persists_stream(tmp_path):
+    redis = InstrumentedRedis.from_url(os.environ["TEST_REDIS_URL"])
+    await redis.flushall()
+    store = OrderStore(str(tmp_path / "orders.sqlite3"))
+    worker = OrderStreamWorker(redis, store, "test", block_ms=10, retry_idle_ms=0, max_deliveries=2)
+    with patch("app.utils.REDIS_CLIENT", redis), patch("app.utils.ORDER_STREAM", worker.stream):
+        await worker.ensure_group()
+        icecream = await RedisUtils.create_ice_cream(IceCream(name="ice", price=10, weight=10))
+        orders = [
+            await RedisUtils.create_order("user1", [OrderPosition(icecream_id=icecream.id, quantity=1)]) for _ in range(3)
+        ]
+        await redis.xadd(worker.stream, {"id": 4, "order": b"\x7fbroken"})
+        with patch.object(store, "save", side_effect=sqlite3.OperationalError("locked")):
+            assert await worker.run_once() == 0
+        assert await worker.run_once() == 4
+        assert await worker.run_once() == 0
+    assert store.count() == 3
+    assert worker.persisted == 3
+    assert (await redis.xpending(worker.stream, worker.group))["pending"] == 0
+    dead = await redis.xrange(f"{worker.stream}:dead")
+    assert [fields[b"reason"] for _, fields in dead] == [b"undecodable"]
+    assert store.connection.execute("SELECT MAX(id) FROM orders").fetchone()[0] == orders[-1].id
+    store.close()
+    await redis.flushall()
+    await redis.connection_pool.disconnect()
+
+
+def test_metrics_record_route_templates():
+    client.get("/api/icecream/not-a-number")
+    body = client.get("/metrics").text
+    assert 'http_requests_total{method="GET",route="/api/icecream/{item_id}",status="422"}' in body
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/icecream/{item_id}"}' in body
+    assert "http_requests_in_flight 1" in body  # the /metrics request itself
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("test_seconds", "Test.", ["kind"], buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, "a")
+    assert histogram.samples() == [
+        'test_seconds_bucket{kind="a",le="0.1"} 1',
+        'test_seconds_bucket{kind="a",le="1"} 2',
+        'test_seconds_bucket{kind="a",le="+Inf"} 3',
+        'test_seconds_sum{kind="a"} 5.55',
+        'test_seconds_count{kind="a"} 3',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_instrumented_redis_times_commands_and_pipelines():
+    redis = InstrumentedRedis(connection_pool=fakeredis.aioredis.FakeRedis().connection_pool)
+    await redis.hset("icecream:1", "name", "ice")
+    async with redis.pipeline() as pipe:
+        assert await pipe.hget("icecream:1", "name").hgetall("icecream:1").execute() == [b"ice", {b"name": b"ice"}]
+    assert ("HSET",) in REDIS_COMMAND_DURATION.values
+    assert ("PIPELINE",) in REDIS_COMMAND_DURATION.values
+    await redis.connection_pool.disconnect()
+
+
+def test_structured_logging_is_sampled_and_correlated(capsys):
+    listener = setup_logging(level="INFO", log_format="json", sample_rates={"icecreamapi.orders": 0})
+    try:
+        token = REQUEST_ID.set("req-1")
+        logging.getLogger("icecreamapi.redis").debug("not formatted at all")
+        logging.getLogger("icecreamapi.redis").info("icecream created", extra={"icecream_id": 7})
+        SampledLogger("icecreamapi.orders").info("order created", extra={"order_id": 1})
+        SampledLogger("icecreamapi.orders").warning("order rejected")
+        REQUEST_ID.reset(token)
+    finally:
+        listener.stop()
+        logger = logging.getLogger("icecreamapi")
+        logger.handlers, logger.propagate = [], True
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [line["message"] for line in lines] == ["icecream created", "order rejected"]
+    assert lines[0]["icecream_id"] == 7
+    assert {line["request_id"] for line in lines} == {"req-1"}
+
+
+def test_request_id_header():
+    assert client.get("/metrics", headers={"X-Request-ID": "abc"}).headers["X-Request-ID"] == "abc"
+    assert len(client.get("/metrics").headers["X-Request-ID"]) == 32
+
+
+@patch("app.main.IMAGE_QUEUE", ImageIngestionQueue())
+def test_app_ready_only_after_warm_up():
+    fake_redis = fakeredis.aioredis.FakeRedis()
+    app = create_app(fake_redis)
+    cold = TestClient(app)
+    assert cold.get("/health/live").json() == {"status": "alive"}
+    assert cold.get("/health/ready").status_code == 503
+    with TestClient(app) as warm:
+        assert warm.get("/health/ready").json() == {"status": "ready"}
+        assert utils.REDIS_CLIENT is fake_redis
+        assert CATALOG_CACHE.get(CATALOG_SNAPSHOT_KEY) is not None
+        assert 'startup_seconds{phase="ready"}' in warm.get("/metrics").text
+    assert utils.REDIS_CLIENT is None
+    assert cold.get("/health/ready").status_code == 503
+    loaded = asyncio.run(fake_redis.script_exists(*(script.sha for script in SCRIPTS)))
+    assert loaded == [True] * len(SCRIPTS)
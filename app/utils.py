@@ -1,13 +1,102 @@
+import asyncio
 import hashlib
+import logging
+import math
 import os
-import random
-from datetime import datetime
-from typing import List, Optional
+import secrets
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Tuple, TypeVar
+from urllib.parse import urlparse
 
-import requests
+import aioredis
+import httpx
+from PIL import Image
 
-from .models import IceCream, Order, OrderPosition, UserIn, UserOut
-from .settings import REDIS_CLIENT, SERVER_STATIC_PREFIX, STATIC_FOLDER_PATH
+from .cache import (
+    ALL_ICECREAMS_KEY,
+    CATALOG_CACHE,
+    CATALOG_SNAPSHOT_KEY,
+    SESSION_CACHE,
+    SINGLE_FLIGHT,
+    CatalogSnapshot,
+    TTLCache,
+)
+from .keys import KEYS
+from .logs import SampledLogger
+from .metrics import REPLICA_READS
+from .models import (
+    IMAGE_FAILED,
+    IMAGE_PENDING,
+    IMAGE_READY,
+    IMAGE_STATE_FIELDS,
+    HourlySales,
+    IceCream,
+    IceCreamSales,
+    IceCreamSearch,
+    IceCreamSort,
+    Order,
+    OrderPosition,
+    OrdersPage,
+    UserIn,
+    UserOut,
+)
+from .replica import ReplicaMonitor
+from .scripts import (
+    CREATE_ORDER,
+    GET_ORDERS_PAGE,
+    MIGRATE_ICECREAM_IDS,
+    RESET_SALES,
+    SCRIPTS,
+    TAKE_TOKENS,
+)
+from .serialization import ICECREAM_SERIALIZER, ORDER_SERIALIZER
+from .settings import (
+    BULK_WRITE_BATCH_SIZE,
+    CATALOG_CACHE_SIZE,
+    CATALOG_INVALIDATION_CHANNEL,
+    ICECREAM_SCORE_INDEXES,
+    ID_BLOCK_SIZE,
+    IMAGE_DOWNLOAD_TIMEOUT,
+    IMAGE_MAX_BYTES,
+    IMAGE_QUEUE_SIZE,
+    IMAGE_VARIANT_FORMAT,
+    IMAGE_VARIANTS,
+    IMAGE_WORKERS,
+    IMAGES_FOLDER,
+    ORDER_STREAM,
+    ORDER_STREAM_MAXLEN,
+    ORDERS_PAGE_LIMIT,
+    REDIS_REPLICA_URL,
+    REDIS_WARM_CONNECTIONS,
+    REPLICA_MAX_LAG,
+    REPLICA_READ_YOUR_WRITES_SECONDS,
+    REPLICA_RECENT_WRITERS_SIZE,
+    SALES_HOUR_FORMAT,
+    SALES_HOUR_TTL,
+    SEARCH_PAGE_LIMIT,
+    SEARCH_SCAN_BATCH_SIZE,
+    SEARCH_SCAN_MAX_SIZE,
+    SERVER_STATIC_PREFIX,
+    SESSION_TTL,
+    STATIC_FOLDER_PATH,
+    create_redis_client,
+)
+
+logger = logging.getLogger("icecreamapi.redis")
+order_logger = SampledLogger("icecreamapi.orders")
+# Set by RedisUtils.connect
+REDIS_CLIENT: Optional[aioredis.Redis] = None
+# Set by RedisUtils.connect_replica when there is one, see RedisUtils.read
+REDIS_REPLICA: Optional[aioredis.Redis] = None
+REPLICA_MONITOR = ReplicaMonitor()
+# Users who created an order lately, whose reads go to the primary
+RECENT_WRITERS = TTLCache(REPLICA_RECENT_WRITERS_SIZE, REPLICA_READ_YOUR_WRITES_SECONDS)
+# CATALOG_CACHE keys invalidated lately, refilled from the primary: a replica within
+# REPLICA_MAX_LAG may not have the change yet, see CacheUtils.stale
+STALE_CATALOG_KEYS = TTLCache(CATALOG_CACHE_SIZE, REPLICA_MAX_LAG)
+T = TypeVar("T")
 
 
 class HashUtils:  # pragma: no cover
@@ -18,129 +107,1302 @@ class HashUtils:  # pragma: no cover
         return hash.digest()
 
     @staticmethod
-    def gen_user_token() -> int:
-        return random.randint(1000000000, 2000000000)
+    def gen_user_token() -> str:
+        return secrets.token_urlsafe(32)
+
+
+class ImageTooLargeError(Exception):
+    pass
+
+
+class SearchTooBroadError(Exception):
+    pass
 
 
 class ImageUtils:
     @staticmethod
-    def save_icecream_image_to_static(image_url: str, id: int) -> str:
-        image = requests.get(image_url)
-        file_extension = os.path.splitext(image_url)[-1]
+    def static_url(file_name: str) -> str:
+        return f"{SERVER_STATIC_PREFIX}{IMAGES_FOLDER}{file_name}"
+
+    @staticmethod
+    async def save_icecream_image_to_static(
+        image_url: str, id: int, client: httpx.AsyncClient
+    ) -> str:
+        """Stream the image to the static folder without blocking the event loop.
+
+        The file is named after the SHA-256 of its content, so the same image
+        is stored once however many icecreams use it. Returns the file name.
+        """
+        file_extension = os.path.splitext(urlparse(image_url).path)[-1]
         if not file_extension:
             file_extension = ".jpg"
-        file_name = f"icecream_{id}{file_extension}"
-        file_path = f"{STATIC_FOLDER_PATH}icecream_{id}{file_extension}"
-        with open(file_path, "wb") as file:
-            file.write(image.content)
-        print(f"SAVED {image_url} to {file_path}")
-        return f"{SERVER_STATIC_PREFIX}{file_name}"
+        folder = f"{STATIC_FOLDER_PATH}{IMAGES_FOLDER}"
+        os.makedirs(folder, exist_ok=True)
+        part_path = f"{folder}icecream_{id}.part"
+        content_hash = hashlib.sha256()
+        try:
+            async with client.stream("GET", image_url) as response:
+                response.raise_for_status()
+                if int(response.headers.get("content-length", 0)) > IMAGE_MAX_BYTES:
+                    raise ImageTooLargeError(image_url)
+                size = 0
+                with open(part_path, "wb") as file:
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > IMAGE_MAX_BYTES:
+                            raise ImageTooLargeError(image_url)
+                        content_hash.update(chunk)
+                        await asyncio.to_thread(file.write, chunk)
+            file_name = f"{content_hash.hexdigest()}{file_extension.lower()}"
+            if not os.path.exists(f"{folder}{file_name}"):
+                os.replace(part_path, f"{folder}{file_name}")
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        logger.debug("image saved", extra={"image_url": image_url, "file_name": file_name})
+        return file_name
+
+    @staticmethod
+    def make_image_variants(file_name: str) -> Dict[str, str]:
+        """Render resized copies of a saved image, returns file names by variant.
+
+        Variant names are derived from the original's content hash and the
+        size, so an already rendered variant is never rendered again.
+        CPU-bound, run it in a thread.
+        """
+        folder = f"{STATIC_FOLDER_PATH}{IMAGES_FOLDER}"
+        content_hash = os.path.splitext(file_name)[0]
+        variants = {}
+        with Image.open(f"{folder}{file_name}") as original:
+            for variant, size in IMAGE_VARIANTS.items():
+                variant_name = f"{content_hash}-{size}.{IMAGE_VARIANT_FORMAT.lower()}"
+                variants[variant] = variant_name
+                if os.path.exists(f"{folder}{variant_name}"):
+                    continue
+                image = original.copy()
+                image.thumbnail((size, size))
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+                part_path = f"{folder}{variant_name}.{uuid.uuid4().hex}.part"
+                image.save(part_path, IMAGE_VARIANT_FORMAT, quality=80)
+                os.replace(part_path, f"{folder}{variant_name}")
+        return variants
+
+    @staticmethod
+    async def ingest_icecream_image(
+        icecream_id: int, image_url: str, client: httpx.AsyncClient
+    ) -> bool:
+        try:
+            file_name = await asyncio.wait_for(
+                ImageUtils.save_icecream_image_to_static(image_url, icecream_id, client),
+                IMAGE_DOWNLOAD_TIMEOUT,
+            )
+            variants = await asyncio.to_thread(ImageUtils.make_image_variants, file_name)
+        except (
+            httpx.HTTPError,
+            asyncio.TimeoutError,
+            ImageTooLargeError,
+            Image.DecompressionBombError,
+            OSError,  # includes images Pillow cannot identify
+        ) as e:
+            logger.warning(
+                "image ingestion failed",
+                extra={"icecream_id": icecream_id, "image_url": image_url, "error": repr(e)},
+            )
+            await RedisUtils.set_icecream_image(icecream_id, image_url, IMAGE_FAILED, image_url)
+            return False
+        await RedisUtils.set_icecream_image(
+            icecream_id,
+            ImageUtils.static_url(file_name),
+            IMAGE_READY,
+            image_url,
+            {variant: ImageUtils.static_url(name) for variant, name in variants.items()},
+        )
+        return True
+
+
+class ImageIngestionQueue:
+    """Bounded queue of image downloads processed by a few background workers."""
+
+    def __init__(self, workers: int = IMAGE_WORKERS, maxsize: int = IMAGE_QUEUE_SIZE):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.ready = 0
+        self.failed = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.maxsize)
+        return self._queue
+
+    async def put(self, icecream_id: int, image_url: str) -> None:
+        await self.queue.put((icecream_id, image_url))
+
+    def start(self) -> None:
+        self._client = httpx.AsyncClient(
+            timeout=IMAGE_DOWNLOAD_TIMEOUT, follow_redirects=True
+        )
+        self._tasks = [
+            asyncio.create_task(self._work()) for _ in range(self.workers)
+        ]
+
+    async def join(self) -> None:
+        await self.queue.join()
+
+    async def stop(self, drain_timeout: float = 0) -> None:
+        """Stop the workers, first giving queued images `drain_timeout` seconds to finish."""
+        if self._tasks and drain_timeout > 0:
+            try:
+                await asyncio.wait_for(self.join(), drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    "image queue not drained", extra={"left": self.queue.qsize()}
+                )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _work(self) -> None:
+        while True:
+            icecream_id, image_url = await self.queue.get()
+            try:
+                if await ImageUtils.ingest_icecream_image(
+                    icecream_id, image_url, self._client
+                ):
+                    self.ready += 1
+                else:
+                    self.failed += 1
+            except Exception:  # keep the worker alive, e.g. when Redis blinks
+                self.failed += 1
+                logger.exception(
+                    "image ingestion crashed", extra={"icecream_id": icecream_id}
+                )
+            finally:
+                self.queue.task_done()
+
+
+IMAGE_QUEUE = ImageIngestionQueue()
+
+
+class IdBlockAllocator:
+    """Ids handed out from blocks of `block_size` reserved with one INCRBY,
+    so a process only touches the shared counter once per block.
+
+    Ids stay unique but are only roughly in creation order across
+    processes, and the rest of a block is skipped when the process exits.
+    """
+
+    def __init__(self, object_name: str, block_size: int = ID_BLOCK_SIZE) -> None:
+        self.object_name = object_name
+        self.block_size = block_size
+        self._next = self._stop = 0
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def next(self) -> int:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._next == self._stop:
+                ids = await RedisUtils.allocate_object_ids(self.object_name, self.block_size)
+                self._next, self._stop = ids[0], ids[-1] + 1
+            self._next += 1
+            return self._next - 1
+
+
+# Order ids in cluster mode, see RedisUtils.store_order_in_slots
+ORDER_IDS = IdBlockAllocator("order")
 
 
 class RedisUtils:
     @staticmethod
-    async def get_new_object_id(object_name: str) -> int:
-        id = await REDIS_CLIENT.incr(f"{object_name}_highest_id")
-        print(f"INFO: New {object_name} id: {id}")
-        return id
+    async def connect(
+        client: Optional[aioredis.Redis] = None, warm_connections: int = REDIS_WARM_CONNECTIONS
+    ) -> aioredis.Redis:
+        """Use `client`, a new pool by default, and open `warm_connections` now.
+
+        Raises if Redis is unreachable, rather than failing the first requests.
+        """
+        global REDIS_CLIENT
+        REDIS_CLIENT = client or create_redis_client()
+        await RedisUtils.open_connections(REDIS_CLIENT, warm_connections)
+        logger.info("redis connected", extra={"connections": max(warm_connections, 1)})
+        return REDIS_CLIENT
 
     @staticmethod
-    async def get_icecream_by_id(id_: int) -> Optional[IceCream]:
-        ice_dict: dict = await REDIS_CLIENT.hgetall(f"icecream:{id_}")
+    async def connect_replica(
+        client: Optional[aioredis.Redis] = None, warm_connections: int = REDIS_WARM_CONNECTIONS
+    ) -> Optional[aioredis.Redis]:
+        """Use `client`, or a new pool to `REDIS_REPLICA_URL` if set, for reads.
+
+        An unreachable replica is only logged, reads then use the primary.
+        A cluster gets none: its reads stay on the masters.
+        """
+        global REDIS_REPLICA
+        if client is None and not REDIS_REPLICA_URL:
+            return None
+        if KEYS.cluster:
+            logger.warning("read replica not used with REDIS_CLUSTER")
+            return None
+        REDIS_REPLICA = client or create_redis_client(REDIS_REPLICA_URL)
+        try:
+            await RedisUtils.open_connections(REDIS_REPLICA, warm_connections)
+        except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+            REPLICA_MONITOR.mark_down(e)
+            logger.warning("replica unavailable", extra={"error": repr(e)})
+        else:
+            logger.info("redis replica connected", extra={"connections": max(warm_connections, 1)})
+        return REDIS_REPLICA
+
+    @staticmethod
+    async def open_connections(client: aioredis.Redis, count: int) -> None:
+        pool = client.connection_pool
+        connections = [await pool.get_connection("PING") for _ in range(max(count, 1))]
+        try:
+            for connection in connections:
+                await connection.send_command("PING")
+                await connection.read_response()
+        finally:
+            for connection in connections:
+                await pool.release(connection)
+
+    @staticmethod
+    async def disconnect() -> None:
+        global REDIS_CLIENT, REDIS_REPLICA
+        if REDIS_REPLICA is not None:
+            await REDIS_REPLICA.close()
+            await REDIS_REPLICA.connection_pool.disconnect()
+            REDIS_REPLICA = None
+        if REDIS_CLIENT is not None:
+            await REDIS_CLIENT.close()
+            await REDIS_CLIENT.connection_pool.disconnect()
+            REDIS_CLIENT = None
+            logger.info("redis connection closed")
+
+    @staticmethod
+    async def monitor_replica() -> None:
+        """Check the replica's lag every `REPLICA_CHECK_INTERVAL` seconds. Runs until cancelled."""
+        while True:
+            try:
+                await REPLICA_MONITOR.check(REDIS_CLIENT, REDIS_REPLICA)
+            except aioredis.RedisError as e:  # the primary failed
+                logger.warning("replica check failed", extra={"error": repr(e)})
+            await asyncio.sleep(REPLICA_MONITOR.interval)
+
+    @staticmethod
+    async def read(
+        fetch: Callable[[aioredis.Redis], Awaitable[T]], user_login: Optional[str] = None
+    ) -> T:
+        """`fetch` from the replica, unless it lags more than `REPLICA_MAX_LAG`,
+        fails, or `user_login` created an order in the last
+        `REPLICA_READ_YOUR_WRITES_SECONDS`; then from the primary.
+        """
+        if REDIS_REPLICA is None:
+            return await fetch(REDIS_CLIENT)
+        if not REPLICA_MONITOR.healthy:
+            route = "lagging"
+        elif user_login is not None and RECENT_WRITERS.get(user_login) is not None:
+            route = "recent_write"
+        else:
+            try:
+                result = await fetch(REDIS_REPLICA)
+            except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+                REPLICA_MONITOR.mark_down(e)
+                route = "replica_failed"
+            else:
+                REPLICA_READS.inc("replica")
+                return result
+        REPLICA_READS.inc(route)
+        return await fetch(REDIS_CLIENT)
+
+    @staticmethod
+    def wrote(user_login: str) -> None:
+        """Read `user_login`'s data from the primary on this worker for a while,
+        so they see what they just wrote. Other workers read the replica and
+        may miss it until it replicates.
+        """
+        if REDIS_REPLICA is not None:
+            RECENT_WRITERS.set(user_login, True)
+
+    @staticmethod
+    async def load_scripts() -> None:
+        """SCRIPT LOAD every Lua script, so no call falls back to sending its source."""
+        async with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            for script in SCRIPTS:
+                pipe.script_load(script.source)
+            await pipe.execute()
+
+    @staticmethod
+    async def allocate_object_ids(object_name: str, count: int) -> List[int]:
+        """Reserve `count` consecutive ids with one INCRBY."""
+        last_id = await REDIS_CLIENT.incrby(KEYS.highest_id(object_name), count)
+        return list(range(last_id - count + 1, last_id + 1))
+
+    @staticmethod
+    async def get_icecream_by_id(id_: int, primary: bool = False) -> Optional[IceCream]:
+        """`primary` for reads a write depends on, which must not be stale."""
+
+        def fetch(client: aioredis.Redis) -> Awaitable[dict]:
+            return client.hgetall(KEYS.icecream(id_))
+
+        ice_dict: dict = await (
+            fetch(REDIS_CLIENT) if primary else RedisUtils.read(fetch)
+        )
         if not ice_dict:
             return None
+        return RedisUtils.icecream_from_hash(ice_dict)
+
+    @staticmethod
+    def icecream_from_hash(ice_dict: dict) -> IceCream:
+        if b"data" in ice_dict:
+            return ICECREAM_SERIALIZER.loads(ice_dict[b"data"])
+        # Written field by field before app.serialization
         return IceCream(
             id=ice_dict[b"id"],
-            name=ice_dict[b"name"],
+            name=ice_dict.get(b"name"),
             price=float(ice_dict[b"price"]),
             weight=float(ice_dict[b"weight"]),
-            img_url=ice_dict[b"img_url"],
+            img_url=ice_dict.get(b"img_url"),
+            img_status=ice_dict.get(b"img_status"),
+            thumbnail_url=ice_dict.get(b"thumbnail_url"),
+            medium_url=ice_dict.get(b"medium_url"),
         )
 
     @staticmethod
-    async def get_all_icecream_ids() -> List[int]:
-        icecream_ids: List[str] = await REDIS_CLIENT.lrange("icecream_ids", 0, -1)
+    def icecream_to_hash(icecream: IceCream) -> dict:
+        return {"data": ICECREAM_SERIALIZER.dumps(icecream)}
+
+    @staticmethod
+    async def get_icecreams_by_ids(
+        ids: List[int], client: Optional[aioredis.Redis] = None
+    ) -> List[IceCream]:
+        """Fetch many icecreams in one pipelined round trip, from the primary
+        unless `client` is given.
+
+        Ids whose hash is already gone (deleted after the id list was read)
+        are skipped.
+        """
+        if not ids:
+            return []
+        client = client or REDIS_CLIENT
+        async with client.pipeline(transaction=False) as pipe:
+            for id_ in ids:
+                pipe.hgetall(KEYS.icecream(id_))
+            ice_dicts: List[dict] = await pipe.execute()
+        return [
+            RedisUtils.icecream_from_hash(ice_dict)
+            for ice_dict in ice_dicts
+            if ice_dict
+        ]
+
+    @staticmethod
+    async def get_all_icecream_ids(client: Optional[aioredis.Redis] = None) -> List[int]:
+        icecream_ids: List[bytes] = await (client or REDIS_CLIENT).zrange(KEYS.icecream_ids, 0, -1)
         return [int(id) for id in icecream_ids]
 
     @staticmethod
-    async def get_all_ice_creams() -> List[IceCream]:
-        icecream_ids = await RedisUtils.get_all_icecream_ids()
-        icecreams = []
-        for id_ in icecream_ids:
-            icecreams.append(await RedisUtils.get_icecream_by_id(id_))
-        return icecreams
+    async def get_all_ice_creams(primary: bool = False) -> List[IceCream]:
+        async def fetch(client: aioredis.Redis) -> List[IceCream]:
+            icecream_ids = await RedisUtils.get_all_icecream_ids(client)
+            return await RedisUtils.get_icecreams_by_ids(icecream_ids, client)
+
+        return await (fetch(REDIS_CLIENT) if primary else RedisUtils.read(fetch))
 
     @staticmethod
     async def get_icecream_count() -> int:
-        return await REDIS_CLIENT.llen("icecream_ids")
+        return await RedisUtils.read(lambda client: client.zcard(KEYS.icecream_ids))
+
+    @staticmethod
+    async def migrate_icecream_ids() -> None:
+        """Turn a list of icecream ids left by older versions into the sorted set."""
+        moved = await MIGRATE_ICECREAM_IDS(REDIS_CLIENT, keys=[KEYS.icecream_ids])
+        if moved:
+            logger.info("icecream ids migrated to a sorted set", extra={"count": moved})
 
     @staticmethod
     async def create_ice_cream(icecream: IceCream) -> IceCream:
-        icecream.id = await RedisUtils.get_new_object_id("icecream")
-        icecream.img_url = ImageUtils.save_icecream_image_to_static(
-            icecream.img_url, icecream.id
-        )
-        await REDIS_CLIENT.rpush("icecream_ids", icecream.id)
-        await REDIS_CLIENT.hset(f"icecream:{icecream.id}", mapping=icecream.dict())
-        print(f"INFO: Icecream created ({icecream})")
-        return icecream
-    
+        return (await RedisUtils.create_ice_creams([icecream]))[0]
+
+    @staticmethod
+    async def create_ice_creams(icecreams: List[IceCream]) -> List[IceCream]:
+        """Create icecreams with one INCRBY and a MULTI pipeline per `BULK_WRITE_BATCH_SIZE`."""
+        ids = await RedisUtils.allocate_object_ids("icecream", len(icecreams))
+        for icecream, id_ in zip(icecreams, ids):
+            icecream.id = id_
+            icecream.img_status = IMAGE_PENDING if icecream.img_url else None
+            icecream.thumbnail_url = icecream.medium_url = None
+        for start in range(0, len(icecreams), BULK_WRITE_BATCH_SIZE):
+            batch = icecreams[start:start + BULK_WRITE_BATCH_SIZE]
+            async with REDIS_CLIENT.pipeline(transaction=True) as pipe:
+                for icecream in batch:
+                    pipe.zadd(KEYS.icecream_ids, {icecream.id: icecream.id})
+                    pipe.hset(
+                        KEYS.icecream(icecream.id),
+                        mapping=RedisUtils.icecream_to_hash(icecream),
+                    )
+                    RedisUtils.index_icecream(pipe, icecream)
+                await pipe.execute()
+            await RedisUtils.publish_icecream_changes([icecream.id for icecream in batch])
+        for icecream in icecreams:
+            if icecream.img_url:
+                await IMAGE_QUEUE.put(icecream.id, icecream.img_url)
+        logger.info("icecreams created", extra={"icecream_ids": ids})
+        return icecreams
+
+    @staticmethod
+    async def set_icecream_image(
+        icecream_id: int,
+        img_url: str,
+        img_status: str,
+        source_url: str,
+        variant_urls: Optional[Dict[str, str]] = None,
+    ) -> bool:
+        """Store the result of downloading `source_url` unless the icecream was
+        deleted or given another image meanwhile."""
+        variant_urls = variant_urls or {}
+        key = KEYS.icecream(icecream_id)
+
+        async def set_image(pipe: aioredis.client.Pipeline) -> bool:
+            ice_dict = await pipe.hgetall(key)
+            if not ice_dict:
+                return False
+            icecream = RedisUtils.icecream_from_hash(ice_dict)
+            if icecream.img_url != source_url:
+                return False
+            icecream = icecream.copy(
+                update={
+                    "img_url": img_url,
+                    "img_status": img_status,
+                    "thumbnail_url": variant_urls.get("thumbnail"),
+                    "medium_url": variant_urls.get("medium"),
+                }
+            )
+            pipe.multi()
+            pipe.delete(key)
+            pipe.hset(key, mapping=RedisUtils.icecream_to_hash(icecream))
+            return True
+
+        # WATCH makes the read-modify-write retry if the icecream changes meanwhile
+        updated = await REDIS_CLIENT.transaction(set_image, key, value_from_callable=True)
+        await RedisUtils.publish_icecream_change(icecream_id)
+        return updated
+
     @staticmethod
     async def update_icecream(icecream: IceCream) -> IceCream:
-        # todo new image url
-        await REDIS_CLIENT.delete(f"icecream:{icecream.id}")
-        await REDIS_CLIENT.hset(f"icecream:{icecream.id}", mapping=icecream.dict())
-        print(f"INFO: Icecream updated ({icecream})")
-        return icecream
+        return (await RedisUtils.update_icecreams([icecream]))[0]
+
+    @staticmethod
+    async def update_icecreams(icecreams: List[IceCream]) -> List[IceCream]:
+        """Replace stored icecreams, one HMGET then a MULTI pipeline per `BULK_WRITE_BATCH_SIZE`.
+
+        Pending images (see `merge_icecream_update`) are queued once written.
+        """
+        old_name_members = await REDIS_CLIENT.hmget(
+            KEYS.name_members, [icecream.id for icecream in icecreams]
+        )
+        for start in range(0, len(icecreams), BULK_WRITE_BATCH_SIZE):
+            batch = slice(start, start + BULK_WRITE_BATCH_SIZE)
+            async with REDIS_CLIENT.pipeline(transaction=True) as pipe:
+                for icecream, old_name_member in zip(icecreams[batch], old_name_members[batch]):
+                    pipe.delete(KEYS.icecream(icecream.id))
+                    pipe.hset(
+                        KEYS.icecream(icecream.id),
+                        mapping=RedisUtils.icecream_to_hash(icecream),
+                    )
+                    RedisUtils.index_icecream(pipe, icecream, old_name_member)
+                await pipe.execute()
+            await RedisUtils.publish_icecream_changes([icecream.id for icecream in icecreams[batch]])
+        for icecream in icecreams:
+            if icecream.img_status == IMAGE_PENDING:
+                await IMAGE_QUEUE.put(icecream.id, icecream.img_url)
+        logger.info(
+            "icecreams updated", extra={"icecream_ids": [icecream.id for icecream in icecreams]}
+        )
+        return icecreams
+
+    @staticmethod
+    async def merge_icecream_updates(updates: List[IceCream]) -> Tuple[List[IceCream], List[int]]:
+        """Apply the fields set in each update to its stored icecream.
+
+        Returns the merged icecreams and the ids of updates whose icecream does not exist.
+        """
+        saved = {
+            icecream.id: icecream
+            for icecream in await RedisUtils.get_icecreams_by_ids([update.id for update in updates])
+        }
+        merged, missing = [], []
+        for update in updates:
+            if update.id not in saved:
+                missing.append(update.id)
+                continue
+            merged.append(RedisUtils.merge_icecream_update(saved[update.id], update))
+        return merged, missing
+
+    @staticmethod
+    def merge_icecream_update(saved: IceCream, update: IceCream) -> IceCream:
+        """`saved` with the fields set in `update`, except its id and image state,
+        which only the image queue writes. A new `img_url` is pending again."""
+        fields = update.dict(exclude_unset=True, exclude=IMAGE_STATE_FIELDS | {"id"})
+        merged = saved.copy(update=fields)
+        if merged.img_url != saved.img_url:
+            merged.img_status = IMAGE_PENDING if merged.img_url else None
+            merged.thumbnail_url = merged.medium_url = None
+        return merged
 
     @staticmethod
     async def delete_icecream(icecream_id: int) -> bool:
-        await REDIS_CLIENT.execute_command("COPY", f"icecream:{icecream_id}", f"deleted:icecream:{icecream_id}")
-        await REDIS_CLIENT.lrem("icecream_ids", 0, icecream_id)
-        return bool(await REDIS_CLIENT.delete(f"icecream:{icecream_id}"))
+        name_member = await REDIS_CLIENT.hget(KEYS.name_members, icecream_id)
+        async with REDIS_CLIENT.pipeline(transaction=True) as pipe:
+            # Fails with "no such key" when there is nothing to delete
+            pipe.rename(KEYS.icecream(icecream_id), KEYS.deleted_icecream(icecream_id))
+            pipe.zrem(KEYS.icecream_ids, icecream_id)
+            RedisUtils.unindex_icecream(pipe, icecream_id, name_member)
+            results = await pipe.execute(raise_on_error=False)
+        await RedisUtils.publish_icecream_change(icecream_id)
+        return results[0] is True
+
+    @staticmethod
+    def name_index_member(icecream: IceCream) -> str:
+        # Equal scores make ZRANGEBYLEX order by name; the id keeps members unique.
+        return f"{(icecream.name or '').casefold()}\x00{icecream.id}"
+
+    @staticmethod
+    def index_icecream(
+        pipe: aioredis.client.Pipeline,
+        icecream: IceCream,
+        old_name_member: Optional[bytes] = None,
+    ) -> None:
+        """Buffer the commands that put the icecream into the search indexes."""
+        name_member = RedisUtils.name_index_member(icecream)
+        if old_name_member is not None and old_name_member != name_member.encode():
+            pipe.zrem(KEYS.name_index, old_name_member)
+        pipe.zadd(KEYS.name_index, {name_member: 0})
+        pipe.hset(KEYS.name_members, icecream.id, name_member)
+        for field, index in KEYS.score_indexes.items():
+            pipe.zadd(index, {icecream.id: getattr(icecream, field) or 0})
+
+    @staticmethod
+    def unindex_icecream(
+        pipe: aioredis.client.Pipeline,
+        icecream_id: int,
+        name_member: Optional[bytes],
+    ) -> None:
+        if name_member is not None:
+            pipe.zrem(KEYS.name_index, name_member)
+        pipe.hdel(KEYS.name_members, icecream_id)
+        for index in KEYS.score_indexes.values():
+            pipe.zrem(index, icecream_id)
+
+    @staticmethod
+    async def rebuild_icecream_indexes() -> int:
+        """Index every icecream from scratch, for data written before the indexes existed."""
+        icecreams = await RedisUtils.get_icecreams_by_ids(await RedisUtils.get_all_icecream_ids())
+        async with REDIS_CLIENT.pipeline(transaction=True) as pipe:
+            pipe.delete(KEYS.name_index, KEYS.name_members, *KEYS.score_indexes.values())
+            for icecream in icecreams:
+                RedisUtils.index_icecream(pipe, icecream)
+            await pipe.execute()
+        logger.info("icecream indexes rebuilt", extra={"count": len(icecreams)})
+        return len(icecreams)
+
+    @staticmethod
+    async def ensure_icecream_indexes() -> None:
+        if await RedisUtils.get_icecream_count() and not await REDIS_CLIENT.exists(
+            KEYS.name_members
+        ):
+            await RedisUtils.rebuild_icecream_indexes()
+
+    @staticmethod
+    async def get_index_range(
+        search: IceCreamSearch,
+        field: str,
+        descending: bool,
+        offset: Optional[int] = None,
+        limit: Optional[int] = None,
+    ) -> List[int]:
+        """Ids matching the `search` condition on `field`, ordered by `field`.
+
+        `field` is "id" (the catalog id set), "name" (prefix range over the lex
+        index) or one of `ICECREAM_SCORE_INDEXES` (score range).
+        """
+        if field == "id":
+            offset = offset or 0
+            stop = -1 if limit is None else offset + limit - 1
+            if descending:
+                ids = await REDIS_CLIENT.zrevrange(KEYS.icecream_ids, offset, stop)
+            else:
+                ids = await REDIS_CLIENT.zrange(KEYS.icecream_ids, offset, stop)
+            return [int(id_) for id_ in ids]
+        if field == "name":
+            if search.name:
+                prefix = search.name.casefold().encode()
+                low, high = b"[" + prefix, b"(" + prefix + b"\xff"
+            else:
+                low, high = b"-", b"+"
+            if descending:
+                members = await REDIS_CLIENT.zrevrangebylex(
+                    KEYS.name_index, high, low, start=offset, num=limit
+                )
+            else:
+                members = await REDIS_CLIENT.zrangebylex(
+                    KEYS.name_index, low, high, start=offset, num=limit
+                )
+            return [int(member.rsplit(b"\x00", 1)[1]) for member in members]
+        low = getattr(search, f"min_{field}")
+        high = getattr(search, f"max_{field}")
+        low = "-inf" if low is None else low
+        high = "+inf" if high is None else high
+        if descending:
+            ids = await REDIS_CLIENT.zrevrangebyscore(
+                KEYS.score_indexes[field], high, low, start=offset, num=limit
+            )
+        else:
+            ids = await REDIS_CLIENT.zrangebyscore(
+                KEYS.score_indexes[field], low, high, start=offset, num=limit
+            )
+        return [int(id_) for id_ in ids]
+
+    @staticmethod
+    async def search_icecreams(search: IceCreamSearch) -> List[IceCream]:
+        """Filter, sort and page the catalog using the secondary indexes.
+
+        The most selective condition (name prefix, then price, then weight
+        range, else the sort field) picks the index to range over. When that
+        is the only condition and also the sort order, Redis applies
+        offset/limit and only the returned page is loaded, O(log N + k).
+        Otherwise the index range is walked `SEARCH_SCAN_BATCH_SIZE` icecreams
+        at a time and the other conditions and the sort are applied here,
+        keeping only the best `offset + limit` matches. When the range is
+        ordered by the sort field the walk stops once the page is full.
+        Walking more than `SEARCH_SCAN_MAX_SIZE` icecreams raises
+        `SearchTooBroadError`.
+        """
+        limit = search.limit or SEARCH_PAGE_LIMIT
+        conditions = [
+            field
+            for field, active in (
+                ("name", search.name is not None),
+                ("price", search.min_price is not None or search.max_price is not None),
+                ("weight", search.min_weight is not None or search.max_weight is not None),
+            )
+            if active
+        ]
+        field = conditions[0] if conditions else search.sort.field
+        if conditions in ([], [search.sort.field]):
+            ids = await RedisUtils.get_index_range(
+                search, field, search.sort.descending, search.offset, limit
+            )
+            return await RedisUtils.get_icecreams_by_ids(ids)
+
+        ordered = field == search.sort.field
+        wanted = search.offset + limit
+        matches: List[IceCream] = []
+        for start in range(0, SEARCH_SCAN_MAX_SIZE, SEARCH_SCAN_BATCH_SIZE):
+            ids = await RedisUtils.get_index_range(
+                search, field, ordered and search.sort.descending, start, SEARCH_SCAN_BATCH_SIZE
+            )
+            matches += [
+                icecream
+                for icecream in await RedisUtils.get_icecreams_by_ids(ids)
+                if RedisUtils.icecream_matches(icecream, search)
+            ]
+            if not ordered:
+                matches = sorted(
+                    matches,
+                    key=lambda icecream: RedisUtils.icecream_sort_key(icecream, search.sort),
+                    reverse=search.sort.descending,
+                )[:wanted]
+            if len(ids) < SEARCH_SCAN_BATCH_SIZE or (ordered and len(matches) >= wanted):
+                return matches[search.offset:wanted]
+        raise SearchTooBroadError(SEARCH_SCAN_MAX_SIZE)
+
+    @staticmethod
+    def icecream_matches(icecream: IceCream, search: IceCreamSearch) -> bool:
+        if search.name and not (icecream.name or "").casefold().startswith(
+            search.name.casefold()
+        ):
+            return False
+        for field in ICECREAM_SCORE_INDEXES:
+            value = getattr(icecream, field) or 0
+            low = getattr(search, f"min_{field}")
+            high = getattr(search, f"max_{field}")
+            if (low is not None and value < low) or (high is not None and value > high):
+                return False
+        return True
+
+    @staticmethod
+    def icecream_sort_key(icecream: IceCream, sort: IceCreamSort) -> tuple:
+        if sort.field == "name":
+            return (icecream.name or "").casefold(), icecream.id
+        return getattr(icecream, sort.field) or 0, icecream.id
+
+    @staticmethod
+    async def publish_icecream_change(icecream_id: int) -> None:
+        await RedisUtils.publish_icecream_changes([icecream_id])
+
+    @staticmethod
+    async def publish_icecream_changes(icecream_ids: List[int]) -> None:
+        """Drop the icecreams from this worker's cache and tell the other workers.
+
+        Sent after the change is written, not inside its MULTI: a cluster
+        proxy pins a MULTI to the node of its keys, PUBLISH has none.
+        """
+        CacheUtils.invalidate_icecreams(icecream_ids)
+        async with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            for icecream_id in icecream_ids:
+                pipe.publish(CATALOG_INVALIDATION_CHANNEL, icecream_id)
+            await pipe.execute()
+
+    @staticmethod
+    async def import_icecreams(items: List[Tuple[str, IceCream]]) -> List[IceCream]:
+        """Idempotently write a batch of (import key, icecream) in a few round trips.
+
+        Icecreams seen by an earlier import under the same key keep their id and
+        image and only get name, price and weight updated. New ones get an id
+        range from one INCRBY and are returned so their images can be fetched.
+        """
+        items = list(dict(items).items())  # the last duplicate key wins
+        keys = [key for key, _ in items]
+        known_ids = await REDIS_CLIENT.hmget(KEYS.import_keys, keys) if keys else []
+        new_items = [
+            (key, icecream)
+            for (key, icecream), known_id in zip(items, known_ids)
+            if known_id is None
+        ]
+        if new_items:
+            ids = await RedisUtils.allocate_object_ids("icecream", len(new_items))
+            for id_, (_, icecream) in zip(ids, new_items):
+                icecream.id = id_
+                icecream.img_status = IMAGE_PENDING if icecream.img_url else None
+                icecream.thumbnail_url = icecream.medium_url = None
+        known_items = [
+            icecream for (_, icecream), known_id in zip(items, known_ids) if known_id is not None
+        ]
+        for icecream, known_id in zip(known_items, filter(None, known_ids)):
+            icecream.id = int(known_id)
+        saved_dicts, old_name_members = [], []
+        if known_items:
+            async with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+                for icecream in known_items:
+                    pipe.hgetall(KEYS.icecream(icecream.id))
+                pipe.hmget(KEYS.name_members, [icecream.id for icecream in known_items])
+                *saved_dicts, old_name_members = await pipe.execute()
+        async with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            for icecream, saved_dict, old_name_member in zip(
+                known_items, saved_dicts, old_name_members
+            ):
+                if not saved_dict:  # deleted since the last import
+                    continue
+                fields = icecream.dict(include={"name", "price", "weight"}, exclude_none=True)
+                icecream = RedisUtils.icecream_from_hash(saved_dict).copy(update=fields)
+                pipe.delete(KEYS.icecream(icecream.id))
+                pipe.hset(
+                    KEYS.icecream(icecream.id),
+                    mapping=RedisUtils.icecream_to_hash(icecream),
+                )
+                RedisUtils.index_icecream(pipe, icecream, old_name_member)
+            for key, icecream in new_items:
+                pipe.zadd(KEYS.icecream_ids, {icecream.id: icecream.id})
+                pipe.hset(
+                    KEYS.icecream(icecream.id),
+                    mapping=RedisUtils.icecream_to_hash(icecream),
+                )
+                RedisUtils.index_icecream(pipe, icecream)
+                pipe.hset(KEYS.import_keys, key, icecream.id)
+            for _, icecream in items:
+                pipe.publish(CATALOG_INVALIDATION_CHANNEL, icecream.id)
+            await pipe.execute()
+        return [icecream for _, icecream in new_items]
+
+    @staticmethod
+    async def import_users(users: List[UserIn]) -> None:
+        async with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            for user in users:
+                password_hash = HashUtils.get_sha256_hash(user.password)
+                pipe.hset(KEYS.user(user.login), "hash", password_hash)
+            await pipe.execute()
 
     @staticmethod
     async def create_user(user: UserIn) -> Optional[UserOut]:
         password_hash = HashUtils.get_sha256_hash(user.password)
-        await REDIS_CLIENT.hset(f"user:{user.login}", "hash", password_hash)
-        print(f"INFO: User created ({user.login})")
+        await REDIS_CLIENT.hset(KEYS.user(user.login), "hash", password_hash)
+        logger.info("user created", extra={"login": user.login})
         return UserOut(login=user.login, created_at=datetime.now())
 
     @staticmethod
     async def is_user_exist(login: str) -> bool:
-        return bool(await REDIS_CLIENT.exists(f"user:{login}"))
+        return bool(await REDIS_CLIENT.exists(KEYS.user(login)))
 
     @staticmethod
     async def user_has_valid_password(user: UserIn) -> bool:
-        redis_user = await REDIS_CLIENT.hgetall(f"user:{user.login}")
+        redis_user = await REDIS_CLIENT.hgetall(KEYS.user(user.login))
         password_hash = HashUtils.get_sha256_hash(user.password)
-        return redis_user[b"hash"] == password_hash
+        return redis_user.get(b"hash") == password_hash
+
+    @staticmethod
+    async def create_session(login: str) -> str:
+        token = HashUtils.gen_user_token()
+        await REDIS_CLIENT.set(KEYS.token(token), login, ex=SESSION_TTL)
+        return token
+
+    @staticmethod
+    async def get_session_login(token: str) -> Optional[str]:
+        login = await REDIS_CLIENT.get(KEYS.token(token))
+        return login.decode("utf-8") if login is not None else None
+
+    @staticmethod
+    async def take_tokens(buckets: List[Tuple[str, float, int]]) -> int:
+        """Take a token from every (key, rate per second, burst) bucket, or from none.
+
+        Returns 0, or the milliseconds to wait when a bucket is empty.
+        """
+        return await TAKE_TOKENS(
+            REDIS_CLIENT,
+            keys=[key for key, _, _ in buckets],
+            args=[value for _, rate, burst in buckets for value in (rate, burst)],
+        )
 
     @staticmethod
-    async def create_order(user_login: str, positions: List[OrderPosition]) -> Order:
-        order_id = await RedisUtils.get_new_object_id("order")
+    async def create_order(
+        user_login: str, positions: List[OrderPosition]
+    ) -> Optional[Order]:
+        """Atomically store, index, count in the sales counters and append to
+        `ORDER_STREAM` a new order in one round trip.
+
+        In a cluster the keys involved are in several slots, see
+        `store_order_in_slots`. Returns None, storing nothing, if an ordered
+        icecream does not exist.
+        """
         order = Order(
-            id=order_id,
+            id=0,
             user_login=user_login,
             created_at=datetime.now(),
             positions=positions,
         )
+        if KEYS.cluster:
+            created, value = await RedisUtils.store_order_in_slots(order)
+        else:
+            hour = order.created_at.replace(minute=0, second=0, microsecond=0)
+            keys = [
+                KEYS.highest_id("order"),
+                KEYS.user_orders(user_login),
+                KEYS.order_ids,
+                KEYS.sales_quantity,
+                KEYS.sales_revenue,
+                KEYS.score_indexes["price"],
+                KEYS.sales_hour(hour.strftime(SALES_HOUR_FORMAT)),
+                KEYS.sales_hours,
+            ]
+            if ORDER_STREAM:
+                keys.append(KEYS.stream(ORDER_STREAM))
+            created, value = await CREATE_ORDER(
+                REDIS_CLIENT,
+                keys=keys,
+                args=[
+                    ORDER_SERIALIZER.dumps(order),
+                    ORDER_STREAM_MAXLEN,
+                    hour.strftime(SALES_HOUR_FORMAT),
+                    RedisUtils.sales_hour_expiry(hour),
+                    *(
+                        value
+                        for position in positions
+                        for value in (position.icecream_id, position.quantity)
+                    ),
+                ],
+            )
+        if not created:
+            order_logger.info(
+                "order rejected", extra={"login": user_login, "icecream_id": value}
+            )
+            return None
+        order.id = value
+        CacheUtils.invalidate_user_orders(user_login)
+        RedisUtils.wrote(user_login)
+        order_logger.info("order created", extra={"order_id": order.id, "login": user_login})
+        return order
 
-        await REDIS_CLIENT.hset(f"order:{order_id}", "order", order.json())
-        await REDIS_CLIENT.rpush(f"user:{user_login}:orders", order_id)
-        await REDIS_CLIENT.rpush("order_ids", order_id)
+    @staticmethod
+    async def store_order_in_slots(order: Order) -> Tuple[int, int]:
+        """CREATE_ORDER for a cluster, one round trip per slot: read the prices
+        from the catalog's, store the order in its user's, then count it and
+        append it to the stream in the sales'. Returns what CREATE_ORDER does.
 
-        print(f"INFO: Order created ({order})")
-        return order
+        Each step is atomic, the whole is not: when the last one fails the
+        order is stored but missing from `order_ids`, the sales and the stream.
+        The id comes from a block of `ORDER_IDS`, not one shared INCR per order.
+        """
+        ids = [position.icecream_id for position in order.positions]
+        async with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            for id_ in ids:
+                pipe.zscore(KEYS.score_indexes["price"], id_)
+            prices = await pipe.execute()
+        for id_, price in zip(ids, prices):
+            # Every icecream is in the price index, see index_icecream
+            if price is None:
+                return 0, id_
+        raw = ORDER_SERIALIZER.dumps(order)
+        order.id = await ORDER_IDS.next()
+        async with REDIS_CLIENT.pipeline(transaction=True) as pipe:
+            pipe.hset(KEYS.order(order.user_login, order.id), "order", raw)
+            pipe.rpush(KEYS.user_orders(order.user_login), order.id)
+            await pipe.execute()
+        async with REDIS_CLIENT.pipeline(transaction=True) as pipe:
+            pipe.rpush(KEYS.order_ids, KEYS.order_ref(order.user_login, order.id))
+            RedisUtils.buffer_sales(pipe, [order], dict(zip(ids, prices)))
+            if ORDER_STREAM:
+                pipe.xadd(
+                    KEYS.stream(ORDER_STREAM),
+                    {"id": order.id, "order": raw},
+                    maxlen=ORDER_STREAM_MAXLEN or None,
+                )
+            await pipe.execute()
+        return 1, order.id
+
+    @staticmethod
+    async def get_user_orders(
+        user_login: str, cursor: Optional[int] = None, limit: int = ORDERS_PAGE_LIMIT
+    ) -> OrdersPage:
+        """Fetch a page of user orders, newest first, in one round trip
+        (two in a cluster, see `get_orders_page_in_slot`).
+
+        Pass the returned `next_cursor` to get the following (older) page.
+        Cursors stay valid while new orders arrive since the list is append-only.
+        """
+        if KEYS.cluster:
+            next_cursor, *page = await RedisUtils.get_orders_page_in_slot(user_login, cursor, limit)
+        else:
+            next_cursor, *page = await RedisUtils.read(
+                lambda client: GET_ORDERS_PAGE(
+                    client,
+                    keys=[KEYS.user_orders(user_login)],
+                    args=["" if cursor is None else cursor, limit, KEYS.order_prefix(user_login)],
+                ),
+                user_login,
+            )
+        return OrdersPage(
+            orders=[
+                ORDER_SERIALIZER.loads(raw, id=int(id_))
+                for id_, raw in zip(page[::2], page[1::2])
+                if raw
+            ],
+            next_cursor=next_cursor or None,
+        )
+
+    @staticmethod
+    async def get_orders_page_in_slot(
+        user_login: str, cursor: Optional[int], limit: int
+    ) -> list:
+        """GET_ORDERS_PAGE for a cluster, which only runs scripts whose keys are
+        all declared: read the page of order ids, then the orders. Returns what
+        GET_ORDERS_PAGE does.
+        """
+        key = KEYS.user_orders(user_login)
+        if cursor is None:
+            async with REDIS_CLIENT.pipeline(transaction=True) as pipe:
+                pipe.llen(key)
+                pipe.lrange(key, -limit, -1)
+                stop, ids = await pipe.execute()
+        else:
+            stop = cursor
+            ids = await REDIS_CLIENT.lrange(key, max(stop - limit, 0), stop - 1) if stop > 0 else []
+        page: list = [max(stop - limit, 0)]
+        if ids:
+            ids = ids[::-1]
+            async with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+                for id_ in ids:
+                    pipe.hget(KEYS.order(user_login, int(id_)), "order")
+                raws = await pipe.execute()
+            for id_, raw in zip(ids, raws):
+                page += [id_, raw]
+        return page
 
     @staticmethod
-    async def get_user_orders(user_login: str) -> List[Order]:
-        orders: List[Order] = []
-        for id_ in await RedisUtils.get_user_orders_ids(user_login):
-            order_raw = await REDIS_CLIENT.hget(f"order:{id_}", "order")
-            orders.append(Order.parse_raw(order_raw))
-        return orders
+    async def get_top_sellers(limit: int, by: str = "quantity") -> List[IceCreamSales]:
+        """Best selling icecreams by "quantity" or "revenue", O(log N + limit)."""
+        key, other = KEYS.sales_quantity, KEYS.sales_revenue
+        if by == "revenue":
+            key, other = other, key
+        top = await REDIS_CLIENT.zrevrange(key, 0, limit - 1, withscores=True)
+        if not top:
+            return []
+        async with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            for icecream_id, _ in top:
+                pipe.zscore(other, icecream_id)
+            other_scores = await pipe.execute()
+        sales = []
+        for (icecream_id, score), other_score in zip(top, other_scores):
+            quantity, cents = (score, other_score) if key == KEYS.sales_quantity else (other_score, score)
+            sales.append(
+                IceCreamSales(
+                    icecream_id=int(icecream_id),
+                    quantity=int(quantity or 0),
+                    revenue=(cents or 0) / 100,
+                )
+            )
+        return sales
 
+    @staticmethod
+    async def get_hourly_sales(since: datetime, until: datetime) -> List[HourlySales]:
+        """Totals of every hour from `since` to `until`, one HGETALL per hour."""
+        hour = since.replace(minute=0, second=0, microsecond=0)
+        hours = []
+        while hour <= until:
+            hours.append(hour)
+            hour += timedelta(hours=1)
+        if not hours:
+            return []
+        async with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            for hour in hours:
+                pipe.hgetall(KEYS.sales_hour(hour.strftime(SALES_HOUR_FORMAT)))
+            totals: List[dict] = await pipe.execute()
+        return [
+            HourlySales(
+                hour=hour,
+                orders=int(total.get(b"orders", 0)),
+                quantity=int(total.get(b"quantity", 0)),
+                revenue=int(total.get(b"revenue_cents", 0)) / 100,
+            )
+            for hour, total in zip(hours, totals)
+        ]
+
+    @staticmethod
+    async def backfill_sales(batch_size: int = 1000) -> int:
+        """Rebuild the sales counters from the stored orders, `batch_size` at a time.
+
+        Orders created while this runs are counted by `create_order` as usual.
+        Revenue uses current prices, the price at order time is not stored.
+        """
+        order_count = -1
+        while order_count == -1:  # an order counted in a new hour meanwhile
+            hours = [hour.decode() for hour in await REDIS_CLIENT.smembers(KEYS.sales_hours)]
+            order_count = await RESET_SALES(
+                REDIS_CLIENT,
+                keys=[
+                    KEYS.order_ids,
+                    KEYS.sales_quantity,
+                    KEYS.sales_revenue,
+                    KEYS.sales_hours,
+                    *(KEYS.sales_hour(hour) for hour in hours),
+                ],
+                args=hours,
+            )
+        prices = {
+            int(icecream_id): price
+            for icecream_id, price in await REDIS_CLIENT.zrange(
+                KEYS.score_indexes["price"], 0, -1, withscores=True
+            )
+        }
+        for start in range(0, order_count, batch_size):
+            stop = min(start + batch_size, order_count) - 1
+            refs = await REDIS_CLIENT.lrange(KEYS.order_ids, start, stop)
+            keys_and_ids = [KEYS.order_from_ref(ref) for ref in refs]
+            async with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+                for key, _ in keys_and_ids:
+                    pipe.hget(key, "order")
+                raws = await pipe.execute()
+            orders = [
+                ORDER_SERIALIZER.loads(raw, id=id_)
+                for (_, id_), raw in zip(keys_and_ids, raws)
+                if raw
+            ]
+            await RedisUtils.count_sales(orders, prices)
+            logger.info("sales backfilled", extra={"orders": stop + 1, "total": order_count})
+        return order_count
+
+    @staticmethod
+    async def count_sales(orders: List[Order], prices: Dict[int, float]) -> None:
+        """Add orders to the sales counters the way CREATE_ORDER does, in one pipeline."""
+        async with REDIS_CLIENT.pipeline(transaction=False) as pipe:
+            RedisUtils.buffer_sales(pipe, orders, prices)
+            await pipe.execute()
+
+    @staticmethod
+    def buffer_sales(
+        pipe: aioredis.client.Pipeline, orders: List[Order], prices: Dict[int, float]
+    ) -> None:
+        """Buffer the commands of `count_sales`."""
+        quantities: Dict[int, int] = defaultdict(int)
+        revenues: Dict[int, int] = defaultdict(int)
+        hours: Dict[datetime, List[int]] = defaultdict(lambda: [0, 0, 0])
+        for order in orders:
+            hour = hours[order.created_at.replace(minute=0, second=0, microsecond=0)]
+            hour[0] += 1
+            for position in order.positions:
+                cents = math.floor(prices.get(position.icecream_id, 0) * 100 + 0.5)
+                quantities[position.icecream_id] += position.quantity
+                revenues[position.icecream_id] += cents * position.quantity
+                hour[1] += position.quantity
+                hour[2] += cents * position.quantity
+        now = datetime.now().timestamp()
+        for icecream_id, quantity in quantities.items():
+            pipe.zincrby(KEYS.sales_quantity, quantity, icecream_id)
+            pipe.zincrby(KEYS.sales_revenue, revenues[icecream_id], icecream_id)
+        for hour, (order_count, quantity, revenue) in hours.items():
+            expiry = RedisUtils.sales_hour_expiry(hour)
+            if expiry <= now:
+                continue
+            key = KEYS.sales_hour(hour.strftime(SALES_HOUR_FORMAT))
+            pipe.hincrby(key, "orders", order_count)
+            pipe.hincrby(key, "quantity", quantity)
+            pipe.hincrby(key, "revenue_cents", revenue)
+            pipe.expireat(key, expiry)
+            pipe.sadd(KEYS.sales_hours, hour.strftime(SALES_HOUR_FORMAT))
+
+    @staticmethod
+    def sales_hour_expiry(hour: datetime) -> int:
+        """Unix time the counters of `hour` expire at, SALES_HOUR_TTL after it starts."""
+        return int(hour.timestamp()) + SALES_HOUR_TTL
+
+    @staticmethod
     async def get_user_orders_ids(user_login: str) -> List[int]:
-        ids = await REDIS_CLIENT.lrange(f"user:{user_login}:orders", 0, 1)
+        ids = await REDIS_CLIENT.lrange(KEYS.user_orders(user_login), 0, -1)
         return [int(id_) for id_ in ids]
+
+
+class CacheUtils:
+    """Read-through access to the catalog kept in this worker's `CATALOG_CACHE`.
+
+    Misses go through `SINGLE_FLIGHT`, so concurrent requests for the same
+    data wait on one Redis fetch instead of each sending their own. A fetch
+    an invalidation overtakes is returned but not cached. The first fill
+    after an invalidation reads the primary, see `stale`.
+    """
+
+    @staticmethod
+    def stale(key: Hashable) -> bool:
+        """Whether `key` was invalidated lately and not refilled since: the
+        replica may not have the change yet, so its refill reads the primary."""
+        return STALE_CATALOG_KEYS.get(key) is not None
+
+    @staticmethod
+    def fill(key: Hashable, value: Any, generation: int) -> None:
+        """Cache `value` fetched at `generation`, unless invalidated since."""
+        if generation == CATALOG_CACHE.generation:
+            CATALOG_CACHE.set(key, value, generation)
+            STALE_CATALOG_KEYS.invalidate(key)
+
+    @staticmethod
+    async def get_all_ice_creams() -> List[IceCream]:
+        icecreams = CATALOG_CACHE.get(ALL_ICECREAMS_KEY)
+        if icecreams is None:
+            generation = CATALOG_CACHE.generation
+            primary = CacheUtils.stale(ALL_ICECREAMS_KEY)
+            icecreams = await SINGLE_FLIGHT.do(
+                (ALL_ICECREAMS_KEY,), lambda: RedisUtils.get_all_ice_creams(primary)
+            )
+            CacheUtils.fill(ALL_ICECREAMS_KEY, icecreams, generation)
+        return icecreams
+
+    @staticmethod
+    async def get_catalog_snapshot() -> CatalogSnapshot:
+        snapshot = CATALOG_CACHE.get(CATALOG_SNAPSHOT_KEY)
+        if snapshot is None:
+            generation = CATALOG_CACHE.generation
+            snapshot = CatalogSnapshot.build(await CacheUtils.get_all_ice_creams())
+            CATALOG_CACHE.set(CATALOG_SNAPSHOT_KEY, snapshot, generation)
+        return snapshot
+
+    @staticmethod
+    async def get_icecreams_by_ids(ids: List[int]) -> List[IceCream]:
+        """Cached icecreams, fetching every miss in one pipelined round trip."""
+        cached = {id_: CATALOG_CACHE.get(id_) for id_ in dict.fromkeys(ids)}
+        missing = [id_ for id_, icecream in cached.items() if icecream is None]
+        generation = CATALOG_CACHE.generation
+        for icecream in await RedisUtils.get_icecreams_by_ids(missing):
+            CacheUtils.fill(icecream.id, icecream, generation)
+            cached[icecream.id] = icecream
+        return [cached[id_] for id_ in ids if cached[id_] is not None]
+
+    @staticmethod
+    async def get_icecream_by_id(id_: int) -> Optional[IceCream]:
+        icecream = CATALOG_CACHE.get(id_)
+        if icecream is None:
+            generation = CATALOG_CACHE.generation
+            primary = CacheUtils.stale(id_)
+            icecream = await SINGLE_FLIGHT.do(
+                ("icecream", id_), lambda: RedisUtils.get_icecream_by_id(id_, primary)
+            )
+            if icecream is not None:
+                CacheUtils.fill(id_, icecream, generation)
+        return icecream
+
+    @staticmethod
+    async def get_user_orders(
+        user_login: str, cursor: Optional[int] = None, limit: int = ORDERS_PAGE_LIMIT
+    ) -> OrdersPage:
+        """Not cached, a user sees their new order right away; only coalesced."""
+        return await SINGLE_FLIGHT.do(
+            ("orders", user_login, cursor, limit),
+            lambda: RedisUtils.get_user_orders(user_login, cursor, limit),
+        )
+
+    @staticmethod
+    async def get_session_login(token: str) -> Optional[str]:
+        """Resolve a session token, remembering valid ones for `SESSION_CACHE_TTL`."""
+        login = SESSION_CACHE.get(token)
+        if login is None:
+            login = await RedisUtils.get_session_login(token)
+            if login is not None:
+                SESSION_CACHE.set(token, login)
+        return login
+
+    @staticmethod
+    def invalidate_icecream(id_: int) -> None:
+        CacheUtils.invalidate_icecreams([id_])
+
+    @staticmethod
+    def invalidate_icecreams(ids: Iterable[int]) -> None:
+        ids = list(ids)
+        for id_ in ids:
+            CATALOG_CACHE.invalidate(id_)
+            SINGLE_FLIGHT.forget("icecream", id_)
+        CATALOG_CACHE.invalidate(ALL_ICECREAMS_KEY)
+        CATALOG_CACHE.invalidate(CATALOG_SNAPSHOT_KEY)
+        SINGLE_FLIGHT.forget(ALL_ICECREAMS_KEY)
+        CacheUtils.mark_stale([*ids, ALL_ICECREAMS_KEY])
+
+    @staticmethod
+    def mark_stale(keys: Iterable[Hashable]) -> None:
+        if REDIS_REPLICA is not None:
+            for key in keys:
+                STALE_CATALOG_KEYS.set(key, True)
+
+    @staticmethod
+    def invalidate_user_orders(user_login: str) -> None:
+        SINGLE_FLIGHT.forget("orders", user_login)
+
+    @staticmethod
+    async def listen_for_invalidations(subscribed: Optional[asyncio.Event] = None) -> None:
+        """Apply icecream changes published by any worker. Runs until cancelled.
+
+        `subscribed` is set once the cache can be filled without missing a change.
+        """
+        while True:
+            pubsub = REDIS_CLIENT.pubsub()
+            try:
+                await pubsub.subscribe(CATALOG_INVALIDATION_CHANNEL)
+                # Changes published while we were not subscribed are lost.
+                CacheUtils.mark_stale([*CATALOG_CACHE.keys(), ALL_ICECREAMS_KEY])
+                CATALOG_CACHE.clear()
+                if subscribed is not None:
+                    subscribed.set()
+                while True:
+                    # Polling instead of listen() so an idle channel does not hit
+                    # REDIS_SOCKET_TIMEOUT; PINGs every REDIS_HEALTH_CHECK_INTERVAL.
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=1.0
+                    )
+                    if message is not None and message["type"] == "message":
+                        CacheUtils.invalidate_icecream(int(message["data"]))
+            except (aioredis.ConnectionError, aioredis.TimeoutError) as e:
+                logger.warning("catalog cache listener disconnected", extra={"error": repr(e)})
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
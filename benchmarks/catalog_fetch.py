@@ -0,0 +1,69 @@
+"""Round trips and latency of the catalog read path against catalog size.
+
+    python -m benchmarks.catalog_fetch --sizes 10 100 1000 --rtt-ms 0.5
+    python -m benchmarks.catalog_fetch --redis-url redis://localhost
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from typing import List
+
+from app import utils
+from app.keys import KEYS
+from app.models import IceCream
+from app.utils import RedisUtils
+
+from .redis_client import make_client
+
+
+async def sequential_fetch() -> List[IceCream]:
+    """The pre-pipelining implementation: one HGETALL round trip per id."""
+    icecreams = []
+    for id_ in await RedisUtils.get_all_icecream_ids():
+        icecreams.append(await RedisUtils.get_icecream_by_id(id_))
+    return icecreams
+
+
+async def seed(client, size: int) -> None:
+    await client.flushall()
+    async with client.pipeline(transaction=False) as pipe:
+        for id_ in range(1, size + 1):
+            icecream = IceCream(id=id_, name=f"icecream {id_}", price=10, weight=50, img_url="img.jpg")
+            pipe.zadd(KEYS.icecream_ids, {id_: id_})
+            pipe.hset(KEYS.icecream(id_), mapping=RedisUtils.icecream_to_hash(icecream))
+        await pipe.execute()
+
+
+async def measure(fetch, counter, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        counter.reset()
+        start = time.perf_counter()
+        await fetch()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {"round_trips": counter.count, "median_ms": statistics.median(timings)}
+
+
+async def main(args: argparse.Namespace) -> None:
+    client, counter = make_client(args.redis_url, args.rtt_ms)
+    utils.REDIS_CLIENT = client
+    print(f"{'size':>6} {'seq trips':>10} {'seq ms':>10} {'pipe trips':>11} {'pipe ms':>10}")
+    for size in args.sizes:
+        await seed(client, size)
+        seq = await measure(sequential_fetch, counter, args.repeat)
+        pipe = await measure(RedisUtils.get_all_ice_creams, counter, args.repeat)
+        print(
+            f"{size:>6} {seq['round_trips']:>10} {seq['median_ms']:>10.2f}"
+            f" {pipe['round_trips']:>11} {pipe['median_ms']:>10.2f}"
+        )
+    await client.flushall()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--rtt-ms", type=float, default=0.5, help="simulated round trip time for fakeredis")
+    parser.add_argument("--redis-url", help="benchmark a real Redis (flushes it!) instead of fakeredis")
+    asyncio.run(main(parser.parse_args()))
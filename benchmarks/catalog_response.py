@@ -0,0 +1,59 @@
+"""Requests/sec of GET /api/icecream/ before and after pre-serialized snapshots.
+
+"before" serves the cached list of IceCream models through FastAPI's encoder,
+as the endpoint did before; "after" serves the snapshot bytes, and "304" is
+a repeat poll carrying the current ETag.
+
+    python -m benchmarks.catalog_response --size 200 --seconds 3
+"""
+import argparse
+import asyncio
+import time
+
+import fakeredis.aioredis
+from fastapi import FastAPI
+
+from app import utils
+from app.main import app
+from app.utils import CacheUtils
+
+from .asgi import asgi_request
+from .catalog_fetch import seed
+
+before_app = FastAPI()
+
+
+@before_app.get("/api/icecream/")
+async def get_icecreams_before():
+    return await CacheUtils.get_all_ice_creams()
+
+
+async def requests_per_second(target, headers: dict, seconds: float) -> float:
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        await asgi_request(target, "GET", "/api/icecream/", headers)
+        count += 1
+    return count / seconds
+
+
+async def main(args: argparse.Namespace) -> None:
+    client = fakeredis.aioredis.FakeRedis()
+    utils.REDIS_CLIENT = client
+    await seed(client, args.size)
+    _, headers, body = await asgi_request(app, "GET", "/api/icecream/")
+    print(f"catalog of {args.size} icecreams, {len(body)} bytes")
+    for name, target, request_headers in (
+        ("before", before_app, {}),
+        ("after", app, {}),
+        ("304", app, {"If-None-Match": headers["etag"]}),
+    ):
+        rps = await requests_per_second(target, request_headers, args.seconds)
+        print(f"{name:>8}: {rps:>10.0f} req/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=3)
+    asyncio.run(main(parser.parse_args()))
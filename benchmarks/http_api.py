@@ -0,0 +1,189 @@
+"""Throughput and latency of the HTTP API under concurrent load.
+
+Drives the app in-process through ASGI, through a uvicorn server started in
+this process, or against an already running server. Prints one JSON
+document with p50/p95/p99 latency (ms) and requests/sec per scenario.
+
+    python -m benchmarks.http_api --mode inprocess --concurrency 16 --duration 5
+    python -m benchmarks.http_api --mode uvicorn --catalog-size 1000 --orders-per-user 200
+    python -m benchmarks.http_api --mode url --url http://localhost:8000 --scenarios catalog item
+
+In-process and uvicorn modes use fakeredis, without the order stream,
+unless --redis-url is given (that Redis is flushed!), and turn admission
+limits off unless --admission-limits is given. In url mode the server's own
+Redis is seeded through the API and its limits apply: raise them with
+ADMISSION_LIMITS. Requests shed with 429 or 503 are counted apart from
+errors.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import random
+import statistics
+import sys
+import time
+from typing import Awaitable, Callable, Dict, List
+
+import aioredis
+import fakeredis.aioredis
+import httpx
+import uvicorn
+
+from app import admission, utils
+from app.main import app
+
+
+class Context:
+    def __init__(self) -> None:
+        self.icecream_ids: List[int] = []
+        self.users: List[tuple] = []
+        self.tokens: List[str] = []
+
+    def auth_headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {random.choice(self.tokens)}"}
+
+
+SHED_STATUSES = {429, 503}
+Scenario = Callable[[httpx.AsyncClient, Context], Awaitable[httpx.Response]]
+
+SCENARIOS: Dict[str, Scenario] = {
+    "catalog": lambda client, ctx: client.get("/api/icecream/"),
+    "item": lambda client, ctx: client.get(f"/api/icecream/{random.choice(ctx.icecream_ids)}"),
+    "login": lambda client, ctx: client.post("/api/user/login", auth=random.choice(ctx.users)),
+    "order_create": lambda client, ctx: client.post(
+        "/api/order/new",
+        json=[{"icecream_id": random.choice(ctx.icecream_ids), "quantity": 1}],
+        headers=ctx.auth_headers(),
+    ),
+    "order_history": lambda client, ctx: client.get("/api/order/my", headers=ctx.auth_headers()),
+}
+
+
+async def seed(client: httpx.AsyncClient, ctx: Context, args: argparse.Namespace) -> None:
+    for i in range(args.catalog_size):
+        icecream = {"name": f"icecream {i}", "price": 10 + i % 7, "weight": 50}
+        response = await client.post("/api/icecream/", json=icecream)
+        ctx.icecream_ids.append(response.json()["id"])
+    for i in range(args.users):
+        credentials = (f"bench_user_{i}", "bench_password")
+        await client.post("/api/user/new", json={"login": credentials[0], "password": credentials[1]})
+        response = await client.post("/api/user/login", auth=credentials)
+        ctx.users.append(credentials)
+        ctx.tokens.append(response.json()["token"])
+    for token in ctx.tokens:
+        for _ in range(args.orders_per_user):
+            await client.post(
+                "/api/order/new",
+                json=[{"icecream_id": random.choice(ctx.icecream_ids), "quantity": 2}],
+                headers={"Authorization": f"Bearer {token}"},
+            )
+
+
+async def run_scenario(
+    client: httpx.AsyncClient, ctx: Context, scenario: Scenario, concurrency: int, duration: float
+) -> dict:
+    latencies: List[float] = []
+    errors = shed = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker() -> None:
+        nonlocal errors, shed
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            response = await scenario(client, ctx)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code in SHED_STATUSES:
+                shed += 1
+            elif response.status_code >= 400:
+                errors += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started_at
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "shed": shed,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentiles[49], 3),
+        "p95_ms": round(percentiles[94], 3),
+        "p99_ms": round(percentiles[98], 3),
+    }
+
+
+async def main(args: argparse.Namespace) -> dict:
+    server = server_task = None
+    if args.mode != "url":
+        if args.redis_url:
+            utils.REDIS_CLIENT = aioredis.from_url(args.redis_url)
+        else:
+            utils.REDIS_CLIENT = fakeredis.aioredis.FakeRedis()
+            utils.ORDER_STREAM = ""  # fakeredis has no streams
+        await utils.REDIS_CLIENT.flushall()
+        if not args.admission_limits:
+            admission.GROUP_LIMITS.clear()  # every group gets the unlimited GroupLimits()
+    if args.mode == "inprocess":
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark")
+    else:
+        base_url = args.url
+        if args.mode == "uvicorn":
+            config = uvicorn.Config(app, host="127.0.0.1", port=args.port, lifespan="off", log_level="warning")
+            server = uvicorn.Server(config)
+            server_task = asyncio.create_task(server.serve())
+            while not server.started:
+                await asyncio.sleep(0.01)
+            base_url = f"http://127.0.0.1:{args.port}"
+        limits = httpx.Limits(max_connections=args.concurrency)
+        client = httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30)
+
+    ctx = Context()
+    async with client:
+        await seed(client, ctx, args)
+        results = {}
+        for name in args.scenarios:
+            results[name] = await run_scenario(client, ctx, SCENARIOS[name], args.concurrency, args.duration)
+    if server is not None:
+        server.should_exit = True
+        await server_task
+    return {
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "duration_s": args.duration,
+        "catalog_size": args.catalog_size,
+        "users": args.users,
+        "orders_per_user": args.orders_per_user,
+        "admission_limits": args.mode == "url" or args.admission_limits,
+        "scenarios": results,
+    }
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn", "url"], default="inprocess")
+    parser.add_argument("--url", default="http://localhost:8000", help="server to load in url mode")
+    parser.add_argument("--port", type=int, default=8765, help="port of the uvicorn mode server")
+    parser.add_argument("--redis-url", help="use a real Redis instead of fakeredis (flushed!)")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5, help="seconds per scenario")
+    parser.add_argument("--catalog-size", type=int, default=100)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--orders-per-user", type=int, default=20)
+    parser.add_argument(
+        "--admission-limits", action="store_true", help="keep the app's rate limits in-process and in uvicorn mode"
+    )
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with contextlib.redirect_stdout(sys.stderr):  # keep stdout for the report
+        report = asyncio.run(main(args))
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,61 @@
+"""Per-call cost of the old print() logging and the queue-backed logger.
+
+Reports wall time and CPU time of the calling thread, which is what the
+event loop pays; the latter excludes the listener thread formatting records.
+
+    python -m benchmarks.logging_overhead --calls 100000
+"""
+import argparse
+import contextlib
+import logging
+import os
+import time
+from datetime import datetime
+
+from app.logs import SampledLogger, setup_logging
+from app.models import Order, OrderPosition
+
+ORDER = Order(
+    id=1,
+    user_login="bestboss",
+    created_at=datetime.now(),
+    positions=[OrderPosition(icecream_id=i, quantity=2) for i in range(5)],
+)
+
+
+def per_call_us(log, calls: int) -> tuple:
+    start, start_cpu = time.perf_counter(), time.thread_time()
+    for _ in range(calls):
+        log()
+    wall, cpu = time.perf_counter() - start, time.thread_time() - start_cpu
+    return wall / calls * 1e6, cpu / calls * 1e6
+
+
+def main(args: argparse.Namespace) -> None:
+    results = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results["print, full repr"] = per_call_us(lambda: print(f"INFO: Order created ({ORDER})"), args.calls)
+        listener = setup_logging(level="INFO", sample_rates={"icecreamapi.orders": 1})
+        orders = SampledLogger("icecreamapi.orders")
+        results["logger.info"] = per_call_us(
+            lambda: orders.info("order created", extra={"order_id": ORDER.id, "login": ORDER.user_login}), args.calls
+        )
+        listener.stop()
+        listener = setup_logging(level="INFO", sample_rates={"icecreamapi.orders": 0.1})
+        results["logger.info, 10% sampled"] = per_call_us(
+            lambda: orders.info("order created", extra={"order_id": ORDER.id, "login": ORDER.user_login}), args.calls
+        )
+        redis_logger = logging.getLogger("icecreamapi.redis")
+        results["logger.debug, disabled"] = per_call_us(
+            lambda: redis_logger.debug("new object id", extra={"object": "order", "id": 1}), args.calls
+        )
+        listener.stop()
+    print(f"{'':>26}  {'wall us':>8}  {'cpu us':>8}")
+    for name, (wall, cpu) in results.items():
+        print(f"{name:>26}: {wall:8.2f}  {cpu:8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=100000)
+    main(parser.parse_args())
@@ -0,0 +1,41 @@
+"""Redis clients for benchmarks that count round trips.
+
+Without a URL an in-memory fakeredis server is used and every round trip
+is delayed by ``rtt_ms`` to model the network between the app and Redis.
+"""
+import asyncio
+from typing import Optional
+
+import aioredis
+import fakeredis.aioredis
+
+
+class RoundTripCounter:
+    def __init__(self) -> None:
+        self.count = 0
+
+    def reset(self) -> None:
+        self.count = 0
+
+
+def _counting(connection_class: type, counter: RoundTripCounter, rtt_ms: float) -> type:
+    class CountingConnection(connection_class):
+        async def send_packed_command(self, *args, **kwargs):
+            counter.count += 1
+            if rtt_ms:
+                await asyncio.sleep(rtt_ms / 1000)
+            return await super().send_packed_command(*args, **kwargs)
+
+    return CountingConnection
+
+
+def make_client(redis_url: Optional[str] = None, rtt_ms: float = 0.5):
+    counter = RoundTripCounter()
+    if redis_url:
+        client = aioredis.from_url(redis_url)
+        client.connection_pool.connection_class = _counting(aioredis.Connection, counter, 0)
+    else:
+        client = fakeredis.aioredis.FakeRedis()
+        pool = client.connection_pool
+        pool.connection_class = _counting(pool.connection_class, counter, rtt_ms)
+    return client, counter
@@ -0,0 +1,85 @@
+"""Encode time and bytes on the wire of each endpoint's JSON body.
+
+"fastapi" is the path responses took before app.responses: validation
+against the response model (where the endpoint has one), `jsonable_encoder`
+and stdlib `json`. "orjson" is `ModelJSONResponse`. Sizes are of the plain,
+gzip and brotli bodies at the levels the middleware uses.
+
+    python -m benchmarks.responses --catalog-size 200 --orders 20 --calls 2000
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Any, List, Optional, Type
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.models import HourlySales, IceCream, IceCreamSales, SalesReport
+from app.responses import ModelJSONResponse, compress
+
+from .serialization import ICECREAM, make_order
+
+
+def payloads(args: argparse.Namespace) -> List[tuple]:
+    catalog = [ICECREAM.copy(update={"id": i, "name": f"ice cream {i}"}) for i in range(args.catalog_size)]
+    orders = [
+        make_order(args.positions).copy(update={"id": i, "created_at": datetime.now() - timedelta(hours=i)})
+        for i in range(args.orders)
+    ]
+    report = SalesReport(
+        top=[IceCreamSales(icecream_id=i, quantity=100 - i, revenue=1589.0 - i) for i in range(10)],
+        hourly=[HourlySales(hour=datetime(2021, 11, 11) + timedelta(hours=i), orders=i) for i in range(24)],
+    )
+    return [
+        ("GET /api/icecream/{item_id}", None, catalog[0]),
+        ("GET /api/icecream/?limit=20", None, catalog[:20]),
+        ("PUT /api/icecream/batch", List[IceCream], catalog),
+        ("POST /api/order/new", None, orders[0]),
+        ("GET /api/order/my", None, orders),
+        ("GET /api/analytics/sales", SalesReport, report),
+    ]
+
+
+def fastapi_encoder(response_model: Optional[Type]):
+    field = create_response_field("response", response_model) if response_model else None
+
+    async def encode(content: Any) -> bytes:
+        encoded = await serialize_response(field=field, response_content=content)
+        return JSONResponse(encoded).body
+
+    return encode
+
+
+async def orjson_encoder(content: Any) -> bytes:
+    return ModelJSONResponse(content).body
+
+
+async def microseconds(encode, content: Any, calls: int) -> float:
+    start = time.perf_counter()
+    for _ in range(calls):
+        await encode(content)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+async def main(args: argparse.Namespace) -> None:
+    print(f"{'endpoint':>28}  {'fastapi µs':>10}  {'orjson µs':>10}  {'bytes':>7}  {'gzip':>6}  {'br':>6}")
+    for endpoint, response_model, content in payloads(args):
+        body = ModelJSONResponse(content).body
+        print(
+            f"{endpoint:>28}"
+            f"  {await microseconds(fastapi_encoder(response_model), content, args.calls):10.1f}"
+            f"  {await microseconds(orjson_encoder, content, args.calls):10.1f}"
+            f"  {len(body):7}  {len(compress(body, 'gzip')):6}  {len(compress(body, 'br')):6}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--catalog-size", type=int, default=200)
+    parser.add_argument("--orders", type=int, default=20, help="orders in a page")
+    parser.add_argument("--positions", type=int, default=5, help="positions per order")
+    parser.add_argument("--calls", type=int, default=2000)
+    asyncio.run(main(parser.parse_args()))
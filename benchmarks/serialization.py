@@ -0,0 +1,90 @@
+"""Stored size and encode/decode speed of orders and icecreams, JSON vs msgpack.
+
+"json" is what was written before app.serialization: the pydantic JSON of an
+order, and the icecream hash fields (sizes summed over field names and values).
+
+    python -m benchmarks.serialization --positions 1 5 20 --calls 20000
+"""
+import argparse
+import time
+from datetime import datetime
+
+from app.models import IceCream, Order, OrderPosition
+from app.serialization import ICECREAM_SERIALIZER, ORDER_SERIALIZER, Serializer
+from app.utils import RedisUtils
+
+ICECREAM = IceCream(
+    id=1234,
+    name="Hot Summer",
+    price=15.89,
+    weight=70.0,
+    img_url="https://media-cdn.tripadvisor.com/media/photo-s/18/7c/da/68/bonmot-ice-cream.jpg",
+    img_status="ready",
+    thumbnail_url="http://localhost/static/images/9f86d081884c7d659a2feaa0c55ad015-160.webp",
+    medium_url="http://localhost/static/images/9f86d081884c7d659a2feaa0c55ad015-640.webp",
+)
+
+
+def make_order(positions: int) -> Order:
+    return Order(
+        id=123456,
+        user_login="bestboss",
+        created_at=datetime.now(),
+        positions=[OrderPosition(icecream_id=i, quantity=2) for i in range(1, positions + 1)],
+    )
+
+
+def per_second(func, calls: int) -> float:
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return calls / (time.perf_counter() - start)
+
+
+def measure(serializer: Serializer, obj, calls: int, **known) -> tuple:
+    raw = serializer.dumps(obj)
+    return (
+        len(raw),
+        per_second(lambda: serializer.dumps(obj), calls),
+        per_second(lambda: serializer.loads(raw, **known), calls),
+    )
+
+
+def legacy_icecream(calls: int) -> tuple:
+    fields = {
+        key.encode(): str(value).encode()
+        for key, value in ICECREAM.dict(exclude_none=True).items()
+    }
+    return (
+        sum(len(key) + len(value) for key, value in fields.items()),
+        per_second(lambda: ICECREAM.dict(exclude_none=True), calls),
+        per_second(lambda: RedisUtils.icecream_from_hash(fields), calls),
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    rows = []
+    for positions in args.positions:
+        order = make_order(positions)
+        json_serializer = Serializer(Order, [ORDER_SERIALIZER.current], "json", {"id"})
+        legacy_raw = order.json()
+        legacy = (
+            len(legacy_raw),
+            per_second(order.json, args.calls),
+            per_second(lambda: Order.parse_raw(legacy_raw), args.calls),
+        )
+        rows.append((f"order, {positions} positions", "json", *legacy))
+        rows.append(("", "json, no id", *measure(json_serializer, order, args.calls, id=order.id)))
+        rows.append(("", "msgpack", *measure(ORDER_SERIALIZER, order, args.calls, id=order.id)))
+    rows.append(("icecream", "hash fields", *legacy_icecream(args.calls)))
+    rows.append(("", "msgpack", *measure(ICECREAM_SERIALIZER, ICECREAM, args.calls)))
+    print(f"{'':>22}  {'format':>12}  {'bytes':>6}  {'encode/s':>10}  {'decode/s':>10}")
+    for name, storage_format, size, encode, decode in rows:
+        print(f"{name:>22}  {storage_format:>12}  {size:6}  {encode:10.0f}  {decode:10.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--positions", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--calls", type=int, default=20000)
+    main(parser.parse_args())
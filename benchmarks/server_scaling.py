@@ -0,0 +1,133 @@
+"""Throughput of the gunicorn server as the number of workers grows.
+
+Starts `gunicorn -c gunicorn.conf.py` with each --workers count and loads it
+with benchmarks.http_api in url mode from --loaders processes at once (one
+Python load generator saturates well before a multi-core server does).
+Prints one JSON document with the summed requests/sec and worst p99 per
+worker count and scenario.
+
+Workers are separate processes, so this needs a real Redis, which is flushed!
+
+    python -m benchmarks.server_scaling --redis-url redis://localhost/15 --workers 1 2 4 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import aioredis
+import httpx
+
+
+def start_server(workers: int, port: int, redis_url: str) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "REDIS_URL": redis_url,
+        "WEB_CONCURRENCY": str(workers),
+        "BIND": f"127.0.0.1:{port}",
+        "LOG_LEVEL": "WARNING",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app.main:app", "-c", "gunicorn.conf.py"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health/ready", timeout=1).status_code == 200:
+                return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("server did not start")
+
+
+def run_loaders(args: argparse.Namespace, port: int) -> list:
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.http_api",
+        "--mode",
+        "url",
+        "--url",
+        f"http://127.0.0.1:{port}",
+        "--concurrency",
+        str(args.concurrency),
+        "--duration",
+        str(args.duration),
+        "--catalog-size",
+        str(args.catalog_size),
+        "--users",
+        "2",
+        "--orders-per-user",
+        "5",
+        "--scenarios",
+        *args.scenarios,
+    ]
+    loaders = [
+        subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        for _ in range(args.loaders)
+    ]
+    return [json.loads(loader.communicate()[0]) for loader in loaders]
+
+
+def summarize(reports: list, scenarios: list) -> dict:
+    summary = {}
+    for name in scenarios:
+        results = [report["scenarios"][name] for report in reports]
+        summary[name] = {
+            "rps": round(sum(result["rps"] for result in results), 1),
+            "errors": sum(result["errors"] for result in results),
+            "p99_ms": max(result["p99_ms"] for result in results),
+        }
+    return summary
+
+
+async def flush(redis_url: str) -> None:
+    client = aioredis.from_url(redis_url)
+    await client.flushall()
+    await client.connection_pool.disconnect()
+
+
+def main(args: argparse.Namespace) -> dict:
+    results = {}
+    for workers in args.workers:
+        asyncio.run(flush(args.redis_url))
+        server = start_server(workers, args.port, args.redis_url)
+        try:
+            results[str(workers)] = summarize(run_loaders(args, args.port), args.scenarios)
+        finally:
+            server.terminate()  # graceful: drains in-flight requests
+            server.wait()
+        print(f"{workers} workers: {results[str(workers)]}", file=sys.stderr)
+    return {
+        "cpu_count": os.cpu_count(),
+        "loaders": args.loaders,
+        "concurrency_per_loader": args.concurrency,
+        "duration_s": args.duration,
+        "workers": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", required=True, help="real Redis shared by the workers (flushed!)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--loaders", type=int, default=4, help="load generator processes")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent requests per loader")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per scenario")
+    parser.add_argument("--scenarios", nargs="+", default=["catalog", "item", "order_create"])
+    parser.add_argument("--catalog-size", type=int, default=100)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+    report = main(args)
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
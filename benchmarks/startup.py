@@ -0,0 +1,72 @@
+"""Import-to-first-request time of a fresh server process.
+
+Imports `app.main` in a new interpreter --runs times, then starts uvicorn
+as many times and polls /health/ready, measuring from process start to
+ready and to the first catalog response. Also prints the startup_seconds
+phases the server reported in /metrics.
+
+Warm-up talks to Redis, so this needs a real one (the catalog is left as is):
+
+    python -m benchmarks.startup --redis-url redis://localhost/15 --runs 5
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import app.main; print(time.perf_counter() - t)"
+
+
+def import_seconds() -> float:
+    return float(subprocess.check_output([sys.executable, "-c", IMPORT_SNIPPET], text=True))
+
+
+def serve_once(args: argparse.Namespace) -> dict:
+    env = {**os.environ, "REDIS_URL": args.redis_url, "LOG_LEVEL": "WARNING"}
+    command = [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(args.port), "--log-level", "warning"]
+    base_url = f"http://127.0.0.1:{args.port}"
+    started_at = time.perf_counter()
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+    try:
+        ready = None
+        while ready is None:
+            if time.perf_counter() - started_at > 30:
+                raise RuntimeError("server did not get ready")
+            try:
+                if httpx.get(f"{base_url}/health/ready", timeout=1).status_code == 200:
+                    ready = time.perf_counter() - started_at
+            except httpx.TransportError:
+                time.sleep(0.01)
+        httpx.get(f"{base_url}/api/icecream/", timeout=5).raise_for_status()
+        first_catalog = time.perf_counter() - started_at
+        metrics = httpx.get(f"{base_url}/metrics", timeout=5).text
+        phases = {
+            phase: float(value)
+            for phase, value in re.findall(r'startup_seconds\{phase="(\w+)"\} ([\d.e-]+)', metrics)
+        }
+        return {"ready": ready, "first_catalog": first_catalog, **{f"server_{k}": v for k, v in phases.items()}}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(args: argparse.Namespace) -> None:
+    imports = [import_seconds() for _ in range(args.runs)]
+    print(f"{'import app.main':>28}: median {statistics.median(imports) * 1000:8.1f} ms")
+    runs = [serve_once(args) for _ in range(args.runs)]
+    for name in runs[0]:
+        values = [run[name] for run in runs if name in run]
+        print(f"{name:>28}: median {statistics.median(values) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", required=True)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8767)
+    main(parser.parse_args())
@@ -0,0 +1,26 @@
+"""Production server: `gunicorn app.main:app -c gunicorn.conf.py`.
+
+Every worker is a separate process with its own event loop, caches and
+Redis pool of REDIS_MAX_CONNECTIONS, so size Redis' maxclients for
+WEB_CONCURRENCY * REDIS_MAX_CONNECTIONS plus the pubsub connections.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Not preloaded: each worker imports the app itself and builds its own Redis pool.
+preload_app = False
+
+# On SIGTERM workers stop accepting, finish in-flight requests and run the
+# shutdown handlers; whatever is left after graceful_timeout is killed.
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+timeout = int(os.getenv("WORKER_TIMEOUT", 60))
+keepalive = int(os.getenv("KEEPALIVE", 5))
+# Recycle workers now and then, jittered so they do not restart together.
+max_requests = int(os.getenv("MAX_REQUESTS", 100000))
+max_requests_jitter = max_requests // 10
+
+accesslog = None  # requests are logged and measured by the app itself
+loglevel = os.getenv("LOG_LEVEL", "info").lower()